@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+运营批量操作
+批量发放免费机会、批量查询用户，输入可以是用户 ID 列表或 CSV（第一列为用户 ID）。
+按 ADMIN_BATCH_SIZE 分批，每批一条 executemany 写入并单独提交，写锁只在一批内持有，不阻塞线上请求。
+
+命令行：
+    python -m api.admin grant --chances 3 --file campaign.csv
+    python -m api.admin grant --chances 1 user_a user_b
+    python -m api.admin lookup --file users.csv > chances.csv
+    cat users.csv | python -m api.admin lookup --file -
+"""
+import os
+import csv
+import sys
+import time
+import logging
+import argparse
+
+from .user_manager import UserManager
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 批量操作配置
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')  # 管理接口令牌，未设置时管理接口不可用
+ADMIN_BATCH_SIZE = int(os.environ.get('ADMIN_BATCH_SIZE', '1000'))  # 每个事务处理的用户数
+ADMIN_BATCH_PAUSE = float(os.environ.get('ADMIN_BATCH_PAUSE', '0'))  # 两批之间的停顿（秒），让出写锁给线上请求
+ADMIN_MAX_USERS = int(os.environ.get('ADMIN_MAX_USERS', '5000'))  # 单次 HTTP 请求最多处理的用户数，更大的名单用命令行
+
+# CSV 表头中可能出现的用户 ID 列名
+USER_ID_HEADERS = {'id', 'user_id', 'userid', '用户id'}
+
+
+def read_user_ids(lines):
+    """从 CSV 行中读出用户 ID（第一列），跳过空行和表头"""
+    for index, row in enumerate(csv.reader(lines)):
+        if not row:
+            continue
+        user_id = row[0].strip()
+        if not user_id or (index == 0 and user_id.lower() in USER_ID_HEADERS):
+            continue
+        yield user_id
+
+
+def chunked(user_ids, size):
+    """按 size 分批，同一次操作中重复的用户 ID 只保留第一次出现"""
+    seen = set()
+    chunk = []
+    for user_id in user_ids:
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        chunk.append(user_id)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def grant_chances(user_ids, chances, batch_size=ADMIN_BATCH_SIZE, pause=ADMIN_BATCH_PAUSE, progress=None):
+    """
+    为每个用户增加 chances 次免费机会，不存在的用户按默认机会数创建
+    :param user_ids: 用户 ID 的可迭代对象，可以是流式读取的 CSV
+    :param progress: 每批提交后调用 progress(已处理数)
+    :return: {'users': 处理的用户数, 'batches': 批数, 'elapsed': 耗时}
+    """
+    if chances <= 0:
+        raise ValueError('发放的机会数必须大于 0')
+    started = time.perf_counter()
+    done = batches = 0
+    for chunk in chunked(user_ids, max(1, batch_size)):
+        done += UserManager.add_chances_many(chunk, chances)
+        batches += 1
+        if progress:
+            progress(done)
+        if pause:
+            time.sleep(pause)
+    elapsed = time.perf_counter() - started
+    logger.info(f"批量发放完成: {done} 个用户各 {chances} 次机会，{batches} 批，耗时 {elapsed:.2f}s")
+    return {'users': done, 'batches': batches, 'elapsed': elapsed}
+
+
+def lookup_users(user_ids, batch_size=ADMIN_BATCH_SIZE, progress=None):
+    """
+    批量查询用户，按输入顺序逐个产出 (用户ID, 用户信息)，不存在的用户信息为 None
+    """
+    done = 0
+    for chunk in chunked(user_ids, max(1, batch_size)):
+        users = UserManager.get_users(chunk)
+        for user_id in chunk:
+            yield user_id, users.get(user_id)
+        done += len(chunk)
+        if progress:
+            progress(done)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SoulMate 批量发放机会和查询用户')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name, help_text in (('grant', '批量发放免费机会'), ('lookup', '批量查询用户，结果以 CSV 输出到 stdout')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('user_ids', nargs='*', help='用户 ID，也可以用 --file 读取')
+        sub.add_argument('--file', help='CSV 文件，第一列为用户 ID；- 表示从 stdin 读取')
+        sub.add_argument('--batch-size', type=int, default=ADMIN_BATCH_SIZE, help='每个事务处理的用户数')
+        if name == 'grant':
+            sub.add_argument('--chances', type=int, required=True, help='每个用户增加的机会数')
+            sub.add_argument('--pause', type=float, default=ADMIN_BATCH_PAUSE, help='两批之间的停顿（秒）')
+    args = parser.parse_args(argv)
+
+    # 命令行单独运行时先确认表结构
+    from .migrations import ensure_schema
+    ensure_schema(UserManager.storage)
+
+    source = None
+    if args.file == '-':
+        user_ids = read_user_ids(sys.stdin)
+    elif args.file:
+        source = open(args.file, newline='', encoding='utf-8-sig')
+        user_ids = read_user_ids(source)
+    else:
+        user_ids = iter(args.user_ids)
+
+    started = time.perf_counter()
+
+    def report(done):
+        elapsed = time.perf_counter() - started
+        print(f"\r已处理 {done} 个用户，{done / elapsed if elapsed else 0:.0f} 个/秒", end='', file=sys.stderr, flush=True)
+
+    try:
+        if args.command == 'grant':
+            result = grant_chances(user_ids, args.chances, args.batch_size, args.pause, report)
+            print(file=sys.stderr)
+            print(f"已为 {result['users']} 个用户各增加 {args.chances} 次机会，共 {result['batches']} 批，"
+                  f"耗时 {result['elapsed']:.2f}s")
+        else:
+            writer = csv.writer(sys.stdout)
+            writer.writerow(['user_id', 'exists', 'free_chances', 'last_shared_at'])
+            for user_id, user in lookup_users(user_ids, args.batch_size, report):
+                if user:
+                    writer.writerow([user_id, 1, user['free_chances'], user['last_shared_at'] or ''])
+                else:
+                    writer.writerow([user_id, 0, '', ''])
+            print(file=sys.stderr)
+    finally:
+        if source is not None:
+            source.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,15 @@
-import sqlite3
-from flask import Flask
+# -*- coding: utf-8 -*-
+"""
+兼容旧的建表脚本
+支付相关的表已纳入 api/migrations.py 统一管理，本脚本只是执行全部迁移，
+等同于 python -m api.migrations --db soulmate.db
+"""
+import os
+import sys
 
-app = Flask(__name__)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.migrations import migrate
+from api.storage import SQLiteBackend
 
 # 配置数据库路径
 db_path = 'soulmate.db'
@@ -9,46 +17,10 @@ db_path = 'soulmate.db'
 # 创建数据库表
 def create_payment_table():
     try:
-        # 连接数据库
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # 创建payment_orders表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payment_orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id TEXT UNIQUE NOT NULL,
-                user_id TEXT NOT NULL,
-                product_type TEXT NOT NULL,
-                amount REAL NOT NULL,
-                status TEXT NOT NULL DEFAULT 'PENDING',
-                error_msg TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        # 创建payment_records表（如果需要）
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payment_records (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                order_id TEXT NOT NULL,
-                user_id TEXT NOT NULL,
-                amount REAL NOT NULL,
-                status TEXT NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-        
-        conn.commit()
+        migrate(SQLiteBackend(db_path))
         print("数据库表创建成功！")
     except Exception as e:
         print(f"创建数据库表时出错: {str(e)}")
-    finally:
-        if conn:
-            conn.close()
 
 if __name__ == '__main__':
-    create_payment_table()
\ No newline at end of file
+    create_payment_table()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+SQLite 连接池
+连接在请求处理线程和后台生成线程之间复用，统一开启 WAL 日志模式并设置性能相关的 PRAGMA。
+每个连接自带语句缓存（cached_statements），连接复用即可复用已编译的预处理语句。
+"""
+import os
+import queue
+import sqlite3
+import logging
+import threading
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 数据库配置
+DB_PATH = os.environ.get('SOULMATE_DB_PATH', 'soulmate.db')
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '16'))  # 最大连接数
+POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))  # 等待空闲连接的最长时间（秒）
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))  # 遇到写锁时的等待时间
+CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '16384'))  # 每个连接的页缓存大小
+STATEMENT_CACHE = int(os.environ.get('DB_STATEMENT_CACHE', '256'))  # 每个连接缓存的预处理语句数
+
+
+class PoolTimeoutError(Exception):
+    """在超时时间内没有拿到空闲连接"""
+
+
+class ConnectionPool:
+    def __init__(self, db_path=DB_PATH, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """创建新连接并设置 PRAGMA"""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_MS / 1000.0,
+            check_same_thread=False,  # 连接由连接池保证同一时间只被一个线程使用
+            cached_statements=STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        # 新建的数据库启用增量回收，归档任务删除的空间可以分批归还给文件系统
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        # WAL 模式下读操作不会被写操作阻塞
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 已能保证数据库一致性，只在检查点时 fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+        conn.execute(f'PRAGMA cache_size=-{CACHE_SIZE_KB}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def acquire(self):
+        """从连接池取出一个连接，没有空闲连接且未达上限时新建"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeoutError(f'等待数据库连接超时 ({self.timeout}s)')
+
+    def created(self):
+        """已创建的连接数"""
+        return self._created
+
+    @staticmethod
+    def _reset(conn):
+        """归还前回滚未提交的事务"""
+        if conn.in_transaction:
+            conn.rollback()
+
+    def release(self, conn):
+        """归还连接，未提交的事务会被回滚"""
+        try:
+            self._reset(conn)
+        except Exception as e:
+            # 连接已损坏，丢弃并允许重新创建
+            logger.error(f"归还数据库连接失败: {str(e)}")
+            try:
+                conn.close()
+            except Exception:
+                pass
+            with self._lock:
+                self._created -= 1
+            return
+        self._idle.put(conn)
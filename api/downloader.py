@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+图像下载
+使用共享的 keep-alive 会话分块流式下载到临时文件，边写边计算内容哈希，完成后交给图像存储，
+内存占用与图像大小和并发数无关。
+"""
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+from .metrics import DOWNLOAD_SECONDS, DOWNLOAD_BYTES
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 下载配置
+CONNECT_TIMEOUT = float(os.environ.get('DOWNLOAD_CONNECT_TIMEOUT', '5'))  # 建立连接超时（秒）
+READ_TIMEOUT = float(os.environ.get('DOWNLOAD_READ_TIMEOUT', '30'))  # 两次读取之间的最长间隔（秒）
+MAX_BYTES = int(os.environ.get('DOWNLOAD_MAX_BYTES', str(20 * 1024 * 1024)))  # 单个文件大小上限
+POOL_SIZE = int(os.environ.get('DOWNLOAD_POOL_SIZE', '16'))  # 每个主机保持的连接数
+CHUNK_SIZE = 64 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class DownloadError(Exception):
+    """下载失败或文件超过大小上限"""
+
+
+def get_session():
+    """进程内共享的下载会话，复用 TCP/TLS 连接"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                # requests 只在首次下载时导入，不计入冷启动
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def _content_length(headers):
+    """响应声明的字节数；缺失或格式错误时返回 None，按未知长度下载，由读取时的累计大小把关"""
+    try:
+        return int(headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def download_temp(url, dest_dir, max_bytes=MAX_BYTES):
+    """
+    流式下载 url 到 dest_dir 下的临时文件，边写边计算 SHA-256
+    :return: (临时文件路径, 内容的 SHA-256 十六进制, 字节数)；临时文件由调用方移动或删除
+    :raises DownloadError: 请求失败、超时或文件超过 max_bytes
+    """
+    import requests
+
+    started = time.monotonic()
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.download-')
+    digest = hashlib.sha256()
+    size = 0
+    done = False
+    try:
+        with get_session().get(url, stream=True, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            content_length = _content_length(response.headers)
+            if content_length is not None and content_length > max_bytes:
+                raise DownloadError(f'文件过大: {content_length} 字节')
+            with os.fdopen(fd, 'wb') as f:
+                fd = None
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise DownloadError(f'文件超过大小上限 {max_bytes} 字节')
+                    digest.update(chunk)
+                    f.write(chunk)
+        done = True
+    except requests.RequestException as e:
+        DOWNLOAD_SECONDS.observe(time.monotonic() - started, 'error')
+        raise DownloadError(f'下载失败: {str(e)}') from e
+    except DownloadError:
+        DOWNLOAD_SECONDS.observe(time.monotonic() - started, 'too_large')
+        raise
+    finally:
+        if fd is not None:
+            os.close(fd)
+        if not done and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    elapsed = time.monotonic() - started
+    DOWNLOAD_SECONDS.observe(elapsed, 'ok')
+    DOWNLOAD_BYTES.inc(amount=size)
+    throughput = size / elapsed / 1024 if elapsed > 0 else 0
+    logger.info(f"图像下载完成: {size} 字节, 耗时 {elapsed:.2f}s, {throughput:.0f} KB/s")
+    return tmp_path, digest.hexdigest(), size
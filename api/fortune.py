@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+命理特征与提示词
+由出生日期、时间和地点推算四柱八字、生肖、节气、季节和时辰，得到一组规范化的特征，
+再按特征从预先准备的词表中取词，组装图像提示词、诗句和详细解读。
+
+- 所有表在导入时构建一次：节气按“月-日”展开为 372 字节的查找表，时辰按小时展开为 24 字节的查找表，
+  六十甲子、五行、生肖等为元组，推算过程只有整数运算和下标访问
+- 同样的输入总是得到同样的提示词，结果缓存（按提示词哈希）可以直接命中
+- 节气按常年的平均日期划分，与当年的实际交节时刻可能相差一天；晚子时（23 点后）仍按当日计算日柱
+"""
+import re
+import zlib
+import datetime
+import functools
+import unicodedata
+from collections import namedtuple
+
+from .gazetteer import gazetteer
+
+# ----------------------------------------------------------------------
+# 基础表
+# ----------------------------------------------------------------------
+
+HEAVENLY_STEMS = '甲乙丙丁戊己庚辛壬癸'
+EARTHLY_BRANCHES = '子丑寅卯辰巳午未申酉戌亥'
+ZODIAC = '鼠牛虎兔龙蛇马羊猴鸡狗猪'
+ELEMENTS = '木火土金水'
+
+# 六十甲子：下标 i 对应天干 i % 10、地支 i % 12
+SEXAGENARY = tuple(HEAVENLY_STEMS[i % 10] + EARTHLY_BRANCHES[i % 12] for i in range(60))
+
+# 天干、地支的五行（ELEMENTS 的下标）
+STEM_ELEMENT = bytes((0, 0, 1, 1, 2, 2, 3, 3, 4, 4))
+BRANCH_ELEMENT = bytes((4, 2, 0, 0, 2, 1, 1, 2, 3, 3, 2, 4))
+
+# 日柱的起点：1949-10-01 为甲子日
+DAY_PILLAR_EPOCH = datetime.date(1949, 10, 1).toordinal()
+
+# 二十四节气：(名称, 常年交节日期, 物候)，从小寒开始按公历顺序排列
+SOLAR_TERMS = (
+    ('小寒', (1, 6), '雁北乡，梅花初绽'),
+    ('大寒', (1, 20), '冰雪凝枝，腊梅飘香'),
+    ('立春', (2, 4), '东风解冻，柳芽初萌'),
+    ('雨水', (2, 19), '春雨如丝，草色遥看'),
+    ('惊蛰', (3, 6), '春雷初响，桃花始开'),
+    ('春分', (3, 21), '玄鸟归来，海棠盛放'),
+    ('清明', (4, 5), '杏花烟雨，柳絮轻扬'),
+    ('谷雨', (4, 20), '牡丹盛开，新茶吐翠'),
+    ('立夏', (5, 6), '蔷薇满架，绿荫初浓'),
+    ('小满', (5, 21), '麦穗渐黄，石榴花红'),
+    ('芒种', (6, 6), '栀子飘香，梅雨绵绵'),
+    ('夏至', (6, 21), '荷叶田田，蝉鸣初起'),
+    ('小暑', (7, 7), '荷风送香，萤火点点'),
+    ('大暑', (7, 23), '莲花盛放，骤雨初歇'),
+    ('立秋', (8, 8), '凉风初至，梧桐叶落'),
+    ('处暑', (8, 23), '暑气渐消，紫薇犹艳'),
+    ('白露', (9, 8), '白露凝珠，桂子初香'),
+    ('秋分', (9, 23), '丹桂飘香，明月当空'),
+    ('寒露', (10, 8), '菊花盛开，枫叶渐红'),
+    ('霜降', (10, 23), '霜林尽染，层叠红叶'),
+    ('立冬', (11, 7), '银杏金黄，落叶铺阶'),
+    ('小雪', (11, 22), '初雪轻飘，山茶含苞'),
+    ('大雪', (12, 7), '大雪封山，红梅映雪'),
+    ('冬至', (12, 22), '雪夜围炉，水仙清雅'),
+)
+
+SEASONS = ('春季', '夏季', '秋季', '冬季')
+# 节气所在的季节：立春至谷雨为春，立夏至大暑为夏，立秋至霜降为秋，立冬至大寒为冬
+SEASON_BY_TERM = bytes((3, 3) + (0,) * 6 + (1,) * 6 + (2,) * 6 + (3,) * 4)
+
+
+def _build_term_table():
+    """“月-日”到节气下标的查找表，下标为 (月 - 1) * 31 + (日 - 1)；元旦到小寒前属于上一年的冬至"""
+    table = bytearray(12 * 31)
+    term = len(SOLAR_TERMS) - 1
+    starts = {date: index for index, (_, date, _) in enumerate(SOLAR_TERMS)}
+    for month in range(1, 13):
+        for day in range(1, 32):
+            term = starts.get((month, day), term)
+            table[(month - 1) * 31 + day - 1] = term
+    return bytes(table)
+
+
+TERM_BY_DAY = _build_term_table()
+
+# 十二时辰：(名称, 别称, 画面)，子时为 23:00-00:59
+SHICHEN = (
+    ('子时', '夜半', '月下灯影，夜色温柔'),
+    ('丑时', '鸡鸣', '星河渐隐，万籁俱寂'),
+    ('寅时', '平旦', '破晓前的微光'),
+    ('卯时', '日出', '晨曦初照，朝霞满天'),
+    ('辰时', '食时', '清晨薄雾，露珠晶莹'),
+    ('巳时', '隅中', '上午明媚的阳光'),
+    ('午时', '日中', '正午明亮的天光'),
+    ('未时', '日昳', '午后斜阳，树影婆娑'),
+    ('申时', '哺时', '傍晚金色的光线'),
+    ('酉时', '日入', '夕阳西下，晚霞绚烂'),
+    ('戌时', '黄昏', '华灯初上的暮色'),
+    ('亥时', '人定', '静谧的夜色，灯火阑珊'),
+)
+# 小时到时辰（地支）下标
+SHICHEN_BY_HOUR = bytes(((hour + 1) // 2) % 12 for hour in range(24))
+
+# ----------------------------------------------------------------------
+# 词表：按五行、季节、地域取词
+# ----------------------------------------------------------------------
+
+# 正缘的外貌，按正缘所属的五行（命主最弱的五行）
+APPEARANCE = (
+    '身形修长挺拔，眉目清朗，气质儒雅',
+    '神采飞扬，笑容明亮，眼神热忱',
+    '五官端正，面容敦厚，气质沉稳',
+    '轮廓分明，眉峰英挺，气质清冷',
+    '眼神温润，神情温柔，气质灵动',
+)
+# 正缘的性格
+PARTNER_TRAITS = (
+    '此人性格正直温和，富有上进心，像春天的树一样让人安心。',
+    '此人性格开朗，热情大方，善于沟通，能让平淡的日子充满温度。',
+    '此人稳重踏实，重信守诺，顾家体贴，是值得托付终身的伴侣。',
+    '此人果断干练，原则分明，事业上积极进取。',
+    '此人聪慧灵动，善解人意，体贴入微，懂得倾听。',
+)
+# 遇见正缘的时机，按正缘所属五行旺的季节
+FAVORABLE_SEASON = ('春季', '夏季', '换季之时', '秋季', '冬季')
+# 画风，按命主最旺的五行
+STYLES = (
+    '青绿山水画风格，工笔重彩',
+    '中国传统绘画风格，工笔重彩',
+    '宋代院体画风格，设色典雅',
+    '水墨淡彩风格，留白意境',
+    '水墨写意风格，烟雨朦胧',
+)
+# 衣着，按季节
+ATTIRE = ('身着月白长衫', '身着青色纱袍', '身着赭色锦袍', '身披素色大氅')
+# 日主（日柱天干）的性情
+DAY_MASTER_TRAITS = (
+    '如参天大树，正直向上，有担当',
+    '如花草藤萝，柔韧灵巧，善于变通',
+    '如当空烈日，热情坦荡，光明磊落',
+    '如灯烛之火，细腻温暖，心思周到',
+    '如高山厚土，稳重可靠，包容大度',
+    '如田园沃土，温和踏实，善于照顾他人',
+    '如刀剑之金，刚毅果断，重情重义',
+    '如珠玉之金，精致敏锐，追求完美',
+    '如江河之水，聪明豁达，胸怀宽广',
+    '如雨露之水，温柔细腻，富有灵性',
+)
+
+POEMS = (
+    '心有灵犀一点通，有缘千里来相会',
+    '两情若是久长时，又岂在朝朝暮暮',
+    '愿得一心人，白头不相离',
+    '执子之手，与子偕老',
+    '金风玉露一相逢，便胜却人间无数',
+    '众里寻他千百度，蓦然回首，那人却在灯火阑珊处',
+    '山有木兮木有枝，心悦君兮君不知',
+    '在天愿作比翼鸟，在地愿为连理枝',
+    '玲珑骰子安红豆，入骨相思知不知',
+    '曾经沧海难为水，除却巫山不是云',
+    '人生若只如初见',
+    '有情人终成眷属，天涯路亦有归途',
+)
+
+# 地域景致：(地名关键字, 景致)；出生地以关键字开头即归入该地域
+REGIONS = (
+    (('江苏', '浙江', '上海', '苏州', '杭州', '南京', '无锡', '宁波', '绍兴', '扬州', '嘉兴'), '小桥流水、粉墙黛瓦的江南水乡'),
+    (('广东', '广西', '海南', '香港', '澳门', '广州', '深圳', '佛山', '东莞', '桂林', '南宁', '海口', '三亚'), '榕树葱茏、骑楼林立的岭南街巷'),
+    (('四川', '重庆', '成都'), '云雾缭绕的巴山蜀水'),
+    (('北京', '天津', '河北', '石家庄'), '红墙金瓦的京华胡同'),
+    (('河南', '山西', '陕西', '西安', '洛阳', '郑州', '开封', '太原'), '古都城阙与黄河长风'),
+    (('内蒙古', '新疆', '甘肃', '宁夏', '青海', '西藏', '呼和浩特', '乌鲁木齐', '兰州', '拉萨'), '天高地阔的草原与雪山'),
+    (('辽宁', '吉林', '黑龙江', '沈阳', '长春', '哈尔滨', '大连'), '白山黑水、林海雪原'),
+    (('湖北', '湖南', '江西', '武汉', '长沙', '南昌'), '烟波浩渺的荆楚湖泽'),
+    (('山东', '济南', '青岛', '烟台'), '泰山云海与海滨渔火'),
+    (('福建', '台湾', '福州', '厦门', '泉州', '台北'), '海风吹拂的闽台山海'),
+    (('云南', '贵州', '昆明', '贵阳', '大理', '丽江'), '四季如春、彩云之下的山寨'),
+    (('安徽', '合肥', '黄山'), '徽派马头墙与黄山松石'),
+)
+# 未识别的地点按地名哈希取一种景致
+GENERIC_SCENERY = ('远山近水，云烟缭绕', '亭台楼阁，曲径通幽', '竹林清溪，石桥横卧', '湖光山色，渔舟唱晚')
+
+# 关键字 -> REGIONS 下标；地名表中的地点按自身及上级的简称查找，其他地点按前 2、3 个字查找
+_REGION_BY_PREFIX = {keyword: index for index, (keywords, _) in enumerate(REGIONS) for keyword in keywords}
+_PREFIX_LENGTHS = tuple(sorted({len(keyword) for keyword in _REGION_BY_PREFIX}, reverse=True))
+
+GENDER_PROMPT = '一位英俊的男子'  # 前端没有性别选项，沿用原来的设定
+
+# ----------------------------------------------------------------------
+# 推算
+# ----------------------------------------------------------------------
+
+MAX_PLACE_LENGTH = 50
+_DATE_PATTERN = re.compile(r'(\d{4})[-/.年](\d{1,2})[-/.月](\d{1,2})日?\Z')
+_TIME_PATTERN = re.compile(r'(\d{1,2})[:：时](\d{1,2})(?:[:：分](\d{1,2})秒?)?分?\Z')
+_SPACES = re.compile(r'\s+')
+
+
+class InvalidBirthData(ValueError):
+    """出生日期、时间或地点无法识别"""
+
+
+# 规范化的特征；各柱为 SEXAGENARY 的下标，其他字段为对应表的下标
+BirthFeatures = namedtuple('BirthFeatures', (
+    'year_pillar', 'month_pillar', 'day_pillar', 'hour_pillar',
+    'solar_term', 'season', 'shichen',
+    'dominant_element', 'lacking_element', 'region', 'place',
+))
+
+# 一次推算的全部结果
+Reading = namedtuple('Reading', ('features', 'prompt', 'poem', 'analysis'))
+
+
+def normalize_birth(birth_date, birth_time, birth_place):
+    """
+    规范化出生信息：日期为 YYYY-MM-DD，时间为 HH:MM；地点与地名表中的名称或别名完全对应时换成标准简称
+    （“北京市”“Beijing” -> 北京），其他地点（如县级市“昆山市”）只去掉多余空白，保留用户的原文
+    :raises InvalidBirthData: 无法识别的日期、时间，或地点为空
+    """
+    date_match = _DATE_PATTERN.match(unicodedata.normalize('NFKC', str(birth_date or '')).strip())
+    if not date_match:
+        raise InvalidBirthData('出生日期格式应为 YYYY-MM-DD')
+    try:
+        date = datetime.date(*map(int, date_match.groups()))
+    except ValueError:
+        raise InvalidBirthData('出生日期不存在')
+    if not 1900 <= date.year <= 2100:
+        raise InvalidBirthData('出生年份应在 1900 到 2100 之间')
+
+    time_match = _TIME_PATTERN.match(unicodedata.normalize('NFKC', str(birth_time or '')).strip())
+    if not time_match:
+        raise InvalidBirthData('出生时间格式应为 HH:MM')
+    hour, minute = int(time_match.group(1)), int(time_match.group(2))
+    if hour > 23 or minute > 59:
+        raise InvalidBirthData('出生时间不存在')
+
+    place = _SPACES.sub(' ', unicodedata.normalize('NFKC', str(birth_place or ''))).strip(' ,，。.')
+    if not place:
+        raise InvalidBirthData('出生地点不能为空')
+    resolved = gazetteer.resolve(place)
+    if resolved is not None:
+        place = resolved.name
+    return date.isoformat(), f'{hour:02d}:{minute:02d}', place[:MAX_PLACE_LENGTH]
+
+
+def region_of(place):
+    """地点所属的地域（REGIONS 下标），未识别时返回 -1"""
+    resolved = gazetteer.resolve(place)
+    if resolved is not None:
+        for ancestor in gazetteer.lineage(resolved):
+            index = _REGION_BY_PREFIX.get(ancestor.name)
+            if index is not None:
+                return index
+        return -1
+    for length in _PREFIX_LENGTHS:
+        index = _REGION_BY_PREFIX.get(place[:length])
+        if index is not None:
+            return index
+    return -1
+
+
+def _count_elements(pillars):
+    """八个字的五行计数；最旺、最弱取计数最大、最小者，计数相同时按木火土金水的顺序"""
+    counts = [0] * 5
+    for pillar in pillars:
+        counts[STEM_ELEMENT[pillar % 10]] += 1
+        counts[BRANCH_ELEMENT[pillar % 12]] += 1
+    return counts.index(max(counts)), counts.index(min(counts))
+
+
+def birth_features(birth_date, birth_time, birth_place):
+    """
+    由规范化的出生信息推算特征
+    :param birth_date: YYYY-MM-DD
+    :param birth_time: HH:MM
+    """
+    year, month, day = int(birth_date[0:4]), int(birth_date[5:7]), int(birth_date[8:10])
+    hour = int(birth_time[0:2])
+
+    term = TERM_BY_DAY[(month - 1) * 31 + day - 1]
+    # 年柱以立春为界，立春前仍属上一年
+    pillar_year = year - 1 if month == 1 or (month == 2 and term < 2) else year
+    year_pillar = (pillar_year - 4) % 60
+
+    # 月柱：小寒起丑月，立春起寅月；月干按“五虎遁”由年干推出
+    month_branch = (term // 2 + 1) % 12
+    month_stem = ((year_pillar % 10) % 5 * 2 + 2 + (month_branch - 2) % 12) % 10
+    month_pillar = _pillar(month_stem, month_branch)
+
+    day_pillar = (datetime.date(year, month, day).toordinal() - DAY_PILLAR_EPOCH) % 60
+
+    # 时柱：时支由时辰表查出，时干按“五鼠遁”由日干推出
+    hour_branch = SHICHEN_BY_HOUR[hour]
+    hour_stem = ((day_pillar % 10) % 5 * 2 + hour_branch) % 10
+    hour_pillar = _pillar(hour_stem, hour_branch)
+
+    dominant, lacking = _count_elements((year_pillar, month_pillar, day_pillar, hour_pillar))
+    return BirthFeatures(
+        year_pillar, month_pillar, day_pillar, hour_pillar,
+        term, SEASON_BY_TERM[term], hour_branch,
+        dominant, lacking, region_of(birth_place), birth_place,
+    )
+
+
+def _pillar(stem, branch):
+    """由天干、地支下标求六十甲子下标（天干与地支奇偶相同）"""
+    return (6 * stem - 5 * branch) % 60
+
+
+def _scenery(features):
+    if features.region >= 0:
+        return REGIONS[features.region][1]
+    return GENERIC_SCENERY[zlib.crc32(features.place.encode('utf-8')) % len(GENERIC_SCENERY)]
+
+
+def _prompt(features):
+    term_phenology = SOLAR_TERMS[features.solar_term][2]
+    return '，'.join((
+        GENDER_PROMPT,
+        APPEARANCE[features.lacking_element],
+        ATTIRE[features.season],
+        f'在{SEASONS[features.season]}的{features.place}',
+        SHICHEN[features.shichen][2],
+        f'{term_phenology}，背景是{_scenery(features)}',
+        STYLES[features.dominant_element],
+    ))
+
+
+def _analysis(features, birth_date, birth_time):
+    year, month, day, hour = (SEXAGENARY[p] for p in features[:4])
+    day_stem = features.day_pillar % 10
+    lacking = features.lacking_element
+    return (
+        f"根据您的出生信息 ({birth_date}, {birth_time}, {features.place})，"
+        f"您生于{year}年{month}月{day}日{hour}时，生肖属{ZODIAC[features.year_pillar % 12]}，"
+        f"正值{SOLAR_TERMS[features.solar_term][0]}，{SHICHEN[features.shichen][0]}（{SHICHEN[features.shichen][1]}）出生。\n\n"
+        f"您的日主为{HEAVENLY_STEMS[day_stem]}{ELEMENTS[STEM_ELEMENT[day_stem]]}，{DAY_MASTER_TRAITS[day_stem]}。"
+        f"八字中{ELEMENTS[features.dominant_element]}气最旺，{ELEMENTS[lacking]}气稍弱，"
+        f"与您互补的正缘五行属{ELEMENTS[lacking]}。\n\n"
+        f"您的正缘画像为：\n"
+        f"{PARTNER_TRAITS[lacking]}\n"
+        f"在感情方面，重视家庭，体贴入微，是理想的伴侣。\n"
+        f"建议您在{FAVORABLE_SEASON[lacking]}多参加社交活动，可能会遇到心仪的对象。"
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def _reading(birth_date, birth_time, birth_place):
+    features = birth_features(birth_date, birth_time, birth_place)
+    poem = POEMS[(features.year_pillar + features.month_pillar + features.day_pillar + features.hour_pillar) % len(POEMS)]
+    return Reading(features, _prompt(features), poem, _analysis(features, birth_date, birth_time))
+
+
+def read_birth(birth_date, birth_time, birth_place):
+    """
+    推算出生信息对应的特征、提示词、诗句和详细解读；相同的出生信息命中进程内缓存
+    :raises InvalidBirthData: 出生信息无法识别
+    """
+    return _reading(*normalize_birth(birth_date, birth_time, birth_place))
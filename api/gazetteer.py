@@ -0,0 +1,470 @@
+# -*- coding: utf-8 -*-
+"""
+地名索引
+把用户输入的出生地规范化为地名表中的标准地点（带稳定的 id），并为出生地输入框提供联想。
+“北京”“北京市”“Beijing”“中国北京”都对应 cn.beijing，提示词和结果缓存因此可以命中同一份结果。
+
+- 地名表 data/places.tsv 随代码发布，收录省级、地级行政区（含港澳台）和常见的海外国家、城市
+- 运行 python -m api.gazetteer build 把地名表编译为 data/gazetteer.idx：定长的地点表、
+  按 UTF-8 字节排序的检索词表和字符串区，启动时用 mmap 只读映射，不需要解析，首次查询才打开
+- 检索词为简称、全称、拼音和别名；查询按最长检索词逐段匹配（“江苏省苏州市” -> 江苏 / 苏州），取与各段都一致的地点
+- resolve（规范化）只接受整段输入都由检索词组成的匹配：“昆山市”“北京市朝阳区”这类地名表之外的地点
+  不会被换成前缀或字形相近的城市，由调用方保留原文；suggest（联想）才使用部分匹配和编辑距离
+  模糊匹配（“哈尔宾” -> 哈尔滨），候选由用户自己选择
+- 拼音和英文检索词只能整词匹配，避免 “Alice Springs” 被前缀 “ali” 匹配到阿里
+- 索引文件缺失或与地名表不一致时在内存中临时构建，并打印警告
+
+用法:
+    python -m api.gazetteer build
+    python -m api.gazetteer lookup 江苏省苏州市 Beijing
+    python -m api.gazetteer suggest 南
+"""
+import os
+import re
+import sys
+import mmap
+import zlib
+import struct
+import logging
+import argparse
+import threading
+import unicodedata
+from collections import namedtuple
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 索引配置
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+GAZETTEER_SOURCE = os.environ.get('GAZETTEER_SOURCE') or os.path.join(DATA_DIR, 'places.tsv')  # 地名表
+GAZETTEER_INDEX = os.environ.get('GAZETTEER_INDEX') or os.path.join(DATA_DIR, 'gazetteer.idx')  # 编译后的索引文件
+GAZETTEER_SUGGEST_LIMIT = int(os.environ.get('GAZETTEER_SUGGEST_LIMIT', '10'))  # 联想最多返回的条数
+
+# 索引文件格式（小端）：文件头 | 地点表 | 检索词表 | 字符串区
+MAGIC = b'SMGZ'
+VERSION = 1
+HEADER = struct.Struct('<4sHHIIIIII')  # 魔数、版本、最长检索词字数、地名表 CRC32、地点数、检索词数、三个区的偏移
+PLACE = struct.Struct('<IHHBBH')  # 文本偏移、文本长度、上级下标、层级、权重、保留
+KEY = struct.Struct('<IHH')  # 检索词偏移、检索词长度、地点下标
+NO_PARENT = 0xFFFF
+FIELD_SEPARATOR = '\x1f'  # 地点文本为 id、简称、全称，以该字符分隔
+
+MAX_QUERY_LENGTH = 50  # 查询只取规范化后的前 50 个字符
+MAX_SCAN = 512  # 联想、模糊匹配时最多扫描的检索词数
+
+# 地点：index 为索引中的下标，parent 为上级的下标（顶级为 None），level 为层级（国家 0、省 1、市 2）
+Place = namedtuple('Place', ('index', 'id', 'name', 'full_name', 'parent', 'level', 'weight'))
+
+_SEPARATORS = re.compile(r'[\W_]+')
+
+
+class GazetteerError(ValueError):
+    """地名表格式错误"""
+
+
+def normalize_key(text):
+    """检索词规范化：全角转半角、转小写，去掉空白和标点"""
+    return _SEPARATORS.sub('', unicodedata.normalize('NFKC', str(text or '')).lower())
+
+
+def _query(text):
+    """
+    规范化查询，返回 (检索串, 词边界位置)
+    词边界是原文中空白、标点所在的位置以及中文和拼音交界处，拼音、英文检索词只能在词边界结束
+    """
+    compact, bounds = '', set()
+    for token in _SEPARATORS.split(unicodedata.normalize('NFKC', str(text or '')).lower()):
+        compact += token
+        bounds.add(len(compact))
+    compact = compact[:MAX_QUERY_LENGTH]
+    bounds.update(i for i in range(1, len(compact)) if compact[i - 1].isascii() != compact[i].isascii())
+    bounds.add(len(compact))
+    return compact, bounds
+
+
+def _edit_distance(a, b, limit):
+    """编辑距离，超过 limit 时提前返回 limit + 1"""
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def read_source(path=GAZETTEER_SOURCE):
+    """
+    读取地名表，返回 (行列表, 原始字节的 CRC32)
+    每行为 (id, 简称, 全称, 拼音, 权重, 别名)
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    rows = []
+    for line_no, line in enumerate(raw.decode('utf-8').splitlines(), 1):
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        if len(fields) != 6:
+            raise GazetteerError(f"{path}:{line_no} 应为 6 列，实际 {len(fields)} 列")
+        place_id, name, full_name, pinyin, weight, aliases = fields
+        if not place_id or not name or not weight.isdigit() or not 1 <= int(weight) <= 255:
+            raise GazetteerError(f"{path}:{line_no} id、简称不能为空，权重应为 1 到 255 的整数")
+        rows.append((place_id, name, full_name or name, pinyin, int(weight), aliases))
+    return rows, zlib.crc32(raw)
+
+
+def build_index(source=GAZETTEER_SOURCE):
+    """把地名表编译为索引文件的内容"""
+    rows, source_crc = read_source(source)
+    indexes = {row[0]: index for index, row in enumerate(rows)}
+    if len(indexes) != len(rows):
+        raise GazetteerError('地名表中有重复的 id')
+    if len(rows) >= NO_PARENT:
+        raise GazetteerError(f"地点数超过上限 {NO_PARENT - 1}")
+
+    strings, places, keys = bytearray(), bytearray(), {}
+    for index, (place_id, name, full_name, pinyin, weight, aliases) in enumerate(rows):
+        parent_id = place_id.rpartition('.')[0]
+        if parent_id and parent_id not in indexes:
+            raise GazetteerError(f"{place_id} 的上级 {parent_id} 不存在")
+        text = FIELD_SEPARATOR.join((place_id, name, full_name)).encode('utf-8')
+        places += PLACE.pack(len(strings), len(text), indexes[parent_id] if parent_id else NO_PARENT,
+                             place_id.count('.'), weight, 0)
+        strings += text
+        for key in {normalize_key(word) for word in (name, full_name, pinyin, *aliases.split(','))}:
+            if key:
+                keys.setdefault(key, []).append(index)
+
+    # 检索词按 UTF-8 字节排序（与按码点排序一致），同一检索词的地点按权重从高到低
+    key_table = bytearray()
+    for key in sorted(keys):
+        encoded = key.encode('utf-8')
+        for index in sorted(keys[key], key=lambda i: (-rows[i][4], i)):
+            key_table += KEY.pack(len(strings), len(encoded), index)
+        strings += encoded
+
+    places_offset = HEADER.size
+    keys_offset = places_offset + len(places)
+    strings_offset = keys_offset + len(key_table)
+    header = HEADER.pack(MAGIC, VERSION, max(map(len, keys)), source_crc, len(rows), len(key_table) // KEY.size,
+                         places_offset, keys_offset, strings_offset)
+    return header + bytes(places) + bytes(key_table) + bytes(strings)
+
+
+def write_index(source=GAZETTEER_SOURCE, output=GAZETTEER_INDEX):
+    """编译地名表并原子地替换索引文件，返回写入的字节数"""
+    data = build_index(source)
+    tmp_path = f"{output}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output)
+    return len(data)
+
+
+class Gazetteer:
+    """
+    只读的地名索引，线程安全
+    首次查询时映射索引文件；地点按下标解码后缓存，检索词直接在映射的内存上二分查找
+    """
+
+    def __init__(self, index_path=GAZETTEER_INDEX, source_path=GAZETTEER_SOURCE):
+        self.index_path = index_path
+        self.source_path = source_path
+        self._lock = threading.Lock()
+        self._buffer = None
+        self._places = None
+        self._children = None
+
+    def _load(self):
+        """打开索引（只在第一次调用时执行）"""
+        if self._buffer is None:
+            with self._lock:
+                if self._buffer is None:
+                    buffer = self._open()
+                    (_, _, self._max_key_length, _, place_count, self._key_count,
+                     self._places_offset, self._keys_offset, self._strings_offset) = HEADER.unpack_from(buffer)
+                    self._places = [None] * place_count
+                    self._buffer = buffer
+        return self._buffer
+
+    def _open(self):
+        """映射索引文件；文件缺失、格式不对或与地名表不一致时在内存中构建"""
+        try:
+            with open(self.source_path, 'rb') as f:
+                source_crc = zlib.crc32(f.read())
+        except OSError:
+            source_crc = None  # 只发布了索引文件
+
+        try:
+            with open(self.index_path, 'rb') as f:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, _, index_crc = HEADER.unpack_from(buffer)[:4]
+            if magic == MAGIC and version == VERSION and source_crc in (None, index_crc):
+                return buffer
+            buffer.close()
+            logger.warning(f"地名索引 {self.index_path} 已过期，请运行 python -m api.gazetteer build；本次在内存中重新构建")
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"无法打开地名索引 {self.index_path}: {e}，在内存中构建")
+        return build_index(self.source_path)
+
+    # ------------------------------------------------------------------
+    # 底层访问
+    # ------------------------------------------------------------------
+
+    def place(self, index):
+        """按下标取地点"""
+        self._load()
+        place = self._places[index]
+        if place is None:
+            text_offset, text_length, parent, level, weight, _ = PLACE.unpack_from(
+                self._buffer, self._places_offset + index * PLACE.size)
+            start = self._strings_offset + text_offset
+            place_id, name, full_name = self._buffer[start:start + text_length].decode('utf-8').split(FIELD_SEPARATOR)
+            place = Place(index, place_id, name, full_name, None if parent == NO_PARENT else parent, level, weight)
+            self._places[index] = place
+        return place
+
+    def lineage(self, place):
+        """地点自身及其各级上级，从下往上"""
+        result = [place]
+        while place.parent is not None:
+            place = self.place(place.parent)
+            result.append(place)
+        return result
+
+    def children(self, place):
+        """直接下级，按权重从高到低"""
+        if self._children is None:
+            children = {}
+            for index in range(len(self._places)):
+                child = self.place(index)
+                children.setdefault(child.parent, []).append(child)
+            for group in children.values():
+                group.sort(key=lambda p: (-p.weight, p.index))
+            self._children = children
+        return self._children.get(place.index, [])
+
+    def _key(self, position):
+        """第 position 个检索词，返回 (UTF-8 字节, 地点下标)"""
+        key_offset, key_length, index = KEY.unpack_from(self._buffer, self._keys_offset + position * KEY.size)
+        start = self._strings_offset + key_offset
+        return self._buffer[start:start + key_length], index
+
+    def _lower_bound(self, encoded, lo, hi):
+        """[lo, hi) 中第一个不小于 encoded 的检索词位置"""
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0] < encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _prefix_end(self, encoded, lo, hi):
+        """[lo, hi) 以 encoded 开头的检索词之后的第一个位置（lo 须为 encoded 的下界）"""
+        size = len(encoded)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0][:size] <= encoded:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _prefix_range(self, prefix, lo=0, hi=None):
+        """以 prefix 开头的检索词所在的位置区间"""
+        encoded = prefix.encode('utf-8')
+        lo = self._lower_bound(encoded, lo, self._key_count if hi is None else hi)
+        return lo, self._prefix_end(encoded, lo, self._key_count if hi is None else hi)
+
+    # ------------------------------------------------------------------
+    # 匹配
+    # ------------------------------------------------------------------
+
+    def _longest_key(self, compact, start, bounds):
+        """
+        从 start 开始能匹配的最长检索词，返回 (结束位置, 地点下标列表)；匹配不上时列表为空
+        逐字收窄以当前前缀开头的检索词区间，区间为空即可停止
+        """
+        lo, hi = 0, self._key_count
+        best_end, best = start, []
+        for end in range(start + 1, min(len(compact), start + self._max_key_length) + 1):
+            lo, hi = self._prefix_range(compact[start:end], lo, hi)
+            if lo >= hi:
+                break
+            if end - start < 2 or (compact[end - 1].isascii() and end not in bounds):
+                continue
+            encoded = compact[start:end].encode('utf-8')
+            matches = []
+            for position in range(lo, hi):
+                key, index = self._key(position)
+                if key != encoded:
+                    break
+                matches.append(index)
+            if matches:
+                best_end, best = end, matches
+        return best_end, best
+
+    def _segments(self, compact, bounds):
+        """从头按最长检索词逐段匹配，返回 (各段的地点下标列表, 已匹配到的位置)"""
+        segments, position = [], 0
+        while position < len(compact):
+            end, matches = self._longest_key(compact, position, bounds)
+            if not matches:
+                break
+            segments.append(matches)
+            position = end
+        return segments, position
+
+    def _best(self, segments, partial=True):
+        """
+        与各段都一致（该段中有它自己或它的上级）的地点中权重最高的一个；
+        partial 为真时，没有这样的地点则依次丢掉最后一段（“北京朝阳”中的“朝阳”不会把结果带到辽宁），
+        否则返回 None
+        """
+        for count in range(len(segments), 0 if partial else len(segments) - 1, -1):
+            candidates = []
+            for index in {index for segment in segments[:count] for index in segment}:
+                lineage = {place.index for place in self.lineage(self.place(index))}
+                if all(lineage.intersection(segment) for segment in segments[:count]):
+                    candidates.append(self.place(index))
+            if candidates:
+                return min(candidates, key=lambda p: (-p.weight, p.index))
+        return None
+
+    def _fuzzy(self, compact):
+        """
+        模糊匹配：与查询首字相同、编辑距离最小的检索词，中文至少 3 个字、拼音至少 5 个字母才尝试；
+        最小距离上有多个权重相同的地点时视为无法确定
+        """
+        ascii_query = compact.isascii()
+        if len(compact) < (5 if ascii_query else 3):
+            return None
+        limit = 2 if ascii_query and len(compact) >= 9 else 1
+        lo, hi = self._prefix_range(compact[0])
+        best = {}
+        for position in range(lo, min(hi, lo + MAX_SCAN)):
+            key, index = self._key(position)
+            key = key.decode('utf-8')
+            if abs(len(key) - len(compact)) > limit:
+                continue
+            distance = _edit_distance(compact, key, limit)
+            if distance <= limit and distance < best.get(index, limit + 1):
+                best[index] = distance
+        if not best:
+            return None
+        ranked = sorted((distance, -self.place(index).weight, index) for index, distance in best.items())
+        if len(ranked) > 1 and ranked[0][:2] == ranked[1][:2]:
+            return None
+        return self.place(ranked[0][2])
+
+    def _complete(self, prefix):
+        """
+        以 prefix 开头的检索词对应的地点，返回 (地点列表, 检索词与 prefix 完全相同的地点数)
+        完全相同的排在前面，其余按权重从高到低
+        """
+        lo, hi = self._prefix_range(prefix)
+        encoded = prefix.encode('utf-8')
+        ranked = {}
+        for position in range(lo, min(hi, lo + MAX_SCAN)):
+            key, index = self._key(position)
+            rank = (key != encoded, -self.place(index).weight, len(key), index)
+            if rank < ranked.get(index, (True, 0, sys.maxsize, index)):
+                ranked[index] = rank
+        order = sorted(ranked, key=ranked.get)
+        return [self.place(index) for index in order], sum(not ranked[index][0] for index in order)
+
+    # ------------------------------------------------------------------
+    # 对外接口
+    # ------------------------------------------------------------------
+
+    def resolve(self, text):
+        """
+        把地名规范化为地名表中的地点：整段输入必须由简称、全称、拼音或别名组成且指向同一地点，
+        否则返回 None（不做部分匹配和模糊匹配，避免把表外的地点换成别的城市）
+        """
+        self._load()
+        compact, bounds = _query(text)
+        if not compact:
+            return None
+        segments, position = self._segments(compact, bounds)
+        if not segments or position < len(compact):
+            return None
+        return self._best(segments, partial=False)
+
+    def suggest(self, text, limit=GAZETTEER_SUGGEST_LIMIT):
+        """
+        输入联想，返回至多 limit 个地点
+        - 输入是某些检索词的前缀：返回这些地点，完全匹配的地点之后附上它的下级（“江苏” -> 江苏、南京、苏州…）
+        - 否则按前面能识别的部分限定范围，用剩下的部分联想下级（“江苏苏” -> 苏州）
+        - 都不行时返回模糊匹配的结果
+        """
+        self._load()
+        compact, bounds = _query(text)
+        if not compact or limit <= 0:
+            return []
+
+        places, exact = self._complete(compact)
+        if places:
+            if exact:
+                places = places[:exact] + self.children(places[0]) + places[exact:]
+            return _unique(places)[:limit]
+
+        segments, position = self._segments(compact, bounds)
+        scope = self._best(segments) if segments else None
+        if scope is None:
+            place = self._fuzzy(compact)
+            return [place] if place is not None else []
+        places = []
+        if position < len(compact):
+            places = [place for place in self._complete(compact[position:])[0]
+                      if scope.index in {p.index for p in self.lineage(place)[1:]}]
+        return (places or [scope])[:limit]
+
+    def label(self, place):
+        """联想列表中显示的名字，带上级地名，如“苏州，江苏”；不显示“中国”"""
+        names = [p.name for p in self.lineage(place) if p.id != 'cn']
+        return '，'.join(names) if names else place.name
+
+
+def _unique(places):
+    """按下标去重，保持顺序"""
+    seen = set()
+    return [place for place in places if not (place.index in seen or seen.add(place.index))]
+
+
+# 全局地名索引
+gazetteer = Gazetteer()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SoulMate 地名索引')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='把地名表编译为索引文件')
+    build.add_argument('--source', default=GAZETTEER_SOURCE, help='地名表路径')
+    build.add_argument('--output', default=GAZETTEER_INDEX, help='索引文件路径')
+    for name, help_text in (('lookup', '规范化地名'), ('suggest', '输入联想')):
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument('texts', nargs='+', help='地名')
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        rows, _ = read_source(args.source)
+        size = write_index(args.source, args.output)
+        print(f"已写入 {args.output}：{len(rows)} 个地点，{size} 字节")
+    elif args.command == 'lookup':
+        for text in args.texts:
+            place = gazetteer.resolve(text)
+            print(f"{text}\t{place.id}\t{place.name}" if place else f"{text}\t-")
+    else:
+        for text in args.texts:
+            print(text, ' | '.join(f"{place.id} {gazetteer.label(place)}" for place in gazetteer.suggest(text)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
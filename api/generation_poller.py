@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+异步图像生成轮询器
+通过 ImageSynthesis.async_call 提交上游任务后立即返回，由一个后台轮询线程集中查询所有未完成的上游任务，
+查询间隔随任务等待时间自适应增长，少量线程即可承载大量并发生成。
+上游任务提交失败、执行失败或超时时 Future 以 UpstreamError 结束，由任务队列标记失败，不会当作成功。
+"""
+import os
+import time
+import heapq
+import logging
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .image_generator import ImageGenerator, UpstreamError
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 轮询配置
+MAX_INFLIGHT = int(os.environ.get('GENERATION_MAX_INFLIGHT', '50'))  # 同时进行中的上游任务上限
+FETCH_WORKERS = int(os.environ.get('GENERATION_FETCH_WORKERS', '4'))  # 并发查询/下载线程数
+FIRST_POLL_DELAY = float(os.environ.get('GENERATION_FIRST_POLL', '2'))  # 提交后首次查询的等待时间（秒）
+MAX_POLL_INTERVAL = float(os.environ.get('GENERATION_MAX_POLL_INTERVAL', '10'))  # 查询间隔上限（秒）
+POLL_BACKOFF = 1.5  # 每次未完成后查询间隔的增长倍数
+UPSTREAM_TIMEOUT = float(os.environ.get('GENERATION_UPSTREAM_TIMEOUT', '300'))  # 上游任务最长等待时间（秒）
+
+
+class GenerationPoller:
+    def __init__(self, max_inflight=MAX_INFLIGHT, fetch_workers=FETCH_WORKERS):
+        self._slots = threading.BoundedSemaphore(max(1, max_inflight))
+        self._executor = ThreadPoolExecutor(max_workers=max(1, fetch_workers), thread_name_prefix='generation-fetch')
+        # 按下次查询时间排序的小顶堆: (下次查询时间, 序号, 上游任务ID)
+        self._schedule = []
+        # 上游任务ID -> {'future', 'submitted_at', 'interval'}
+        self._pending = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """启动轮询线程"""
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='generation-poller')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def submit(self, prompt):
+        """
+        提交上游生成任务，进行中的任务达到上限时阻塞等待
+        :return: Future，完成时结果为图像文件名；上游任务失败或超时时为 UpstreamError
+        """
+        future = Future()
+        self._slots.acquire()
+        upstream_id = ImageGenerator.generate_async_image(prompt)
+        if not upstream_id:
+            self._slots.release()
+            future.set_exception(UpstreamError('提交上游生成任务失败'))
+            return future
+
+        now = time.monotonic()
+        with self._cond:
+            self._pending[upstream_id] = {
+                'future': future,
+                'submitted_at': now,
+                'interval': FIRST_POLL_DELAY,
+            }
+            heapq.heappush(self._schedule, (now + FIRST_POLL_DELAY, next(self._counter), upstream_id))
+            self._cond.notify()
+        return future
+
+    def pending(self):
+        """进行中的上游任务数"""
+        with self._cond:
+            return len(self._pending)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._schedule or self._schedule[0][0] > time.monotonic():
+                    timeout = self._schedule[0][0] - time.monotonic() if self._schedule else None
+                    self._cond.wait(timeout)
+                # 一次取出所有已到查询时间的任务，批量分发给查询线程
+                due = []
+                now = time.monotonic()
+                while self._schedule and self._schedule[0][0] <= now:
+                    due.append(heapq.heappop(self._schedule)[2])
+
+            for upstream_id in due:
+                self._executor.submit(self._poll, upstream_id)
+
+    def _poll(self, upstream_id):
+        """查询单个上游任务，完成则结束，未完成则按退避间隔重新排期"""
+        with self._cond:
+            entry = self._pending.get(upstream_id)
+        if entry is None:
+            return
+
+        try:
+            file_name = ImageGenerator.fetch_image(upstream_id)
+        except UpstreamError as e:
+            self._finish(upstream_id, entry, error=e)
+            return
+        except Exception as e:
+            logger.error(f"查询上游任务 {upstream_id} 失败: {str(e)}")
+            file_name = None
+
+        now = time.monotonic()
+        if file_name is None and now - entry['submitted_at'] < UPSTREAM_TIMEOUT:
+            with self._cond:
+                entry['interval'] = min(entry['interval'] * POLL_BACKOFF, MAX_POLL_INTERVAL)
+                heapq.heappush(self._schedule, (now + entry['interval'], next(self._counter), upstream_id))
+                self._cond.notify()
+            return
+
+        if file_name is None:
+            logger.error(f"上游任务 {upstream_id} 超时未完成")
+            self._finish(upstream_id, entry, error=UpstreamError(f'上游任务超时未完成（{UPSTREAM_TIMEOUT:.0f}s）'))
+            return
+        self._finish(upstream_id, entry, file_name)
+
+    def _finish(self, upstream_id, entry, file_name=None, error=None):
+        """结束上游任务：释放名额，以图像文件名或错误完成 Future"""
+        with self._cond:
+            self._pending.pop(upstream_id, None)
+        self._slots.release()
+        if error is not None:
+            entry['future'].set_exception(error)
+        else:
+            entry['future'].set_result(file_name)
@@ -1,14 +1,16 @@
 from http import HTTPStatus
 from urllib.parse import urlparse, unquote
 from pathlib import PurePosixPath
-import requests
-from dashscope import ImageSynthesis
 import os
 import time
 import logging
 import random
 import uuid
-import dashscope
+import threading
+
+from .downloader import download_temp, DownloadError
+from .image_store import image_store, OUTPUT_DIR, ImageStoreError, normalize_extension
+from .metrics import UPSTREAM_SECONDS, UPSTREAM_RESPONSES
 
 # 配置API密钥
 # 优先从环境变量读取
@@ -16,11 +18,10 @@ api_key = os.environ.get('DASHSCOPE_API_KEY')
 # 模拟模式开关 - 当没有API密钥时自动启用
 use_mock = os.environ.get('USE_MOCK', str(not api_key)).lower() == 'true'
 
-if api_key and not use_mock:
-    dashscope.api_key = api_key
-elif use_mock:
+# 密钥在首次调用上游时设置，见 image_synthesis()
+if use_mock:
     logging.info('启用模拟模式，将生成模拟图像')
-else:
+elif not api_key:
     logging.warning('未设置DASHSCOPE_API_KEY，图像生成功能将无法使用')
 
 # 配置日志
@@ -30,7 +31,6 @@ logger = logging.getLogger(__name__)
 # 图像生成配置
 MODEL = "flux-schnell"
 IMAGE_SIZE = "1024*1024"
-OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "generated_images")
 
 # 模拟数据 - 预定义一些图像路径
 MOCK_IMAGES = [
@@ -38,27 +38,113 @@ MOCK_IMAGES = [
     # 可以添加更多预定义的图像路径
 ]
 
-# 确保输出目录存在
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
-# 如果启用模拟模式，确保至少有一个默认图像
-if use_mock and not os.path.exists(os.path.join(OUTPUT_DIR, "default_image.svg")):
-    # 复制public目录下的default_image.svg到generated_images目录
-    public_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "default_image.svg")
-    if os.path.exists(public_default):
-        import shutil
-        shutil.copy(public_default, os.path.join(OUTPUT_DIR, "default_image.svg"))
-    else:
-        # 如果public目录下也没有，则创建一个简单的SVG
-        svg_content = '''<?xml version="1.0" encoding="UTF-8"?>
+_output_dir_ready = False
+_output_dir_lock = threading.Lock()
+
+
+def ensure_output_dir():
+    """首次写入图像时才创建输出目录并准备默认图像，导入阶段不访问文件系统"""
+    global _output_dir_ready
+    if _output_dir_ready:
+        return
+    with _output_dir_lock:
+        if _output_dir_ready:
+            return
+        _prepare_output_dir()
+        _output_dir_ready = True
+
+
+def _prepare_output_dir():
+    # 确保输出目录存在
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+    # 如果启用模拟模式，确保至少有一个默认图像
+    if use_mock and not os.path.exists(os.path.join(OUTPUT_DIR, "default_image.svg")):
+        # 复制public目录下的default_image.svg到generated_images目录
+        public_default = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "default_image.svg")
+        if os.path.exists(public_default):
+            import shutil
+            shutil.copy(public_default, os.path.join(OUTPUT_DIR, "default_image.svg"))
+        else:
+            # 如果public目录下也没有，则创建一个简单的SVG
+            svg_content = '''<?xml version="1.0" encoding="UTF-8"?>
 <svg width="1024" height="1024" viewBox="0 0 1024 1024" xmlns="http://www.w3.org/2000/svg">
   <rect width="1024" height="1024" fill="#f8f8f8"/>
   <text x="512" y="512" font-family="Arial" font-size="48" text-anchor="middle" fill="#333">模拟图像</text>
 </svg>'''
-        with open(os.path.join(OUTPUT_DIR, "default_image.svg"), "w") as f:
-            f.write(svg_content)
+            with open(os.path.join(OUTPUT_DIR, "default_image.svg"), "w") as f:
+                f.write(svg_content)
+
+
+def image_synthesis():
+    """
+    首次调用上游时才导入 dashscope（其依赖的 aiohttp 等模块约占冷启动导入耗时的一半）
+    :return: dashscope.ImageSynthesis
+    """
+    import dashscope
+    from dashscope import ImageSynthesis
+    if api_key and dashscope.api_key != api_key:
+        dashscope.api_key = api_key
+    return ImageSynthesis
+
+# 模拟模式下的异步任务: 任务ID -> (提示词, 完成时间)
+MOCK_TASKS = {}
+MOCK_LATENCY = 1  # 模拟生成延迟（秒）
+
+
+class UpstreamError(Exception):
+    """上游生成任务已失败（提交失败、任务失败或超时、图像下载失败），不会再产出图像"""
+
 
 class ImageGenerator:
+    @staticmethod
+    def _mock_image(prompt):
+        """模拟模式下生成图像，返回文件名"""
+        ensure_output_dir()
+        # 随机选择一个模拟图像或生成新的模拟图像
+        if random.random() < 0.7 and MOCK_IMAGES:
+            # 70%概率返回已有模拟图像
+            file_name = random.choice(MOCK_IMAGES)
+        else:
+            # 30%概率生成新的模拟图像，按内容保存到图像存储
+            svg_content = f'''<?xml version="1.0" encoding="UTF-8"?>
+<svg width="1024" height="1024" viewBox="0 0 1024 1024" xmlns="http://www.w3.org/2000/svg">
+  <rect width="1024" height="1024" fill="#f0f0f0"/>
+  <text x="512" y="512" font-family="Arial" font-size="36" text-anchor="middle" fill="#333">模拟生成图像</text>
+  <text x="512" y="560" font-family="Arial" font-size="24" text-anchor="middle" fill="#666">提示词: {prompt[:30]}{'...' if len(prompt) > 30 else ''}</text>
+</svg>'''
+            file_name = image_store.put_bytes(svg_content.encode('utf-8'), '.svg')
+            # 添加到模拟图像列表
+            if file_name not in MOCK_IMAGES:
+                MOCK_IMAGES.append(file_name)
+        logger.info(f"模拟图像生成成功: {file_name}")
+        return file_name
+
+    @staticmethod
+    def _call_upstream(operation, fn, *args, **kwargs):
+        """调用 ImageSynthesis 接口并记录耗时和响应码"""
+        started = time.perf_counter()
+        try:
+            rsp = fn(*args, **kwargs)
+        except Exception:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - started, operation)
+            UPSTREAM_RESPONSES.inc(operation, 'exception')
+            raise
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, operation)
+        code = rsp.status_code if rsp.status_code == HTTPStatus.OK else (rsp.code or rsp.status_code)
+        UPSTREAM_RESPONSES.inc(operation, code)
+        return rsp
+
+    @staticmethod
+    def _save_result(url):
+        """把上游返回的图像流式下载并按内容哈希保存到图像存储，返回图像的键（如 ab/cd/abcd…ef.png）"""
+        extension = normalize_extension(PurePosixPath(unquote(urlparse(url).path)).suffix)
+        ensure_output_dir()
+        tmp_path, digest, _ = download_temp(url, image_store.staging_dir)
+        file_name = image_store.put_file(tmp_path, digest, extension)
+        logger.info(f"图像已保存: {file_name}")
+        return file_name
+
     @staticmethod
     def generate_image(prompt):
         """
@@ -74,31 +160,12 @@ class ImageGenerator:
                 logger.info("使用模拟模式生成图像")
                 # 模拟生成延迟
                 time.sleep(1)
-                # 随机选择一个模拟图像或生成新的模拟图像
-                if random.random() < 0.7 and MOCK_IMAGES:
-                    # 70%概率返回已有模拟图像
-                    file_name = random.choice(MOCK_IMAGES)
-                else:
-                    # 30%概率生成新的模拟图像文件名
-                    file_name = f"mock_image_{uuid.uuid4().hex[:8]}.svg"
-                    # 创建一个简单的SVG文件
-                    svg_content = f'''<?xml version="1.0" encoding="UTF-8"?>
-<svg width="1024" height="1024" viewBox="0 0 1024 1024" xmlns="http://www.w3.org/2000/svg">
-  <rect width="1024" height="1024" fill="#f0f0f0"/>
-  <text x="512" y="512" font-family="Arial" font-size="36" text-anchor="middle" fill="#333">模拟生成图像</text>
-  <text x="512" y="560" font-family="Arial" font-size="24" text-anchor="middle" fill="#666">提示词: {prompt[:30]}{'...' if len(prompt) > 30 else ''}</text>
-</svg>'''
-                    with open(os.path.join(OUTPUT_DIR, file_name), "w") as f:
-                        f.write(svg_content)
-                    # 添加到模拟图像列表
-                    MOCK_IMAGES.append(file_name)
-                logger.info(f"模拟图像生成成功: {file_name}")
-                return file_name
+                return ImageGenerator._mock_image(prompt)
             else:
                 # 真实API调用
-                from dashscope import ImageSynthesis
-                import dashscope
-                rsp = ImageSynthesis.call(
+                rsp = ImageGenerator._call_upstream(
+                    'call',
+                    image_synthesis().call,
                     model=MODEL,
                     prompt=prompt,
                     size=IMAGE_SIZE
@@ -110,12 +177,7 @@ class ImageGenerator:
 
                     # 保存图像到本地
                     for result in rsp.output.results:
-                        file_name = PurePosixPath(unquote(urlparse(result.url).path)).parts[-1]
-                        file_path = os.path.join(OUTPUT_DIR, file_name)
-                        with open(file_path, 'wb+') as f:
-                            f.write(requests.get(result.url).content)
-                        logger.info(f"图像已保存到: {file_path}")
-                        return file_name  # 返回文件名，供前端使用
+                        return ImageGenerator._save_result(result.url)  # 返回文件名，供前端使用
                 else:
                     logger.error(f"图像生成失败, status_code: {rsp.status_code}, code: {rsp.code}, message: {rsp.message}")
                     return "default_image.svg"
@@ -128,10 +190,18 @@ class ImageGenerator:
         """
         异步生成图像
         :param prompt: 图像生成提示词
-        :return: 任务ID
+        :return: 任务ID，如果提交失败则返回None
         """
         try:
-            rsp = ImageSynthesis.async_call(
+            if use_mock:
+                task_id = f"mock-{uuid.uuid4().hex}"
+                MOCK_TASKS[task_id] = (prompt, time.time() + MOCK_LATENCY)
+                logger.info(f"模拟异步图像生成任务已提交: {task_id}")
+                return task_id
+
+            rsp = ImageGenerator._call_upstream(
+                'async_call',
+                image_synthesis().async_call,
                 model=MODEL,
                 prompt=prompt,
                 size=IMAGE_SIZE
@@ -142,37 +212,51 @@ class ImageGenerator:
                 return rsp.output.task_id
             else:
                 logger.error(f"异步图像生成任务提交失败: {rsp.status_code}, {rsp.code}, {rsp.message}")
-                return "default_image.svg"
+                return None
         except Exception as e:
             logger.error(f"异步图像生成任务提交过程中发生错误: {str(e)}")
-            return "default_image.svg"
+            return None
 
     @staticmethod
     def fetch_image(task_id):
         """
         获取异步生成的图像
         :param task_id: 任务ID
-        :return: 图像路径，如果失败则返回None
+        :return: 图像文件名；任务尚未完成或查询失败时返回None
+        :raises UpstreamError: 上游任务失败或图像下载失败
         """
         try:
-            status = ImageSynthesis.fetch(task_id)
+            if task_id in MOCK_TASKS:
+                prompt, ready_at = MOCK_TASKS[task_id]
+                if time.time() < ready_at:
+                    return None
+                del MOCK_TASKS[task_id]
+                return ImageGenerator._mock_image(prompt)
+
+            status = ImageGenerator._call_upstream('fetch', image_synthesis().fetch, task_id)
             if status.status_code == HTTPStatus.OK:
                 if status.output.task_status == "SUCCEEDED":
                     for result in status.output.results:
-                        file_name = PurePosixPath(unquote(urlparse(result.url).path)).parts[-1]
-                        file_path = os.path.join(OUTPUT_DIR, file_name)
-                        with open(file_path, 'wb+') as f:
-                            f.write(requests.get(result.url).content)
-                        return file_name
+                        try:
+                            return ImageGenerator._save_result(result.url)
+                        except (DownloadError, ImageStoreError) as e:
+                            logger.error(f"下载生成图像失败: {task_id}, {str(e)}")
+                            raise UpstreamError(f'下载生成图像失败: {str(e)}')
+                elif status.output.task_status in ("FAILED", "CANCELED", "UNKNOWN"):
+                    logger.error(f"图像生成任务失败: {task_id}, {status.output.task_status}")
+                    raise UpstreamError(f'图像生成任务失败: {status.output.task_status}')
                 else:
                     logger.info(f"图像生成任务尚未完成: {status.output.task_status}")
                     return None
             else:
+                # 查询失败（如限流）不代表任务失败，返回None由调用方稍后重试
                 logger.error(f"获取图像生成任务状态失败: {status.status_code}, {status.code}, {status.message}")
-                return "default_image.svg"
+                return None
+        except UpstreamError:
+            raise
         except Exception as e:
             logger.error(f"获取图像生成任务状态过程中发生错误: {str(e)}")
-            return "default_image.svg"
+            return None
 
 # 测试代码
 if __name__ == '__main__':
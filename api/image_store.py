@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""
+生成图像存储
+图像按内容的 SHA-256 命名，并按哈希前缀分到多级子目录：ab/cd/abcd…ef.png。
+- 相同字节的图像只存一份，重复写入直接复用已有文件
+- 单个目录下的文件数有上限（两级 256×256 个目录），文件数到百万级时查找和列目录仍然很快
+- 内容变化时名字一定变化，文件可以由浏览器和 CDN 永久缓存（Cache-Control: immutable），ETag 即文件名
+
+后端：
+- local（默认）：保存在 GENERATED_IMAGES_DIR 下，由 /generated_images/<key> 提供下载
+- s3：保存在 S3 兼容的对象存储（AWS S3、MinIO 等），需要 pip install boto3；
+  设置 IMAGE_STORE_PUBLIC_URL 后图像地址直接指向存储桶或 CDN，否则仍由 /generated_images/<key> 转发
+
+改造前的图像（default_image.svg、按上游文件名保存的旧文件）没有分片目录，始终从本地目录读取。
+"""
+import os
+import re
+import shutil
+import hashlib
+import logging
+import mimetypes
+import tempfile
+import threading
+
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 存储配置
+OUTPUT_DIR = os.environ.get('GENERATED_IMAGES_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "public", "generated_images")  # 生成图像保存目录
+IMAGE_STORE_BACKEND = os.environ.get('IMAGE_STORE_BACKEND', 'local').lower()  # local 或 s3
+IMAGE_STORE_SHARD_LEVELS = int(os.environ.get('IMAGE_STORE_SHARD_LEVELS', '2'))  # 分片目录层数，每层取哈希的两个十六进制字符
+IMAGE_STORE_PUBLIC_URL = os.environ.get('IMAGE_STORE_PUBLIC_URL', '')  # 按内容命名的图像的地址前缀（CDN 或存储桶，对应对象键前缀）；为空时使用 /generated_images/
+IMAGE_STORE_S3_BUCKET = os.environ.get('IMAGE_STORE_S3_BUCKET', '')  # s3 后端的存储桶
+IMAGE_STORE_S3_PREFIX = os.environ.get('IMAGE_STORE_S3_PREFIX', 'generated_images/')  # 对象键前缀
+IMAGE_STORE_S3_ENDPOINT = os.environ.get('IMAGE_STORE_S3_ENDPOINT', '')  # S3 兼容服务的地址，如 MinIO；为空时使用 AWS
+IMAGE_STORE_S3_REGION = os.environ.get('IMAGE_STORE_S3_REGION', os.environ.get('AWS_REGION', ''))  # 存储桶所在区域
+IMAGE_STORE_S3_POOL_SIZE = int(os.environ.get('IMAGE_STORE_S3_POOL_SIZE', '16'))  # 与对象存储保持的连接数
+
+LOCAL_URL_PREFIX = '/generated_images/'
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # 按内容命名的图像
+LEGACY_CACHE_CONTROL = 'public, max-age=86400'  # 旧文件名不随内容变化，只缓存一天
+CHUNK_SIZE = 64 * 1024
+
+# 按内容命名的键：若干级两位十六进制目录 + 64 位哈希 + 扩展名；
+# 同一原图派生的文件（如 abcd…ef.thumb.webp）与原图在同一目录，同样不可变
+_CONTENT_KEY = re.compile(r'(?:[0-9a-f]{2}/)+([0-9a-f]{64})((?:\.[a-z0-9_-]{1,16}){1,3})\Z')
+# 旧文件：单层文件名
+_LEGACY_KEY = re.compile(r'[A-Za-z0-9_][A-Za-z0-9_.-]{0,200}\Z')
+_EXTENSION = re.compile(r'\.[a-z0-9]{1,8}\Z')
+
+IMAGE_STORE_WRITES = REGISTRY.counter(
+    'soulmate_image_store_writes_total', '图像存储写入数，result=stored/deduplicated', ('backend', 'result'))
+
+
+class ImageStoreError(Exception):
+    """存储后端读写失败"""
+
+
+def is_content_key(key):
+    """是否为按内容命名的键（可以永久缓存）"""
+    return bool(key) and _CONTENT_KEY.match(key) is not None
+
+
+def is_valid_key(key):
+    """键只能是按内容命名的分片路径或单层旧文件名，拒绝 .. 等路径穿越"""
+    return bool(key) and (_CONTENT_KEY.match(key) is not None or _LEGACY_KEY.match(key) is not None) \
+        and '..' not in key
+
+
+def normalize_extension(extension, default='.png'):
+    extension = (extension or '').lower()
+    if not extension.startswith('.'):
+        extension = '.' + extension
+    return extension if _EXTENSION.match(extension) else default
+
+
+# 旧版本 Python 的 mimetypes 不认识这两种格式
+mimetypes.add_type('image/webp', '.webp')
+mimetypes.add_type('image/avif', '.avif')
+
+
+def content_type(key):
+    return mimetypes.guess_type(key)[0] or 'application/octet-stream'
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LocalImageStore:
+    """本地目录，临时文件与目标在同一文件系统，写入用原子重命名完成"""
+    name = 'local'
+
+    def __init__(self, root=OUTPUT_DIR):
+        self.root = root
+
+    @property
+    def staging_dir(self):
+        """下载时临时文件所在目录"""
+        os.makedirs(self.root, exist_ok=True)
+        return self.root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def local_path(self, key):
+        return self._path(key)
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def put_file(self, tmp_path, key):
+        """
+        把临时文件移动到 key，key 已存在时删除临时文件
+        :return: True 表示新写入，False 表示内容已存在
+        """
+        path = self._path(key)
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def save_file(self, key, src_path):
+        """保存派生文件（变体、清单），覆盖已有文件"""
+        path = self._path(key)
+        if os.path.abspath(src_path) != os.path.abspath(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.move(src_path, path)
+
+    def read_bytes(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def fetch(self, key, dest_path):
+        shutil.copyfile(self._path(key), dest_path)
+
+    def open(self, key):
+        """:return: (文件对象, 字节数)，不存在时返回 None"""
+        try:
+            f = open(self._path(key), 'rb')
+        except FileNotFoundError:
+            return None
+        return f, os.fstat(f.fileno()).st_size
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key):
+        return f'{IMAGE_STORE_PUBLIC_URL or LOCAL_URL_PREFIX}{key}'
+
+
+class S3ImageStore:
+    """
+    S3 兼容的对象存储
+    client 可以是任何兼容 boto3 S3 客户端的对象，默认按配置创建；对象上传时带上 Content-Type 和 immutable 缓存头
+    """
+    name = 's3'
+
+    def __init__(self, bucket=IMAGE_STORE_S3_BUCKET, prefix=IMAGE_STORE_S3_PREFIX, endpoint_url=IMAGE_STORE_S3_ENDPOINT,
+                 region=IMAGE_STORE_S3_REGION, public_url=IMAGE_STORE_PUBLIC_URL, client=None):
+        if not bucket:
+            raise ValueError('s3 图像存储需要设置 IMAGE_STORE_S3_BUCKET')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint_url = endpoint_url or None
+        self.region = region or None
+        self.public_url = public_url
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    # boto3 导入较慢，首次读写时才导入
+                    import boto3
+                    from botocore.config import Config
+                    config = Config(retries={'max_attempts': 3, 'mode': 'standard'},
+                                    max_pool_connections=IMAGE_STORE_S3_POOL_SIZE)
+                    self._client = boto3.client('s3', endpoint_url=self.endpoint_url,
+                                                region_name=self.region, config=config)
+        return self._client
+
+    @property
+    def staging_dir(self):
+        return tempfile.gettempdir()
+
+    def _object(self, key):
+        return f'{self.prefix}{key}'
+
+    @staticmethod
+    def _missing(error):
+        return error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound')
+
+    def local_path(self, key):
+        return None
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._object(key))
+            return True
+        except ClientError as e:
+            if self._missing(e):
+                return False
+            raise
+
+    def _upload(self, key, path):
+        self.client.upload_file(path, self.bucket, self._object(key), ExtraArgs={
+            'ContentType': content_type(key),
+            'CacheControl': IMMUTABLE_CACHE_CONTROL,
+        })
+
+    def put_file(self, tmp_path, key):
+        try:
+            if self.exists(key):
+                return False
+            self._upload(key, tmp_path)
+            return True
+        finally:
+            os.remove(tmp_path)
+
+    def save_file(self, key, src_path):
+        try:
+            self._upload(key, src_path)
+        finally:
+            os.remove(src_path)
+
+    def read_bytes(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._object(key))['Body'].read()
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+
+    def fetch(self, key, dest_path):
+        self.client.download_file(self.bucket, self._object(key), dest_path)
+
+    def open(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=self._object(key))
+        except ClientError as e:
+            if self._missing(e):
+                return None
+            raise
+        return obj['Body'], obj['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._object(key))
+
+    def url(self, key):
+        # public_url 对应对象键前缀所在的位置，如 https://cdn.example.com/generated_images/
+        return f'{self.public_url or LOCAL_URL_PREFIX}{key}'
+
+
+class ImageStore:
+    """
+    按键路由到具体后端：按内容命名的键交给配置的后端，旧文件名始终在本地目录中
+    """
+
+    def __init__(self, backend, local=None, shard_levels=IMAGE_STORE_SHARD_LEVELS):
+        self.backend = backend
+        self.local = local or (backend if isinstance(backend, LocalImageStore) else LocalImageStore())
+        self.shard_levels = max(1, shard_levels)
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    @property
+    def staging_dir(self):
+        return self.backend.staging_dir
+
+    def _route(self, key):
+        return self.backend if is_content_key(key) else self.local
+
+    def key_for(self, digest, extension):
+        """内容哈希对应的键：ab/cd/abcd…ef.png"""
+        shards = [digest[i * 2:i * 2 + 2] for i in range(self.shard_levels)]
+        return '/'.join(shards + [digest + normalize_extension(extension)])
+
+    def put_file(self, tmp_path, digest=None, extension='.png'):
+        """
+        保存临时文件（调用后临时文件不再存在）
+        :param digest: 文件内容的 SHA-256，下载时边写边算可以省去再读一遍
+        :return: 图像的键
+        """
+        try:
+            key = self.key_for(digest or hash_file(tmp_path), extension)
+            stored = self.backend.put_file(tmp_path, key)
+        except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise ImageStoreError(f'保存图像失败: {str(e)}') from e
+        IMAGE_STORE_WRITES.inc(self.name, 'stored' if stored else 'deduplicated')
+        if not stored:
+            logger.info(f"图像内容已存在，复用: {key}")
+        return key
+
+    def put_bytes(self, data, extension='.png'):
+        """保存内存中的图像，返回键"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.staging_dir, prefix='.upload-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self.put_file(tmp_path, hashlib.sha256(data).hexdigest(), extension)
+
+    def save_file(self, key, src_path):
+        """保存由 key 对应原图派生的文件（变体、清单），键由调用方决定"""
+        self._route(key).save_file(key, src_path)
+
+    def save_bytes(self, key, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self._route(key).staging_dir, prefix='.upload-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        self.save_file(key, tmp_path)
+
+    def local_path(self, key):
+        """键在本地磁盘上的路径；对象存储中的键返回 None"""
+        return self._route(key).local_path(key)
+
+    def exists(self, key):
+        return self._route(key).exists(key)
+
+    def read_bytes(self, key):
+        return self._route(key).read_bytes(key)
+
+    def fetch(self, key, dest_path):
+        self._route(key).fetch(key, dest_path)
+
+    def open(self, key):
+        return self._route(key).open(key)
+
+    def delete(self, key):
+        self._route(key).delete(key)
+
+    def url(self, key):
+        # 旧文件只在本地目录中，不经过 CDN 或存储桶地址
+        return self.backend.url(key) if is_content_key(key) else f'{LOCAL_URL_PREFIX}{key}'
+
+    @staticmethod
+    def etag(key):
+        """按内容命名的键以文件名为 ETag；旧文件返回 None，由文件的修改时间和大小生成"""
+        return key.rsplit('/', 1)[-1] if is_content_key(key) else None
+
+    @staticmethod
+    def cache_control(key):
+        return IMMUTABLE_CACHE_CONTROL if is_content_key(key) else LEGACY_CACHE_CONTROL
+
+
+def create_image_store(backend=IMAGE_STORE_BACKEND):
+    """按配置创建图像存储"""
+    if backend == 's3':
+        logger.info(f"生成图像保存到对象存储: {IMAGE_STORE_S3_BUCKET}")
+        return ImageStore(S3ImageStore())
+    if backend != 'local':
+        raise ValueError(f'不支持的图像存储后端: {backend}')
+    return ImageStore(LocalImageStore())
+
+
+# 进程内共享的图像存储
+image_store = create_image_store()
@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+"""
+生成图像的多尺寸变体
+上游返回的原图为 1024×1024 的 PNG，手机端结果页只显示约 320px 宽。
+图像保存到 OUTPUT_DIR 后，在进程池中一次解码原图，依次缩放出 thumb / preview / full 三档，
+按 IMAGE_VARIANT_FORMATS 编码为 WebP（可选 AVIF、渐进式 JPEG），写入同一目录，
+结果中以 srcset 的形式返回，浏览器按屏幕宽度只下载其中一档。
+
+变体和原图保存在同一个图像存储中，原图 ab/cd/<哈希>.png 的变体为 ab/cd/<哈希>.thumb.webp、
+.preview.webp、.full.webp，全部写完后写入清单 ab/cd/<哈希>.variants.json，清单存在即表示这组变体完整可用。
+原图不在本地磁盘上时（s3 后端）先下载到临时目录，编码后再上传。
+SVG 等非位图（模拟模式、兜底图像）不生成变体。
+"""
+import os
+import json
+import time
+import shutil
+import logging
+import posixpath
+import tempfile
+import threading
+
+from .metrics import IMAGE_VARIANT_SECONDS, IMAGE_VARIANT_BYTES
+from .single_flight import SingleFlight
+from .image_store import image_store
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 变体配置
+IMAGE_VARIANTS = os.environ.get('IMAGE_VARIANTS', 'true').lower() == 'true'  # 是否生成变体
+IMAGE_VARIANT_FORMATS = os.environ.get('IMAGE_VARIANT_FORMATS', 'webp')  # 逗号分隔，可选 webp、avif、jpeg；第一个为默认格式
+IMAGE_VARIANT_WIDTHS = os.environ.get('IMAGE_VARIANT_WIDTHS', 'thumb:320,preview:640,full:1024')  # 档位名:宽度
+IMAGE_VARIANT_QUALITY = int(os.environ.get('IMAGE_VARIANT_QUALITY', '80'))  # 编码质量（1-100）
+IMAGE_VARIANT_WORKERS = int(os.environ.get('IMAGE_VARIANT_WORKERS', str(min(2, os.cpu_count() or 1))))  # 进程数，0 表示在调用线程内编码
+IMAGE_VARIANT_TIMEOUT = float(os.environ.get('IMAGE_VARIANT_TIMEOUT', '15'))  # 等待一组变体的最长时间（秒），超时则结果只含原图
+IMAGE_VARIANT_SIZES = os.environ.get('IMAGE_VARIANT_SIZES', '(max-width: 400px) 80vw, 320px')  # <img sizes>，与结果页的显示宽度一致
+
+MANIFEST_SUFFIX = '.variants.json'
+
+# 可以生成变体的原图扩展名
+RASTER_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.webp'}
+
+# 格式 -> (Pillow 格式名, 扩展名, MIME 类型)
+FORMATS = {
+    'avif': ('AVIF', 'avif', 'image/avif'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+}
+# <picture> 中 <source> 的先后顺序，浏览器取第一个支持的格式
+FORMAT_PREFERENCE = ('avif', 'webp', 'jpeg')
+
+
+def parse_widths(text):
+    """解析“档位名:宽度”列表，按宽度从大到小返回 ((档位名, 宽度), ...)"""
+    widths = []
+    for item in text.split(','):
+        name, _, width = item.strip().partition(':')
+        if name and width:
+            widths.append((name.strip(), int(width)))
+    return tuple(sorted(widths, key=lambda item: -item[1]))
+
+
+def _load_codecs(formats):
+    """导入 Pillow 并按需加载 AVIF 插件（Pillow 11.2 之前需要 pillow-avif-plugin）"""
+    from PIL import Image
+    if 'avif' in formats:
+        try:
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            pass
+    Image.init()
+    return Image
+
+
+def _save_options(fmt, quality):
+    if fmt == 'webp':
+        return {'quality': quality, 'method': 4}
+    if fmt == 'avif':
+        return {'quality': quality, 'speed': 8}
+    return {'quality': quality, 'optimize': True, 'progressive': True}
+
+
+def _render(source_path, output_dir, stem, widths, formats, quality):
+    """
+    在工作进程中执行：解码原图一次，从大到小逐档缩放并编码
+    每档从上一档缩小而不是从原图缩小，后面几档的缩放开销很小；原图比档位窄时不放大
+    :return: [{'name', 'format', 'file', 'width', 'height', 'bytes'}, ...]
+    """
+    Image = _load_codecs(formats)
+    with Image.open(source_path) as opened:
+        opened.load()
+        if opened.mode in ('RGB', 'RGBA'):
+            image = opened.copy()
+        else:
+            has_alpha = 'A' in opened.getbands() or 'transparency' in opened.info
+            image = opened.convert('RGBA' if has_alpha else 'RGB')
+
+    variants = []
+    for name, width in widths:
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))),
+                                 Image.LANCZOS, reducing_gap=3.0)
+        for fmt in formats:
+            pil_format, extension, _ = FORMATS[fmt]
+            frame = image.convert('RGB') if fmt == 'jpeg' and image.mode != 'RGB' else image
+            file_name = f'{stem}.{name}.{extension}'
+            path = os.path.join(output_dir, file_name)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            frame.save(tmp_path, pil_format, **_save_options(fmt, quality))
+            os.replace(tmp_path, path)
+            variants.append({
+                'name': name,
+                'format': fmt,
+                'file': file_name,
+                'width': image.width,
+                'height': image.height,
+                'bytes': os.path.getsize(path),
+            })
+    return variants
+
+
+def _warm_up(formats):
+    """预先在工作进程中导入 Pillow，首个任务不再承担导入耗时"""
+    _load_codecs(formats)
+    return os.getpid()
+
+
+def split_name(file_name):
+    stem, extension = os.path.splitext(file_name)
+    return stem, extension.lower()
+
+
+def is_raster(file_name):
+    return bool(file_name) and split_name(file_name)[1] in RASTER_EXTENSIONS
+
+
+class ImageVariants:
+    def __init__(self, store=image_store, formats=IMAGE_VARIANT_FORMATS, widths=IMAGE_VARIANT_WIDTHS,
+                 quality=IMAGE_VARIANT_QUALITY, workers=IMAGE_VARIANT_WORKERS, timeout=IMAGE_VARIANT_TIMEOUT,
+                 enabled=IMAGE_VARIANTS):
+        self.store = store
+        self.requested_formats = [fmt.strip().lower() for fmt in formats.split(',') if fmt.strip()]
+        self.widths = parse_widths(widths) if isinstance(widths, str) else tuple(sorted(widths, key=lambda item: -item[1]))
+        self.quality = quality
+        self.workers = workers
+        self.timeout = timeout
+        self.enabled = enabled
+        self.flight = SingleFlight()
+        self._formats = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def formats(self):
+        """配置中当前 Pillow 能够编码的格式；Pillow 不可用时为空，不生成变体"""
+        if self._formats is None:
+            with self._lock:
+                if self._formats is None:
+                    self._formats = self._detect_formats()
+        return self._formats
+
+    def _detect_formats(self):
+        unknown = [fmt for fmt in self.requested_formats if fmt not in FORMATS]
+        if unknown:
+            raise ValueError(f'不支持的变体格式: {",".join(unknown)}')
+        try:
+            Image = _load_codecs(self.requested_formats)
+        except ImportError:
+            logger.warning("未安装 Pillow，不生成图像变体")
+            return []
+        formats = []
+        for fmt in self.requested_formats:
+            if FORMATS[fmt][0] in Image.SAVE:
+                formats.append(fmt)
+            else:
+                logger.warning(f"当前 Pillow 不支持编码 {fmt}，跳过该格式")
+        return formats
+
+    def start(self):
+        """在后台线程中创建进程池并预热工作进程，不占用首个请求的时间（可选）"""
+        if self.enabled and self.workers > 0:
+            threading.Thread(target=self._warm_up, name='image-variants-warmup', daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            if not self.formats:
+                return
+            pool = self._executor()
+            if pool is not None:
+                for _ in range(self.workers):
+                    pool.submit(_warm_up, self.formats)
+        except Exception as e:
+            logger.warning(f"预热图像变体进程池失败: {str(e)}")
+
+    def _executor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # 按需导入；spawn 启动的子进程不继承父进程的线程和锁，gunicorn 多线程 worker 下也安全
+                    import multiprocessing
+                    from concurrent.futures import ProcessPoolExecutor
+                    try:
+                        self._pool = ProcessPoolExecutor(
+                            max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                    except (OSError, NotImplementedError) as e:
+                        # 部分 Serverless 环境不允许创建子进程，退回到调用线程内编码
+                        logger.warning(f"无法创建图像变体进程池，改为线程内编码: {str(e)}")
+                        self.workers = 0
+        return self._pool
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    @staticmethod
+    def manifest_key(file_name):
+        return split_name(file_name)[0] + MANIFEST_SUFFIX
+
+    def load(self, file_name):
+        """读取已生成的变体清单，不存在时返回 None"""
+        try:
+            data = self.store.read_bytes(self.manifest_key(file_name))
+            return json.loads(data) if data is not None else None
+        except Exception as e:
+            logger.warning(f"读取图像变体清单失败: {file_name}, {str(e)}")
+            return None
+
+    def ensure(self, file_name):
+        """
+        确保原图的变体已生成；同一原图的并发调用只编码一次
+        :return: 变体清单；原图不是位图、功能关闭或生成失败时返回 None
+        """
+        if not self.enabled or not is_raster(file_name):
+            return None
+        manifest = self.load(file_name)
+        if manifest is not None:
+            return manifest
+        if not self.formats:
+            return None
+        try:
+            manifest, _ = self.flight.do(file_name, self._render, file_name)
+        except Exception as e:
+            logger.error(f"生成图像变体失败: {file_name}, {str(e)}")
+            return None
+        return manifest
+
+    def _render(self, file_name):
+        # 合并到进行中渲染的调用方之前，领头的调用可能刚好写完清单
+        manifest = self.load(file_name)
+        if manifest is not None:
+            return manifest
+
+        key_dir, base_name = posixpath.split(file_name)
+        started = time.perf_counter()
+        # 原图在本地磁盘上时直接在其所在目录编码，否则下载到临时目录，编码后逐个上传
+        source_path = self.store.local_path(file_name)
+        work_dir = None
+        if source_path is None:
+            work_dir = tempfile.mkdtemp(prefix='soulmate-variants-')
+            source_path = os.path.join(work_dir, base_name)
+        try:
+            if work_dir:
+                self.store.fetch(file_name, source_path)
+            variants = self._encode(source_path, os.path.dirname(source_path), split_name(base_name)[0])
+            for variant in variants:
+                key = posixpath.join(key_dir, variant['file'])
+                if work_dir:
+                    self.store.save_file(key, os.path.join(work_dir, variant['file']))
+                variant['file'] = key
+            manifest = {
+                'source': file_name,
+                'source_bytes': os.path.getsize(source_path),
+                'variants': variants,
+            }
+            self.store.save_bytes(self.manifest_key(file_name), json.dumps(manifest, ensure_ascii=False).encode('utf-8'))
+        except Exception:
+            IMAGE_VARIANT_SECONDS.observe(time.perf_counter() - started, 'error')
+            raise
+        finally:
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        IMAGE_VARIANT_SECONDS.observe(time.perf_counter() - started, 'success')
+        for variant in variants:
+            IMAGE_VARIANT_BYTES.inc(variant['format'], amount=variant['bytes'])
+        logger.info(f"图像变体已生成: {file_name}，{len(variants)} 个文件，"
+                    f"耗时 {time.perf_counter() - started:.2f}s")
+        return manifest
+
+    def _encode(self, source_path, output_dir, stem):
+        """在进程池（或调用线程）中编码，返回相对 output_dir 的文件列表"""
+        args = (source_path, output_dir, stem, self.widths, self.formats, self.quality)
+        pool = self._executor() if self.workers > 0 else None
+        if pool is None:
+            return _render(*args)
+        from concurrent.futures.process import BrokenProcessPool
+        try:
+            return pool.submit(_render, *args).result(timeout=self.timeout)
+        except BrokenProcessPool:
+            # 工作进程异常退出（如内存不足被杀），下次调用重建进程池
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+
+    def payload(self, file_name):
+        """
+        结果中与变体相关的字段，变体不可用时返回空字典（前端只使用 hdImage）
+        - previewImage：默认格式的 preview 档，未指定 srcset 时的 src
+        - imageSrcset / imageSizes：默认格式的 srcset 和 sizes
+        - imageSources：各格式的 srcset，按 AVIF、WebP、JPEG 排序，用于 <picture><source>
+        """
+        manifest = self.ensure(file_name)
+        if not manifest or not manifest.get('variants'):
+            return {}
+        by_format = {}
+        for variant in manifest['variants']:
+            by_format.setdefault(variant['format'], []).append(variant)
+        default_format = next((fmt for fmt in self.requested_formats if fmt in by_format), None)
+        if default_format is None:
+            return {}
+
+        def srcset(variants):
+            # 原图比档位窄时几档的宽度相同，srcset 中同一宽度只能出现一次
+            by_width = {}
+            for v in variants:
+                by_width.setdefault(v['width'], v)
+            return ', '.join(f"{self.store.url(v['file'])} {width}w" for width, v in sorted(by_width.items()))
+
+        defaults = {v['name']: v for v in by_format[default_format]}
+        preview = defaults.get('preview') or min(defaults.values(), key=lambda v: v['width'])
+        return {
+            'previewImage': self.store.url(preview['file']),
+            'imageSrcset': srcset(by_format[default_format]),
+            'imageSizes': IMAGE_VARIANT_SIZES,
+            'imageSources': [{'type': FORMATS[fmt][2], 'srcset': srcset(by_format[fmt])}
+                             for fmt in FORMAT_PREFERENCE if fmt in by_format],
+        }
+
+    def remove(self, file_name):
+        """删除原图的全部变体和清单（结果缓存淘汰原图时调用）"""
+        manifest = self.load(file_name)
+        if manifest is None:
+            return 0
+        removed = 0
+        for variant in manifest.get('variants', []):
+            try:
+                self.store.delete(variant['file'])
+                removed += 1
+            except Exception as e:
+                logger.warning(f"删除图像变体失败: {variant['file']}, {str(e)}")
+        try:
+            self.store.delete(self.manifest_key(file_name))
+        except Exception as e:
+            logger.warning(f"删除图像变体清单失败: {file_name}, {str(e)}")
+        return removed
+
+
+# 进程内共享的变体生成器
+image_variants = ImageVariants()
@@ -5,12 +5,15 @@
 它实现了用户数据获取、生成任务提交和结果查询等功能。
 """
 import os
+import json
 import time
 import random
 import datetime
 import sqlite3
 import logging
-from flask import Flask, jsonify, request, g
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, request, g, send_file
 from flask_cors import CORS
 
 # 配置日志
@@ -31,117 +34,196 @@ CORS(app, resources={r"/api/*": {"origins": ["http://localhost:3000", "https://y
 # 不再需要JWT密钥
 # app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
 
+# 导入运行指标
+from .metrics import REGISTRY, HTTP_REQUEST_SECONDS
+
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+
+@app.after_request
+def record_request_latency(response):
+    started = getattr(g, '_request_started', None)
+    if started is not None:
+        # 按路由模板统计，避免任务ID等路径参数造成标签爆炸
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route, response.status_code)
+    return response
+
 # 导入用户管理器
 from .user_manager import UserManager
 
-# 初始化数据库表
-UserManager.init_db(app)
+# 导入限流，按客户端地址限制提交、分享、查询和支付接口
+from .rate_limit import rate_limited
+
+from .migrations import ensure_schema
 
-# 创建生成任务表
-with app.app_context():
-    with UserManager.get_db_cursor() as cursor:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS generation_tasks (
-                id TEXT PRIMARY KEY,
-                user_id TEXT,
-                status TEXT DEFAULT 'PROCESSING',
-                result TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                birth_date TEXT,
-                birth_time TEXT,
-                birth_place TEXT,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
+# 注册数据库连接回收；表结构由 migrations 管理，首个请求到达时才检查版本
+UserManager.init_db(app)
 
 # 导入支付配置
 from .payment_config import WECHAT_PAY_CONFIG, PAYMENT_AMOUNTS
+from .payment_notify import apply_notification
+from .payment_gateway import get_client as get_payment_client, GatewayUnavailable, PaymentGatewayError
 
-# 微信支付API相关辅助函数
-import hashlib
-import xml.etree.ElementTree as ET
-import time
-import requests
-
-def generate_sign(params, api_key):
-    """生成微信支付签名"""
-    # 按照参数名ASCII码从小到大排序
-    sorted_params = sorted(params.items(), key=lambda x: x[0])
-    # 拼接参数
-    sign_str = '&'.join([f'{k}={v}' for k, v in sorted_params]) + f'&key={api_key}'
-    # MD5加密
-    sign = hashlib.md5(sign_str.encode('utf-8')).hexdigest().upper()
-    return sign
-
-def dict_to_xml(params):
-    """将字典转换为XML"""
-    xml = '<xml>'
-    for k, v in params.items():
-        xml += f'<{k}>{v}</{k}>'
-    xml += '</xml>'
-    return xml
-
-def xml_to_dict(xml_str):
-    """将XML转换为字典"""
-    xml = ET.fromstring(xml_str)
-    params = {child.tag: child.text for child in xml}
-    return params
-
-# 导入图像生成器
+# 微信支付报文编解码及签名
+from .wechat_xml import to_xml, parse_xml, sign as generate_sign, verify_sign, XMLCodecError, MAX_XML_BYTES
+
+def wechat_reply(return_code, return_msg):
+    """生成应答微信支付通知的XML"""
+    return Response(to_xml({'return_code': return_code, 'return_msg': return_msg}), mimetype='text/xml')
+
+# 导入图像生成器及结果缓存
 from .image_generator import ImageGenerator
+from .result_cache import result_cache
+from .image_variants import image_variants
+from .image_store import image_store, is_valid_key, content_type
 
-# 辅助函数：根据 birthDate、birthTime 和 birthPlace 生成正缘画像
-def generate_real_result(birth_date, birth_time, birth_place):
+# 命理推算：出生信息 -> 规范化特征、提示词、诗句和详细解读
+from .fortune import read_birth, normalize_birth, InvalidBirthData
+from .gazetteer import gazetteer, GAZETTEER_SUGGEST_LIMIT
+
+PLACES_CACHE_CONTROL = 'public, max-age=86400'  # 联想结果只随地名表变化
+
+# 辅助函数：根据 birthDate、birthTime 和 birthPlace 生成正缘画像提示词
+def build_prompt(birth_date, birth_time, birth_place):
     """
-    根据输入的出生信息生成真实的 AI 正缘画像结果。
-    调用玄学算法和 AI 图像生成模型生成结果。
+    根据输入的出生信息生成图像提示词，相同的出生信息总是得到相同的提示词。
     """
-    # 这里可以根据出生信息生成更精准的提示词
-    # 简单示例：根据出生时间和地点生成不同的提示词元素
-    time_of_day = "清晨" if int(birth_time.split(':')[0]) < 12 else "黄昏"
-    season = "春季"  # 这里可以根据出生月份进一步细化
-    
-    # 生成正缘画像提示词（示例）
-    gender_prompt = "一位英俊的男子"  # 可以根据命理算法确定性别
-    appearance_prompt = "五官端正，气质优雅，眼神温和"
-    background_prompt = f"在{season}{time_of_day}的{birth_place}，背景有山水元素"
-    style_prompt = "中国传统绘画风格，工笔重彩"
-    
-    full_prompt = f"{gender_prompt}，{appearance_prompt}，{background_prompt}，{style_prompt}"
-    
-    # 调用图像生成API
-    image_filename = ImageGenerator.generate_image(full_prompt)
-    
+    return read_birth(birth_date, birth_time, birth_place).prompt
+
+# 辅助函数：把生成的图像和文字组合成最终结果
+def compose_result(birth_date, birth_time, birth_place, image_filename):
+    """
+    根据出生信息和生成的图像文件组装正缘画像结果。
+    """
+    reading = read_birth(birth_date, birth_time, birth_place)
+
     # 如果图像生成失败，使用备用方案
+    variants = {}
     if not image_filename:
         # 可以使用占位图或返回错误信息
         image_url = "https://placehold.co/400x600/6b7280/ffffff?text=画像生成中"
     else:
-        # 生成图像URL
-        image_url = f"/generated_images/{image_filename}"
-    
-    # 生成诗意文字（这里可以接入诗歌生成API）
-    poetic_text = "心有灵犀一点通，有缘千里来相会"
-    
-    # 生成详细分析（这里可以接入命理分析API）
-    detailed_analysis = (
-        f"根据您的出生信息 ({birth_date}, {birth_time}, {birth_place})，您的正缘画像为：\n\n"
-        f"此人性格开朗，热情大方，善于沟通，事业上积极进取。\n"
-        f"在感情方面，重视家庭，体贴入微，是理想的伴侣。\n"
-        f"建议您在{season}多参加社交活动，可能会遇到心仪的对象。"
-    )
+        # 生成图像URL，hdImage 保留原图供保存，页面显示使用按宽度选择的变体
+        image_url = image_store.url(image_filename)
+        variants = image_variants.payload(image_filename)
 
     return {
         "hdImage": image_url,
-        "poeticText": poetic_text,
-        "detailedAnalysis": detailed_analysis,
+        **variants,
+        "poeticText": reading.poem,
+        "detailedAnalysis": reading.analysis,
     }
 
+def generate_real_result(birth_date, birth_time, birth_place):
+    """
+    根据输入的出生信息同步生成真实的 AI 正缘画像结果。
+    调用玄学算法和 AI 图像生成模型生成结果。
+    """
+    prompt = build_prompt(birth_date, birth_time, birth_place)
+    # 调用图像生成API，相同提示词优先复用缓存中的图像
+    image_filename = result_cache.get_or_generate(prompt, ImageGenerator.generate_image)
+    return compose_result(birth_date, birth_time, birth_place, image_filename)
+
+# 导入异步生成轮询器
+from .generation_poller import GenerationPoller
+
+# 上游任务通过 async_call 提交，由单个轮询线程集中查询结果
+generation_poller = GenerationPoller()
+
+# 图像就绪后的收尾（组装结果、等待变体、写库）在独立的线程池中执行，
+# 轮询器的查询线程只负责查询和下载，合并到同一提示词的多个任务也不会在查询线程上排队
+COMPLETION_WORKERS = int(os.environ.get('GENERATION_COMPLETION_WORKERS', '4'))  # 完成任务的线程数
+completion_executor = ThreadPoolExecutor(max_workers=max(1, COMPLETION_WORKERS), thread_name_prefix='generation-complete')
+
+def finish_generation_task(task, future):
+    """图像就绪后组装结果并完成任务，在 completion_executor 中执行"""
+    try:
+        image_filename = future.result()
+        result = compose_result(task['birth_date'], task['birth_time'], task['birth_place'], image_filename)
+        task_queue.complete(task, result, image_filename)
+    except Exception as e:
+        task_queue.fail(task, e)
+
+def run_generation_task(task):
+    """
+    生成任务处理函数，由任务队列的工作线程调用。
+    只负责提交上游任务，图像就绪后交给 completion_executor 完成任务，不占用工作线程等待模型。
+    """
+    prompt = build_prompt(task['birth_date'], task['birth_time'], task['birth_place'])
+
+    def on_image_ready(future):
+        # 回调在轮询器的查询线程上触发，这里只提交收尾工作
+        completion_executor.submit(finish_generation_task, task, future)
+
+    # 相同提示词优先复用缓存中的图像，并发的相同提示词只提交一次上游任务
+    result_cache.get_or_submit(prompt, generation_poller.submit).add_done_callback(on_image_ready)
+    return None
+
+# 导入生成任务队列及状态通知
+from .task_queue import TaskQueue, QueueFullError, STATUS_SUCCESS, STATUS_FAILED
+from .task_events import task_events
+
+# 任务结束状态，长轮询和 SSE 到达这些状态后不再等待
+TERMINAL_STATUSES = (STATUS_SUCCESS, STATUS_FAILED)
+LONG_POLL_MAX_WAIT = 25  # 长轮询最长等待时间（秒）
+SSE_MAX_DURATION = 60  # 单个 SSE 连接最长保持时间（秒），客户端断开后会自动重连
+SSE_HEARTBEAT = 15  # SSE 心跳间隔（秒）
+RESULT_CACHE_CONTROL = 'public, max-age=31536000, immutable'  # 成功任务的结果不再变化
+
+# 有界工作线程池，替代每个请求单独创建线程
+task_queue = TaskQueue(run_generation_task)
+
+# 队列、轮询器和缓存的状态在输出指标时读取
+REGISTRY.gauge_callback('soulmate_generation_queue_depth', '排队中的生成任务数', task_queue.depth)
+REGISTRY.gauge_callback('soulmate_generation_active_workers', '正在处理任务的工作线程数', task_queue.active)
+REGISTRY.gauge_callback('soulmate_generation_upstream_inflight', '进行中的上游生成任务数', generation_poller.pending)
+REGISTRY.gauge_callback('soulmate_db_pool_connections', '数据库连接池已创建的连接数', UserManager.storage.created)
+REGISTRY.gauge_callback('soulmate_result_cache_hits_total', '结果缓存命中数', lambda: result_cache.hits, 'counter')
+REGISTRY.gauge_callback('soulmate_result_cache_misses_total', '结果缓存未命中数', lambda: result_cache.misses, 'counter')
+REGISTRY.gauge_callback('soulmate_result_cache_coalesced_total', '合并到进行中生成的任务数', lambda: result_cache.coalesced, 'counter')
+REGISTRY.gauge_callback('soulmate_task_event_waiters', '等待任务状态变化的任务数', task_events.waiting)
+
+# 定期把过期的已结束任务移到归档数据库
+from .retention import RetentionJob
+retention_job = RetentionJob()
+
+# 后台服务在首个请求到达时才启动，冷启动的导入阶段不访问 SQLite、不创建线程
+_services_started = False
+_services_lock = threading.Lock()
+
+@app.before_request
+def start_background_services():
+    """检查数据库结构，恢复未完成的任务并启动轮询器、工作线程和归档线程（只执行一次）"""
+    global _services_started
+    if _services_started:
+        return
+    with _services_lock:
+        if _services_started:
+            return
+        ensure_schema(UserManager.storage)
+        generation_poller.start()
+        task_queue.start()
+        retention_job.start()
+        image_variants.start()
+        _services_started = True
+
+def queue_full_response(retry_after):
+    """生成队列已满时的响应，附带 Retry-After 提示客户端稍后重试"""
+    response = jsonify({
+        "error": "当前求缘人数过多，请稍后再试。",
+        "retry_after": retry_after
+    })
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
 # ----------------------------------------------------------------------
 # API 路由
 # ----------------------------------------------------------------------
 
 @app.route('/api/v1/share/verify', methods=['POST']) 
+@rate_limited('share')
 def verify_share():
     """
     验证用户分享行为，成功后增加免费机会
@@ -153,18 +235,11 @@ def verify_share():
         if not user_id:
             return jsonify({'error': '用户ID不能为空'}), 400
         
-        # 检查用户是否存在
-        user = UserManager.get_user(user_id)
-        if not user:
+        # 记录分享时间并增加免费机会（单条语句完成）
+        new_chances = UserManager.record_share(user_id)
+        if new_chances is None:
             return jsonify({'error': '用户不存在'}), 404
         
-        # 更新最后分享时间
-        UserManager.update_last_shared(user_id)
-        
-        # 增加免费机会
-        new_chances = user['free_chances'] + 1
-        UserManager.update_free_chances(user_id, new_chances)
-        
         logger.info(f"用户 {user_id} 分享成功，增加1次免费机会，当前剩余: {new_chances}")
         
         return jsonify({
@@ -176,6 +251,7 @@ def verify_share():
         return jsonify({'error': '分享验证失败'}), 500
 
 @app.route('/api/v1/users/<user_id>', methods=['GET'])
+@rate_limited('user')
 def get_user_data(user_id):
     """
     获取用户的免费机会和最近分享时间。
@@ -199,6 +275,25 @@ def get_user_data(user_id):
         'last_shared_at': last_shared_at
     }), 200
 
+@app.route('/api/v1/places', methods=['GET'])
+@rate_limited('places')
+def suggest_places():
+    """
+    出生地输入联想：按简称、全称、拼音或别名的前缀返回地名表中的地点。
+    name 为提交任务时使用的标准地名，label 带上级地名用于显示。
+    """
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', GAZETTEER_SUGGEST_LIMIT, type=int), 1), GAZETTEER_SUGGEST_LIMIT)
+    places = gazetteer.suggest(query, limit)
+    response = jsonify({
+        "places": [
+            {"id": place.id, "name": place.name, "fullName": place.full_name, "label": gazetteer.label(place)}
+            for place in places
+        ]
+    })
+    response.headers['Cache-Control'] = PLACES_CACHE_CONTROL
+    return response
+
 # 登录接口已移除，因为不再需要登录功能
 # @app.route('/api/v1/auth/login', methods=['POST'])
 # def login():
@@ -229,6 +324,7 @@ def get_user_data(user_id):
 #     return jsonify({'token': token}), 200
 
 @app.route('/api/v1/generate/submit', methods=['POST'])
+@rate_limited('submit')
 def submit_generation_task():
     """
     提交一个生成任务，异步处理。
@@ -252,18 +348,22 @@ def submit_generation_task():
                     if not value
                 ]
             }), 400
+
+        # 出生信息无法识别时直接拒绝，不扣减机会；入库的是规范化后的值，相同出生信息对应相同的提示词
+        try:
+            birth_date, birth_time, birth_place = normalize_birth(birth_date, birth_time, birth_place)
+        except InvalidBirthData as e:
+            return jsonify({"error": str(e)}), 400
     
-        # 检查用户是否有免费机会
-        user = UserManager.get_user(user_id)
+        # 队列已满时直接拒绝，不扣减机会
+        if task_queue.full():
+            logger.warning(f"生成队列已满，拒绝用户 {user_id} 的任务")
+            return queue_full_response(task_queue.retry_after())
     
-        if not user:
-            # 如果用户不存在，创建新用户
-            UserManager.create_user(user_id)
-            # 创建后从数据库中获取最新用户数据
-            user = UserManager.get_user(user_id)
-            logger.info(f"创建新用户: {user_id}, 免费机会: {user['free_chances']}")
+        # 原子扣减一次免费机会，用户不存在时自动创建
+        new_chances = UserManager.consume_chance(user_id)
     
-        if user['free_chances'] <= 0:
+        if new_chances is None:
             # 用户没有免费机会，需要付费
             logger.info(f"用户 {user_id} 免费机会已用完")
             return jsonify({
@@ -271,81 +371,19 @@ def submit_generation_task():
                 "need_payment": True,
                 "free_chances_remaining": 0
             }), 402
+        logger.info(f"用户 {user_id} 剩余免费机会: {new_chances}")
     
         # 创建任务ID
         task_id = os.urandom(16).hex()
         logger.info(f"用户 {user_id} 提交生成任务: {task_id}")
     
-        # 保存任务到数据库
-        with app.app_context():
-            with UserManager.get_db_cursor() as cursor:
-                created_at = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                cursor.execute('''
-                    INSERT INTO generation_tasks (id, user_id, birth_date, birth_time, birth_place, created_at)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (task_id, user_id, birth_date, birth_time, birth_place, created_at))
-    
-        # 减少用户免费机会
-        new_chances = user['free_chances'] - 1
-        UserManager.update_free_chances(user_id, new_chances)
-        logger.info(f"用户 {user_id} 剩余免费机会: {new_chances}")
-    
-        # 异步处理生成任务
-        import threading
-        def run_generation_async():
-            try:
-                # 生成结果
-                real_result = generate_real_result(birth_date, birth_time, birth_place)
-                result_json = str(real_result).replace("'", '"')
-            
-                # 更新任务状态和结果
-                with app.app_context():
-                    with UserManager.get_db_cursor() as cursor:
-                        cursor.execute('''
-                            UPDATE generation_tasks
-                            SET status = 'SUCCESS', result = ?
-                            WHERE id = ?
-                        ''', (result_json, task_id))
-                
-                logger.info(f"任务 {task_id} 生成成功")
-                
-                # 如果提供了回调URL，发送通知
-                if callback_url:
-                    try:
-                        import requests
-                        requests.post(callback_url, json={
-                            'task_id': task_id,
-                            'status': 'SUCCESS',
-                            'result': real_result
-                        }, timeout=5)
-                    except Exception as e:
-                        logger.error(f"发送任务完成回调失败: {str(e)}")
-            except Exception as e:
-                logger.error(f"异步任务错误: {str(e)}")
-                with app.app_context():
-                    with UserManager.get_db_cursor() as cursor:
-                        cursor.execute('''
-                            UPDATE generation_tasks
-                            SET status = 'FAILED', result = ?
-                            WHERE id = ?
-                        ''', (str(e), task_id))
-                
-                # 如果提供了回调URL，发送失败通知
-                if callback_url:
-                    try:
-                        import requests
-                        requests.post(callback_url, json={
-                            'task_id': task_id,
-                            'status': 'FAILED',
-                            'error': str(e)
-                        }, timeout=5)
-                    except Exception as e:
-                        logger.error(f"发送任务失败回调失败: {str(e)}")
-    
-        # 启动异步线程
-        thread = threading.Thread(target=run_generation_async)
-        thread.daemon = True
-        thread.start()
+        # 持久化并排队任务，并发提交导致队列已满时退还机会
+        try:
+            task_queue.submit(task_id, user_id, birth_date, birth_time, birth_place, callback_url)
+        except QueueFullError as e:
+            logger.warning(f"生成队列已满，拒绝用户 {user_id} 的任务")
+            UserManager.add_chances(user_id, 1)
+            return queue_full_response(e.retry_after)
     
         return jsonify({
             "taskId": task_id,
@@ -357,6 +395,7 @@ def submit_generation_task():
         return jsonify({"error": "提交生成任务失败"}), 500
 
 @app.route('/api/v1/payment/create', methods=['POST'])
+@rate_limited('payment')
 def create_payment():
     """
     创建微信支付订单
@@ -403,20 +442,26 @@ def create_payment():
     params['sign'] = sign
     
     # 转换为XML
-    xml_data = dict_to_xml(params)
+    xml_data = to_xml(params)
     
+    # 调用微信支付统一下单API：带超时、有限重试和熔断，熔断中直接返回 503
+    try:
+        result = get_payment_client().unified_order(xml_data, parse_xml)
+    except GatewayUnavailable as e:
+        response = jsonify({'error': '支付系统繁忙，请稍后重试', 'retry_after': e.retry_after})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    except PaymentGatewayError as e:
+        logger.error(f"WeChat unifiedorder error: {str(e)}")
+        return jsonify({'error': '支付系统暂时不可用'}), 503
+
+    # 应答同样需要验签，防止伪造的 prepay_id
+    if result.get('return_code') == 'SUCCESS' and not verify_sign(result, WECHAT_PAY_CONFIG['API_KEY']):
+        logger.error("WeChat unifiedorder response signature mismatch")
+        return jsonify({'error': '支付系统暂时不可用'}), 503
+
     try:
-        # 调用微信支付统一下单API
-        response = requests.post(
-            'https://api.mch.weixin.qq.com/pay/unifiedorder',
-            data=xml_data.encode('utf-8'),
-            headers={'Content-Type': 'text/xml'}
-        )
-        
-        # 解析XML响应
-        response_xml = response.content
-        result = xml_to_dict(response_xml)
-        
         if result.get('return_code') == 'SUCCESS' and result.get('result_code') == 'SUCCESS':
             # 构造JSAPI支付参数
             jsapi_params = {
@@ -455,93 +500,104 @@ def create_payment():
 def payment_callback():
     """
     微信支付回调接口
+    同一订单的通知可能被微信重试多次，处理是幂等的：只有第一次会改变订单状态和用户机会
     """
-    # 读取XML数据
-    xml_data = request.data
-    result = xml_to_dict(xml_data)
-    
-    # 验证签名
-    sign = result.pop('sign')
-    generated_sign = generate_sign(result, WECHAT_PAY_CONFIG['API_KEY'])
-    
-    if sign != generated_sign:
+    # 读取XML数据：超长报文不读取，解析器拒绝 DTD、实体声明和嵌套元素
+    if (request.content_length or 0) > MAX_XML_BYTES:
+        return wechat_reply('FAIL', '报文过大'), 413
+    try:
+        result = parse_xml(request.get_data(cache=False))
+    except XMLCodecError as e:
+        logger.warning(f"微信支付回调解析失败: {str(e)}")
+        return wechat_reply('FAIL', '报文格式错误'), 400
+
+    # 验证签名（常量时间比较）
+    if not verify_sign(result, WECHAT_PAY_CONFIG['API_KEY']):
         logger.warning("微信支付回调签名验证失败")
-        return '签名失败', 400
+        return wechat_reply('FAIL', '签名失败'), 400
     
     if result.get('return_code') == 'SUCCESS':
-        if result.get('result_code') == 'SUCCESS':
-            # 支付成功
-            out_trade_no = result['out_trade_no']
-            
-            # 从数据库查询订单信息获取用户ID
-            with app.app_context():
-                with UserManager.get_db_cursor() as cursor:
-                    cursor.execute('SELECT user_id, product_type FROM payment_orders WHERE order_id = ?', (out_trade_no,))
-                    order = cursor.fetchone()
-                    
-                    if order:
-                        user_id = order['user_id']
-                        product_type = order['product_type']
-                        
-                        # 根据商品类型增加相应的免费机会
-                        if product_type == 'single':
-                            chances = 1
-                        elif product_type == 'monthly':
-                            chances = 10
-                        elif product_type == 'yearly':
-                            chances = 100
-                        else:
-                            chances = 1
-                        
-                        # 更新用户免费机会
-                        user = UserManager.get_user(user_id)
-                        if user:
-                            new_chances = user['free_chances'] + chances
-                            UserManager.update_free_chances(user_id, new_chances)
-                            logger.info(f"用户 {user_id} 购买{product_type}成功，增加 {chances} 次免费机会")
-                        
-                        # 更新订单状态
-                        cursor.execute('UPDATE payment_orders SET status = ? WHERE order_id = ?', ('SUCCESS', out_trade_no))
-                    else:
-                        logger.error(f"订单 {out_trade_no} 不存在")
-        else:
-            # 支付失败
-            out_trade_no = result.get('out_trade_no', '')
-            error_msg = result.get('err_code_des', '支付失败')
-            logger.error(f"支付失败: {out_trade_no}, {error_msg}")
-            
-            # 更新订单状态
-            if out_trade_no:
-                with app.app_context():
-                    with UserManager.get_db_cursor() as cursor:
-                        cursor.execute('UPDATE payment_orders SET status = ?, error_msg = ? WHERE order_id = ?', ('FAILED', error_msg, out_trade_no))
-    
-    # 更新支付记录
+        try:
+            apply_notification(result)
+        except Exception as e:
+            # 应答失败，微信稍后会重试这条通知
+            logger.error(f"处理支付通知失败: {str(e)}")
+            return wechat_reply('FAIL', '处理失败'), 500
+
+    # 返回成功响应给微信服务器
+    return wechat_reply('SUCCESS', 'OK')
+
+def read_task(task_id):
+    """
+    读取任务状态和结果，使用独立的应用上下文，读取完立即归还数据库连接。
+    """
     with app.app_context():
         with UserManager.get_db_cursor() as cursor:
             cursor.execute('''
-                INSERT INTO payment_records (order_id, user_id, amount, status, error_msg)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (out_trade_no, user_id, int(result.get('total_fee', 0))/100, 'FAILED', error_msg))
+                SELECT status, result FROM generation_tasks WHERE id = ?
+            ''', (task_id,))
+            task = cursor.fetchone()
+    return dict(task) if task else None
 
-    # 返回成功响应给微信服务器
-    return '<xml><return_code><![CDATA[SUCCESS]]></return_code><return_msg><![CDATA[OK]]></return_msg></xml>'
-    
-    # 回复微信服务器
-    return '<xml><return_code><![CDATA[SUCCESS]]></return_code><return_msg><![CDATA[OK]]></return_msg></xml>'
+def wait_for_task(task_id, wait, since=None):
+    """
+    读取任务；wait 大于 0 且任务未结束时，阻塞等待状态变化（最多 LONG_POLL_MAX_WAIT 秒）。
+    传入 since 时仅当当前状态与其相同时才等待。
+    :return: 任务字典，任务不存在时返回 None
+    """
+    wait = min(max(wait, 0), LONG_POLL_MAX_WAIT)
+
+    if wait <= 0:
+        return read_task(task_id)
+
+    # 先订阅再读取状态，避免在两者之间错过状态变化
+    event = task_events.subscribe(task_id)
+    try:
+        task = read_task(task_id)
+        if task and task["status"] not in TERMINAL_STATUSES and not (since and task["status"] != since):
+            if event.wait(wait):
+                task = read_task(task_id) or task
+        return task
+    finally:
+        task_events.unsubscribe(task_id, event)
+
+def task_payload(task):
+    """
+    生成 {"status": ..., "result": ...} 形式的 JSON 文本。
+    结果入库时已序列化为 JSON，这里直接拼接，无需解析。
+    """
+    if task["status"] == STATUS_SUCCESS:
+        return f'{{"status": "{STATUS_SUCCESS}", "result": {task["result"] or "{}"}}}'
+    return json.dumps({"status": task["status"]})
+
+def result_response(task_id, body):
+    """
+    成功任务的响应：结果写入后不再变化，附带 ETag 并允许 HTTP 缓存永久缓存。
+    """
+    response = Response(body, mimetype='application/json')
+    response.headers['ETag'] = f'"{task_id}"'
+    response.headers['Cache-Control'] = RESULT_CACHE_CONTROL
+    return response
+
+def result_not_modified(task_id):
+    """客户端已缓存该任务的结果时返回 304，无需查询数据库"""
+    if request.if_none_match.contains(task_id):
+        response = Response(status=304)
+        response.headers['ETag'] = f'"{task_id}"'
+        response.headers['Cache-Control'] = RESULT_CACHE_CONTROL
+        return response
+    return None
 
 @app.route('/api/v1/generate/status/<task_id>', methods=['GET'])
+@rate_limited('status')
 def get_generation_status(task_id):
     """
     查询生成任务的当前状态。
+    支持长轮询：传入 wait=<秒> 时，若任务未结束则阻塞等待状态变化（最多 LONG_POLL_MAX_WAIT 秒）；
+    可选 since=<状态>，仅当当前状态与其相同时才等待。
     """
     try:
-        with app.app_context():
-            with UserManager.get_db_cursor() as cursor:
-                cursor.execute('''
-                    SELECT status FROM generation_tasks WHERE id = ?
-                ''', (task_id,))
-                task = cursor.fetchone()
+        task = wait_for_task(task_id, request.args.get('wait', 0, type=float), request.args.get('since'))
         
         if not task:
             logger.warning(f"任务 {task_id} 不存在")
@@ -551,13 +607,83 @@ def get_generation_status(task_id):
     except Exception as e:
         logger.error(f"查询任务状态失败: {str(e)}")
         return jsonify({"error": "查询任务状态失败"}), 500
+
+@app.route('/api/v1/tasks/<task_id>', methods=['GET'])
+@rate_limited('status')
+def get_task(task_id):
+    """
+    一次返回任务状态和结果（成功时），同样支持 wait/since 长轮询参数。
+    成功的响应附带 ETag 和 Cache-Control: immutable，可被浏览器和 CDN 永久缓存。
+    """
+    try:
+        cached = result_not_modified(task_id)
+        if cached is not None:
+            return cached
+
+        task = wait_for_task(task_id, request.args.get('wait', 0, type=float), request.args.get('since'))
+        
+        if not task:
+            logger.warning(f"任务 {task_id} 不存在")
+            return jsonify({"error": "任务不存在。"}), 404
+
+        if task["status"] == STATUS_SUCCESS:
+            return result_response(task_id, task_payload(task))
+
+        response = jsonify({"status": task["status"]})
+        response.headers['Cache-Control'] = 'no-store'
+        return response, 200
+    except Exception as e:
+        logger.error(f"查询任务失败: {str(e)}")
+        return jsonify({"error": "查询任务失败"}), 500
+
+@app.route('/api/v1/generate/events/<task_id>', methods=['GET'])
+@rate_limited('status')
+def stream_generation_events(task_id):
+    """
+    以 Server-Sent Events 推送任务状态，任务成功时随事件一并返回结果，
+    客户端一个请求即可拿到最终结果。
+    """
+    def stream():
+        deadline = time.monotonic() + SSE_MAX_DURATION
+        last_status = None
+        while True:
+            event = task_events.subscribe(task_id)
+            # 客户端断开时生成器被关闭，同样会执行 finally 取消订阅
+            try:
+                task = read_task(task_id)
+                if not task:
+                    yield f"event: error\ndata: {json.dumps({'error': '任务不存在。'}, ensure_ascii=False)}\n\n"
+                    return
+
+                if task["status"] != last_status:
+                    last_status = task["status"]
+                    yield f"event: status\ndata: {task_payload(task)}\n\n"
+
+                remaining = deadline - time.monotonic()
+                if last_status in TERMINAL_STATUSES or remaining <= 0:
+                    return
+                if not event.wait(min(SSE_HEARTBEAT, remaining)):
+                    # 心跳注释，防止代理断开空闲连接
+                    yield ": keep-alive\n\n"
+            finally:
+                task_events.unsubscribe(task_id, event)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
     
 @app.route('/api/v1/results/<task_id>', methods=['GET'])
+@rate_limited('status')
 def get_generation_result(task_id):
     """
     获取最终的生成结果。
     """
     try:
+        cached = result_not_modified(task_id)
+        if cached is not None:
+            return cached
+
         with app.app_context():
             with UserManager.get_db_cursor() as cursor:
                 cursor.execute('''
@@ -576,19 +702,128 @@ def get_generation_result(task_id):
                 "status": task["status"]
             }), 400
         
-        # 解析JSON结果
-        import json
-        try:
-            result = json.loads(task["result"]) if task["result"] else {}
-        except json.JSONDecodeError as e:
-            logger.error(f"解析任务结果失败: {str(e)}")
-            result = {}
-            
-        return jsonify(result), 200
+        # 结果入库时已序列化为 JSON，直接返回原文
+        return result_response(task_id, task["result"] or '{}')
     except Exception as e:
         logger.error(f"获取任务结果失败: {str(e)}")
         return jsonify({"error": "获取任务结果失败"}), 500
 
+@app.route('/generated_images/<path:key>', methods=['GET'])
+def get_generated_image(key):
+    """
+    下载生成图像。按内容命名的图像附带以文件名为值的 ETag 和 Cache-Control: immutable，
+    浏览器和 CDN 可以永久缓存；客户端带 If-None-Match 时直接返回 304，不访问磁盘或对象存储。
+    """
+    if not is_valid_key(key):
+        return jsonify({"error": "图像不存在"}), 404
+    etag = image_store.etag(key)
+    cache_control = image_store.cache_control(key)
+    if etag and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = cache_control
+        return response
+
+    path = image_store.local_path(key)
+    if path is not None:
+        if not os.path.isfile(path):
+            return jsonify({"error": "图像不存在"}), 404
+        # 本地文件交给 send_file 处理条件请求和 Range
+        response = send_file(path, mimetype=content_type(key), conditional=True, etag=etag or True)
+    else:
+        try:
+            opened = image_store.open(key)
+        except Exception as e:
+            logger.error(f"读取图像失败: {key}, {str(e)}")
+            return jsonify({"error": "读取图像失败"}), 502
+        if opened is None:
+            return jsonify({"error": "图像不存在"}), 404
+        body, size = opened
+        response = Response(iter(lambda: body.read(64 * 1024), b''), mimetype=content_type(key))
+        response.headers['Content-Length'] = str(size)
+        response.set_etag(etag)
+        response.call_on_close(body.close)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    以 Prometheus 文本格式输出运行指标。
+    """
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# 导入运营批量操作
+from .admin import ADMIN_TOKEN, ADMIN_MAX_USERS, grant_chances, lookup_users, read_user_ids
+
+def admin_authorized():
+    """管理接口通过 X-Admin-Token 请求头鉴权，未配置 ADMIN_TOKEN 时一律拒绝"""
+    import hmac
+    token = request.headers.get('X-Admin-Token', '')
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode('utf-8'), ADMIN_TOKEN.encode('utf-8'))
+
+def admin_user_ids():
+    """
+    读取请求中的用户 ID：JSON 请求体 {"userIds": [...]}，或 text/csv 请求体（第一列为用户 ID）
+    :return: 用户 ID 列表；格式错误时返回 None
+    """
+    if request.mimetype == 'text/csv':
+        return list(read_user_ids(request.get_data(as_text=True).splitlines()))
+    data = request.get_json(silent=True) or {}
+    user_ids = data.get('userIds')
+    if not isinstance(user_ids, list):
+        return None
+    return [str(user_id) for user_id in user_ids if user_id]
+
+@app.route('/api/v1/admin/grants', methods=['POST'])
+def admin_grant_chances():
+    """
+    批量发放免费机会，机会数由 JSON 的 chances 字段或查询参数 chances 指定
+    """
+    if not admin_authorized():
+        return jsonify({'error': '无权访问'}), 403
+    user_ids = admin_user_ids()
+    if user_ids is None:
+        return jsonify({'error': '请提供 userIds 列表或 CSV 请求体'}), 400
+    if len(user_ids) > ADMIN_MAX_USERS:
+        return jsonify({'error': f'单次最多处理 {ADMIN_MAX_USERS} 个用户，更大的名单请使用命令行: '
+                                 f'python -m api.admin grant --chances N --file users.csv'}), 413
+    data = request.get_json(silent=True) or {}
+    try:
+        chances = int(data.get('chances') or request.args.get('chances', 0))
+        result = grant_chances(user_ids, chances)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"批量发放机会失败: {str(e)}")
+        return jsonify({'error': '批量发放失败'}), 500
+    return jsonify(result), 200
+
+@app.route('/api/v1/admin/users/lookup', methods=['POST'])
+def admin_lookup_users():
+    """
+    批量查询用户的免费机会和最后分享时间
+    """
+    if not admin_authorized():
+        return jsonify({'error': '无权访问'}), 403
+    user_ids = admin_user_ids()
+    if user_ids is None:
+        return jsonify({'error': '请提供 userIds 列表或 CSV 请求体'}), 400
+    if len(user_ids) > ADMIN_MAX_USERS:
+        return jsonify({'error': f'单次最多处理 {ADMIN_MAX_USERS} 个用户，更大的名单请使用命令行: '
+                                 f'python -m api.admin lookup --file users.csv'}), 413
+    try:
+        users = [{
+            'userId': user_id,
+            'exists': user is not None,
+            'free_chances': user['free_chances'] if user else None,
+            'last_shared_at': user['last_shared_at'] if user else None,
+        } for user_id, user in lookup_users(user_ids)]
+    except Exception as e:
+        logger.error(f"批量查询用户失败: {str(e)}")
+        return jsonify({'error': '批量查询失败'}), 500
+    return jsonify({'users': users}), 200
+
 if __name__ == '__main__':
     # 直接启动Flask应用
     app.run(debug=True, host='127.0.0.1', port=5000)
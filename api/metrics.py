@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+运行指标
+进程内的计数器、直方图和回调指标，以 Prometheus 文本格式在 /metrics 输出。
+记录一次指标只需一次加锁和一次二分查找，对请求路径的开销可以忽略。
+"""
+import bisect
+import threading
+
+# 默认的耗时分桶（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    type_name = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labelvalues, value in items:
+            yield self.name, _format_labels(self.labelnames, labelvalues), value
+
+
+class Histogram:
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 标签值 -> [各分桶计数..., 总和, 总数]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labelvalues, list(state)) for labelvalues, state in self._values.items()]
+        for labelvalues, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield (f'{self.name}_bucket',
+                       _format_labels(self.labelnames, labelvalues, [('le', _format_value(float(bound)))]),
+                       cumulative)
+            yield f'{self.name}_bucket', _format_labels(self.labelnames, labelvalues, [('le', '+Inf')]), state[-1]
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labelvalues), state[-2]
+            yield f'{self.name}_count', _format_labels(self.labelnames, labelvalues), state[-1]
+
+
+class CallbackMetric:
+    """在输出时才调用函数取值，适合队列长度、活跃线程数等已由其他组件维护的数值"""
+
+    def __init__(self, name, documentation, callback, type_name='gauge'):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.type_name = type_name
+
+    def samples(self):
+        yield self.name, '', self.callback()
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            # 模块重复加载时保留先注册的指标
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_callback(self, name, documentation, callback, type_name='gauge'):
+        metric = CallbackMetric(name, documentation, callback, type_name)
+        with self._lock:
+            # 回调指标以最后一次注册为准
+            self._metrics[name] = metric
+        return metric
+
+    def render(self):
+        """输出 Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type_name}')
+            try:
+                for name, labels, value in metric.samples():
+                    lines.append(f'{name}{labels} {_format_value(value)}')
+            except Exception as e:
+                lines.append(f'# 指标 {metric.name} 采集失败: {str(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+# 进程内共享的指标注册表
+REGISTRY = Registry()
+
+# HTTP 请求
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    'soulmate_http_request_duration_seconds', '按路由统计的请求耗时', ('method', 'route', 'status'))
+
+# SQLite
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    'soulmate_db_cursor_duration_seconds', 'get_db_cursor 事务块耗时（含提交）', ('outcome',))
+DB_ERRORS = REGISTRY.counter(
+    'soulmate_db_errors_total', 'SQLite 错误数，kind=locked 表示锁等待超时', ('kind',))
+
+# 上游图像模型
+UPSTREAM_SECONDS = REGISTRY.histogram(
+    'soulmate_upstream_request_duration_seconds', 'ImageSynthesis 调用耗时', ('operation',))
+UPSTREAM_RESPONSES = REGISTRY.counter(
+    'soulmate_upstream_responses_total', 'ImageSynthesis 响应数，按状态码或错误码统计', ('operation', 'code'))
+
+# 图像下载
+DOWNLOAD_SECONDS = REGISTRY.histogram(
+    'soulmate_image_download_duration_seconds', '生成图像下载耗时', ('outcome',))
+DOWNLOAD_BYTES = REGISTRY.counter(
+    'soulmate_image_download_bytes_total', '生成图像下载字节数')
+
+# 微信支付网关
+PAYMENT_GATEWAY_SECONDS = REGISTRY.histogram(
+    'soulmate_payment_gateway_duration_seconds', '微信支付接口单次调用耗时（每次重试单独计）', ('operation', 'outcome'))
+
+# 图像变体
+IMAGE_VARIANT_SECONDS = REGISTRY.histogram(
+    'soulmate_image_variant_duration_seconds', '生成一组缩略图/预览图/大图变体的耗时（含排队）', ('outcome',))
+IMAGE_VARIANT_BYTES = REGISTRY.counter(
+    'soulmate_image_variant_bytes_total', '图像变体写入的字节数，format=webp/avif/jpeg', ('format',))
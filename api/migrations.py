@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+数据库结构迁移
+所有表结构按版本号登记在 MIGRATIONS 中，已执行的版本记录在 schema_version 表里，每个版本只执行一次。
+部署时执行 python -m api.migrations 完成迁移；应用启动时只读取一次版本号，已是最新版本时不执行任何 DDL。
+
+新增迁移：在 MIGRATIONS 末尾追加 (版本号, 说明, 迁移内容)，版本号递增，已发布的迁移不要修改。迁移内容可以是
+- SQL 列表：按 SQLite 语法编写，PostgreSQL 下由存储后端替换类型后执行
+- 按后端名称区分的 SQL 列表字典：{'sqlite': [...], 'postgres': [...]}
+- 函数：接收游标和存储后端
+"""
+import os
+import logging
+import argparse
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 启动时发现数据库落后于代码时是否自动迁移；部署流程已执行迁移时可关闭
+AUTO_MIGRATE = os.environ.get('DB_AUTO_MIGRATE', 'true').lower() == 'true'
+
+
+def _add_payment_records_error_msg(cursor, storage):
+    """payment_records 补充支付回调写入的 error_msg 列"""
+    if 'error_msg' not in storage.column_names(cursor, 'payment_records'):
+        cursor.execute('ALTER TABLE payment_records ADD COLUMN error_msg TEXT')
+
+
+def _users_last_shared_at_epoch(cursor, storage):
+    """
+    users.last_shared_at 写入的是 Unix 时间戳（time.time()）；
+    PostgreSQL 下把 TIMESTAMP 列转为 DOUBLE PRECISION，SQLite 按值存储不需要改动
+    """
+    if storage.name != 'postgres':
+        return
+    cursor.execute('''
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'last_shared_at'
+    ''')
+    row = cursor.fetchone()
+    if row and row[0].startswith('timestamp'):
+        cursor.execute('''
+            ALTER TABLE users ALTER COLUMN last_shared_at TYPE DOUBLE PRECISION
+            USING EXTRACT(EPOCH FROM last_shared_at)
+        ''')
+
+
+# (版本号, 说明, 迁移内容)
+# 早期版本使用 IF NOT EXISTS，引入迁移之前创建的数据库可以直接从版本 0 升级
+MIGRATIONS = [
+    (1, '创建用户表', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id TEXT PRIMARY KEY,
+            free_chances INTEGER DEFAULT 1,
+            last_shared_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, '创建生成任务表及索引', [
+        '''
+        CREATE TABLE IF NOT EXISTS generation_tasks (
+            id TEXT PRIMARY KEY,
+            user_id TEXT,
+            status TEXT DEFAULT 'QUEUED',
+            result TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            birth_date TEXT,
+            birth_time TEXT,
+            birth_place TEXT,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # 按用户查询任务，以及按状态和时间查找排队/待归档的任务
+        'CREATE INDEX IF NOT EXISTS idx_generation_tasks_user ON generation_tasks (user_id, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_generation_tasks_status ON generation_tasks (status, created_at)',
+    ]),
+    (3, '创建图像缓存表', [
+        '''
+        CREATE TABLE IF NOT EXISTS image_cache (
+            cache_key TEXT NOT NULL,
+            variant INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            last_used_at REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cache_key, variant)
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_image_cache_last_used ON image_cache (last_used_at)',
+    ]),
+    (4, '创建支付订单表和支付记录表', [
+        '''
+        CREATE TABLE IF NOT EXISTS payment_orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT UNIQUE NOT NULL,
+            user_id TEXT NOT NULL,
+            product_type TEXT NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'PENDING',
+            error_msg TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS payment_records (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            amount REAL NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        ''',
+        # 按用户和状态查询订单、按订单号查询支付记录
+        'CREATE INDEX IF NOT EXISTS idx_payment_orders_user ON payment_orders (user_id, status)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_orders_status ON payment_orders (status, created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_records_order ON payment_records (order_id)',
+        'CREATE INDEX IF NOT EXISTS idx_payment_records_user ON payment_records (user_id)',
+    ]),
+    (5, 'payment_records 增加 error_msg 列', _add_payment_records_error_msg),
+    # SQLite 的归档写入独立的数据库文件（见 retention），PostgreSQL 归档到同库的表中
+    (6, '创建生成任务归档表', {
+        'sqlite': [],
+        'postgres': [
+            '''
+            CREATE TABLE IF NOT EXISTS generation_tasks_archive (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                status TEXT,
+                result TEXT,
+                created_at TIMESTAMP,
+                birth_date TEXT,
+                birth_time TEXT,
+                birth_place TEXT,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_generation_tasks_archive_user ON generation_tasks_archive (user_id, created_at)',
+        ],
+    }),
+    # 回调地址随任务持久化，重启恢复的任务同样会发送回调；领取时间用于判断 PROCESSING 任务是否已中断
+    (7, 'generation_tasks 增加 callback_url 和 claimed_at 列', [
+        'ALTER TABLE generation_tasks ADD COLUMN callback_url TEXT',
+        'ALTER TABLE generation_tasks ADD COLUMN claimed_at TIMESTAMP',
+    ]),
+    # 结果中引用的图像，结果缓存淘汰时跳过仍被未归档任务引用的图像
+    (8, 'generation_tasks 增加 image_file 列', [
+        'ALTER TABLE generation_tasks ADD COLUMN image_file TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_generation_tasks_image_file ON generation_tasks (image_file)',
+    ]),
+    (9, 'PostgreSQL 下 users.last_shared_at 改为 Unix 时间戳', _users_last_shared_at_epoch),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(storage, cursor):
+    """数据库当前的结构版本，尚未建立 schema_version 表时为 0"""
+    if not storage.table_exists(cursor, 'schema_version'):
+        return 0
+    cursor.execute('SELECT MAX(version) FROM schema_version')
+    return cursor.fetchone()[0] or 0
+
+
+def _apply(storage, cursor, migration):
+    if callable(migration):
+        migration(cursor, storage)
+        return
+    if isinstance(migration, dict):
+        statements = migration[storage.name]
+    else:
+        statements = [storage.translate_ddl(statement) for statement in migration]
+    for statement in statements:
+        cursor.execute(statement)
+
+
+def migrate(storage, target=LATEST_VERSION):
+    """
+    依次执行尚未执行的迁移，每个版本一个事务；多个进程同时迁移时由写锁串行化
+    :return: 本次执行的迁移版本列表
+    """
+    conn = storage.acquire()
+    cursor = storage.cursor(conn)
+    try:
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.commit()
+
+        applied = []
+        for version, description, migration in MIGRATIONS:
+            if version > target:
+                break
+            storage.begin_exclusive(cursor)
+            try:
+                # 拿到写锁后再检查一次，其他进程可能已经执行过
+                cursor.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,))
+                if cursor.fetchone():
+                    conn.rollback()
+                    continue
+                _apply(storage, cursor, migration)
+                cursor.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+            logger.info(f"已执行数据库迁移 {version}: {description}")
+        return applied
+    finally:
+        cursor.close()
+        storage.release(conn)
+
+
+def ensure_schema(storage, auto_migrate=AUTO_MIGRATE):
+    """
+    应用启动时调用：只读取一次版本号，已是最新版本时直接返回；
+    落后时按 auto_migrate 自动迁移，或记录错误等待部署流程执行迁移
+    """
+    conn = storage.acquire()
+    cursor = storage.cursor(conn)
+    try:
+        version = current_version(storage, cursor)
+    finally:
+        cursor.close()
+        storage.release(conn)
+
+    if version >= LATEST_VERSION:
+        return
+    if not auto_migrate:
+        logger.error(f"数据库结构版本 {version} 落后于代码版本 {LATEST_VERSION}，请执行 python -m api.migrations")
+        return
+    migrate(storage)
+
+
+def main(argv=None):
+    from .storage import STORAGE_BACKEND, SQLiteBackend, create_backend
+
+    parser = argparse.ArgumentParser(description='SoulMate 数据库迁移')
+    parser.add_argument('--db', help='SQLite 数据库路径，默认读取 SOULMATE_DB_PATH；设置 DATABASE_URL 时迁移 PostgreSQL')
+    parser.add_argument('--status', action='store_true', help='只显示当前版本和待执行的迁移')
+    args = parser.parse_args(argv)
+
+    storage = SQLiteBackend(args.db) if args.db else create_backend(STORAGE_BACKEND)
+    if args.status:
+        conn = storage.acquire()
+        cursor = storage.cursor(conn)
+        try:
+            version = current_version(storage, cursor)
+        finally:
+            cursor.close()
+            storage.release(conn)
+        print(f"当前版本: {version}，最新版本: {LATEST_VERSION}")
+        for v, d, _ in MIGRATIONS:
+            if v > version:
+                print(f"  待执行 {v}: {d}")
+        return
+    applied = migrate(storage)
+    print(f"数据库已是最新版本 {LATEST_VERSION}" + (f"，本次执行: {applied}" if applied else ''))
+
+
+if __name__ == '__main__':
+    main()
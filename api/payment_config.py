@@ -13,6 +13,7 @@ WECHAT_PAY_CONFIG = {
     'NOTIFY_URL': os.environ.get('WECHAT_NOTIFY_URL', 'https://your-domain.com/api/v1/payment/callback'),  # 支付回调URL
     'CERT_PATH': os.environ.get('WECHAT_CERT_PATH', 'path/to/cert.pem'),  # 证书路径
     'KEY_PATH': os.environ.get('WECHAT_KEY_PATH', 'path/to/key.pem'),  # 密钥路径
+    'UNIFIEDORDER_URL': os.environ.get('WECHAT_UNIFIEDORDER_URL', 'https://api.mch.weixin.qq.com/pay/unifiedorder'),  # 统一下单接口地址
 }
 
 # 支付金额配置 (单位: 元)
@@ -20,4 +21,10 @@ PAYMENT_AMOUNTS = {
     'single': 28.8,  # 单次求缘机会
     'monthly': 98.0,  # 月度会员
     'yearly': 888.0  # 年度会员
-}
\ No newline at end of file
+}
+# 各商品购买成功后增加的免费机会数
+PRODUCT_CHANCES = {
+    'single': 1,
+    'monthly': 10,
+    'yearly': 100
+}
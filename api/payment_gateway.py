@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付网关客户端
+统一下单通过共享的 keep-alive 会话发送，连接和读取都有超时。
+连接失败、5xx 和 SYSTEMERROR 等可安全重试的错误按带抖动的指数退避有限次重试（同一 out_trade_no 重复下单是幂等的）；
+读取超时不重试，避免请求线程被慢响应长时间占用。
+连续失败达到阈值后熔断：冷却期内直接拒绝，调用方返回 503，冷却结束后放行一个探测请求决定是否恢复。
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+from .metrics import REGISTRY, PAYMENT_GATEWAY_SECONDS
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 网关配置
+CONNECT_TIMEOUT = float(os.environ.get('WECHAT_CONNECT_TIMEOUT', '2'))  # 建立连接超时（秒）
+READ_TIMEOUT = float(os.environ.get('WECHAT_READ_TIMEOUT', '5'))  # 等待响应超时（秒）
+MAX_RETRIES = int(os.environ.get('WECHAT_MAX_RETRIES', '2'))  # 可安全重试的错误最多重试次数
+RETRY_BACKOFF = float(os.environ.get('WECHAT_RETRY_BACKOFF', '0.2'))  # 首次重试前的平均等待（秒），之后每次翻倍
+POOL_SIZE = int(os.environ.get('WECHAT_POOL_SIZE', '8'))  # 保持的连接数
+BREAKER_THRESHOLD = int(os.environ.get('WECHAT_BREAKER_THRESHOLD', '5'))  # 连续失败多少次后熔断
+BREAKER_COOLDOWN = float(os.environ.get('WECHAT_BREAKER_COOLDOWN', '30'))  # 熔断后多久放行探测请求（秒）
+
+# 微信要求用原订单号重试的业务错误码
+RETRYABLE_ERR_CODES = {'SYSTEMERROR', 'BIZERR_NEED_RETRY'}
+
+
+class PaymentGatewayError(Exception):
+    """统一下单请求失败"""
+
+
+class GatewayUnavailable(PaymentGatewayError):
+    """熔断中，调用方应稍后重试"""
+
+    def __init__(self, retry_after):
+        super().__init__('微信支付暂时不可用')
+        self.retry_after = retry_after
+
+
+class _RetryableError(PaymentGatewayError):
+    """可以用原订单号安全重试的错误"""
+
+
+class CircuitBreaker:
+    """按连续失败次数熔断：closed → open → half_open（放行一个探测请求）→ closed 或 open"""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        判断是否放行本次请求
+        :raises GatewayUnavailable: 熔断中，或半开状态下已有探测请求在进行
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+                return
+        raise GatewayUnavailable(max(1, int(remaining + 0.999)))
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("微信支付网关已恢复，关闭熔断")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"微信支付网关连续失败 {self.failures} 次，熔断 {self.cooldown:g}s")
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class WeChatPayClient:
+    def __init__(self, url, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF, breaker=None):
+        self.url = url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max(0, max_retries)
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """共享的 keep-alive 会话，第一次下单时创建"""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # 重试由本类控制，连接池本身不重试
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+
+    def unified_order(self, xml_data, parse):
+        """
+        调用统一下单接口
+        :param xml_data: 已签名的请求 XML
+        :param parse: 把响应 XML 解析为字典的函数
+        :return: 响应字典（业务失败也原样返回，由调用方处理 result_code）
+        :raises GatewayUnavailable: 熔断中
+        :raises PaymentGatewayError: 重试后仍失败
+        """
+        self.breaker.allow()
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                result = self._post(xml_data, parse)
+            except _RetryableError as e:
+                PAYMENT_GATEWAY_SECONDS.observe(time.perf_counter() - started, 'unifiedorder', 'retryable_error')
+                if attempt < self.max_retries:
+                    attempt += 1
+                    # 全抖动：在 [0, backoff * 2^attempt) 内随机等待，避免大量请求同时重试
+                    delay = random.uniform(0, self.backoff * (2 ** attempt))
+                    logger.warning(f"统一下单失败，{delay:.2f}s 后第 {attempt} 次重试: {str(e)}")
+                    time.sleep(delay)
+                    continue
+                self.breaker.record_failure()
+                raise PaymentGatewayError(str(e)) from e
+            except Exception:
+                PAYMENT_GATEWAY_SECONDS.observe(time.perf_counter() - started, 'unifiedorder', 'error')
+                self.breaker.record_failure()
+                raise
+            PAYMENT_GATEWAY_SECONDS.observe(time.perf_counter() - started, 'unifiedorder', 'ok')
+            self.breaker.record_success()
+            return result
+
+    def _post(self, xml_data, parse):
+        import requests
+
+        try:
+            response = self.session.post(self.url, data=xml_data.encode('utf-8'),
+                                         headers={'Content-Type': 'text/xml'}, timeout=self.timeout)
+        except requests.exceptions.ConnectTimeout as e:
+            raise _RetryableError(f'连接超时: {str(e)}') from e
+        except requests.exceptions.ReadTimeout as e:
+            raise PaymentGatewayError(f'响应超时: {str(e)}') from e
+        except requests.exceptions.ConnectionError as e:
+            raise _RetryableError(f'连接失败: {str(e)}') from e
+        except requests.RequestException as e:
+            raise PaymentGatewayError(f'请求失败: {str(e)}') from e
+
+        if response.status_code >= 500:
+            raise _RetryableError(f'HTTP {response.status_code}')
+        if response.status_code != 200:
+            raise PaymentGatewayError(f'HTTP {response.status_code}')
+        try:
+            result = parse(response.content)
+        except Exception as e:
+            raise PaymentGatewayError(f'响应解析失败: {str(e)}') from e
+        if result.get('err_code') in RETRYABLE_ERR_CODES:
+            raise _RetryableError(result.get('err_code_des') or result['err_code'])
+        return result
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """进程内共享的统一下单客户端"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from .payment_config import WECHAT_PAY_CONFIG
+                _client = WeChatPayClient(WECHAT_PAY_CONFIG['UNIFIEDORDER_URL'])
+    return _client
+
+
+REGISTRY.gauge_callback('soulmate_payment_gateway_breaker_open', '微信支付熔断状态，1 表示熔断中',
+                        lambda: int(_client is not None and _client.breaker.state != CircuitBreaker.CLOSED))
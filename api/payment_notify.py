@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付结果通知处理
+每条通知以 out_trade_no 为键在一个事务内完成：订单从 PENDING 转为 SUCCESS/FAILED 只会发生一次，
+成功时在同一事务中增加用户机会。微信重试的通知先用一次只读查询判断订单已处理，直接应答，不再加写锁。
+支付记录等非关键的记账在应答之后由后台线程写入。
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .user_manager import UserManager
+from .payment_config import PRODUCT_CHANCES
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 订单状态
+ORDER_PENDING = 'PENDING'
+ORDER_SUCCESS = 'SUCCESS'
+ORDER_FAILED = 'FAILED'
+
+# 处理结果：credited 已到账，failed 已标记失败，duplicate 重复通知，unknown 订单不存在
+PAYMENT_NOTIFICATIONS = REGISTRY.counter(
+    'soulmate_payment_notifications_total', '微信支付结果通知数，按处理结果统计', ('outcome',))
+
+_bookkeeping = None
+_bookkeeping_lock = threading.Lock()
+
+
+def _bookkeeping_executor():
+    """记账线程在第一次用到时创建"""
+    global _bookkeeping
+    if _bookkeeping is None:
+        with _bookkeeping_lock:
+            if _bookkeeping is None:
+                _bookkeeping = ThreadPoolExecutor(max_workers=1, thread_name_prefix='payment-bookkeeping')
+    return _bookkeeping
+
+
+def _order_status(out_trade_no):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT status FROM payment_orders WHERE order_id = ?', (out_trade_no,))
+        row = cursor.fetchone()
+        return row['status'] if row else None
+
+
+def apply_notification(notification):
+    """
+    处理一条已验签的支付结果通知
+    :param notification: 通知字段字典
+    :return: 处理结果 credited / failed / duplicate / unknown
+    """
+    out_trade_no = notification.get('out_trade_no', '')
+    paid = notification.get('result_code') == 'SUCCESS'
+    error_msg = None if paid else notification.get('err_code_des', '支付失败')
+
+    # 重试的通知只读一次订单状态，WAL 模式下读不阻塞写
+    status = _order_status(out_trade_no) if out_trade_no else None
+    if status is None:
+        logger.error(f"订单 {out_trade_no} 不存在")
+        outcome = 'unknown'
+    elif status != ORDER_PENDING:
+        outcome = 'duplicate'
+    else:
+        outcome = _transition(out_trade_no, paid, error_msg)
+
+    PAYMENT_NOTIFICATIONS.inc(outcome)
+    if outcome in ('credited', 'failed'):
+        _bookkeeping_executor().submit(_record_payment, out_trade_no, notification, error_msg)
+    return outcome
+
+
+def _transition(out_trade_no, paid, error_msg):
+    """在一个事务内把 PENDING 订单转为最终状态，成功时增加机会；并发的重复通知只有一个能完成转换"""
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('''
+            UPDATE payment_orders SET status = ?, error_msg = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE order_id = ? AND status = ?
+            RETURNING user_id, product_type
+        ''', (ORDER_SUCCESS if paid else ORDER_FAILED, error_msg, out_trade_no, ORDER_PENDING))
+        order = cursor.fetchone()
+        if order is None:
+            return 'duplicate'
+        if not paid:
+            logger.error(f"支付失败: {out_trade_no}, {error_msg}")
+            return 'failed'
+
+        user_id, product_type = order['user_id'], order['product_type']
+        chances = PRODUCT_CHANCES.get(product_type, 1)
+        UserManager.add_chances(user_id, chances, cursor)
+    logger.info(f"用户 {user_id} 购买{product_type}成功，增加 {chances} 次免费机会")
+    return 'credited'
+
+
+def _record_payment(out_trade_no, notification, error_msg):
+    """写入支付记录；每个订单只在状态转换成功后写一次"""
+    try:
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO payment_records (order_id, user_id, amount, status, error_msg)
+                SELECT order_id, user_id, ?, status, ? FROM payment_orders WHERE order_id = ?
+            ''', (int(notification.get('total_fee') or 0) / 100, error_msg, out_trade_no))
+    except Exception as e:
+        logger.error(f"写入支付记录失败: {out_trade_no}, {str(e)}")
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+请求限流
+令牌桶按 (策略, 维度, 键) 计数，目前只有 ip 维度，以客户端地址为键。请求中的 userId 由客户端提供、没有经过认证，
+换一个 userId 就能拿到新的桶，因此不作为限流维度；接入登录认证后再按认证的用户增加维度。
+桶容量为策略允许的突发请求数，令牌按“次数/周期”匀速补充；桶空时返回 429 和 Retry-After，
+限流检查在视图函数之前完成，被拒绝的请求不会访问数据库或上游模型。
+- memory（默认）：进程内计数，适合单进程部署；多个 worker 各自计数
+- redis：Lua 脚本在 Redis 中原子地补充和扣减令牌，多 worker、多实例共享同一组桶
+- off：关闭限流
+
+策略可以用环境变量覆盖，格式为“次数/秒数”，如 RATE_LIMIT_SUBMIT_IP=30/60，设为 0 关闭该项限制。
+"""
+import os
+import time
+import logging
+import threading
+import functools
+from collections import OrderedDict
+
+from flask import request, jsonify
+
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 限流配置
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()  # memory、redis 或 off
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL', os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
+RATE_LIMIT_MAX_BUCKETS = int(os.environ.get('RATE_LIMIT_MAX_BUCKETS', '100000'))  # memory 后端保留的桶数上限
+RATE_LIMIT_TRUST_PROXY = os.environ.get('RATE_LIMIT_TRUST_PROXY', 'false').lower() == 'true'  # 是否按 X-Forwarded-For 识别客户端
+
+# 各接口的默认策略：{策略名: {维度: '次数/秒数'}}
+DEFAULT_POLICIES = {
+    # 提交任务会扣减机会并可能调用上游模型
+    'submit': {'ip': '30/60'},
+    # 每次分享都会奖励一次机会
+    'share': {'ip': '30/3600'},
+    # 任务状态和结果查询，轮询频率较高
+    'status': {'ip': '300/60'},
+    # 首页查询剩余机会
+    'user': {'ip': '120/60'},
+    # 出生地输入联想，随输入触发
+    'places': {'ip': '300/60'},
+    # 创建支付订单会调用微信统一下单
+    'payment': {'ip': '30/60'},
+}
+
+RATE_LIMITED = REGISTRY.counter(
+    'soulmate_rate_limited_total', '被限流拒绝的请求数', ('policy', 'scope'))
+
+
+def parse_rate(text):
+    """
+    解析“次数/秒数”
+    :return: (桶容量, 每秒补充的令牌数)；为 0 或空时返回 None 表示不限制
+    """
+    text = (text or '').strip()
+    if not text or text == '0':
+        return None
+    count, _, period = text.partition('/')
+    count, period = float(count), float(period or 1)
+    if count <= 0 or period <= 0:
+        return None
+    return count, count / period
+
+
+def load_policies(defaults=DEFAULT_POLICIES):
+    """读取默认策略及环境变量覆盖：{策略名: {维度: (容量, 补充速率)}}"""
+    policies = {}
+    for name, scopes in defaults.items():
+        policies[name] = {}
+        for scope, rate in scopes.items():
+            parsed = parse_rate(os.environ.get(f'RATE_LIMIT_{name.upper()}_{scope.upper()}', rate))
+            if parsed:
+                policies[name][scope] = parsed
+    return policies
+
+
+class MemoryBuckets:
+    """进程内令牌桶，超过上限时淘汰最久未访问的桶（相当于重置该客户端的计数）"""
+    name = 'memory'
+
+    def __init__(self, max_buckets=RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max(1, max_buckets)
+        # 键 -> [剩余令牌, 上次更新时间]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, rate, cost=1):
+        """
+        尝试从桶中取出 cost 个令牌
+        :return: (是否放行, 需要等待的秒数)
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [capacity, now]
+                if len(self._buckets) > self.max_buckets:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return True, 0.0
+            return False, (cost - bucket[0]) / rate
+
+
+# KEYS[1]=桶的键；ARGV=容量, 每秒补充数, 消耗数。使用 Redis 服务器时间，避免各实例时钟不一致
+TOKEN_BUCKET_SCRIPT = '''
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1])
+local ts = tonumber(state[2])
+if tokens == nil then
+    tokens = capacity
+else
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+end
+local allowed = 0
+local wait = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000))
+return {allowed, tostring(wait)}
+'''
+
+
+class RedisBuckets:
+    """Redis 令牌桶；client 可以是任何兼容 redis-py 的客户端（需支持 Lua 脚本）"""
+    name = 'redis'
+
+    def __init__(self, url=RATE_LIMIT_REDIS_URL, prefix='soulmate:ratelimit:', client=None):
+        self.url = url
+        self.prefix = prefix
+        self._client = client
+        self._script = None
+        self._lock = threading.Lock()
+
+    def _get_script(self):
+        if self._script is None:
+            with self._lock:
+                if self._script is None:
+                    if self._client is None:
+                        import redis
+                        self._client = redis.Redis.from_url(self.url, socket_timeout=0.5, socket_connect_timeout=0.5)
+                    self._script = self._client.register_script(TOKEN_BUCKET_SCRIPT)
+        return self._script
+
+    def take(self, key, capacity, rate, cost=1):
+        allowed, wait = self._get_script()(keys=[self.prefix + key], args=[capacity, rate, cost])
+        return bool(allowed), float(wait)
+
+
+class RateLimiter:
+    def __init__(self, backend, policies=None):
+        self.backend = backend
+        self.policies = load_policies() if policies is None else policies
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def check(self, policy, keys):
+        """
+        依次检查各维度的桶
+        :param keys: {维度: 键}，键为空的维度跳过
+        :return: 需要等待的秒数；0 表示放行
+        """
+        if self.backend is None:
+            return 0
+        for scope, (capacity, rate) in self.policies.get(policy, {}).items():
+            key = keys.get(scope)
+            if not key:
+                continue
+            try:
+                allowed, wait = self.backend.take(f'{policy}:{scope}:{key}', capacity, rate)
+            except Exception as e:
+                # 限流后端不可用时放行，不影响正常请求
+                logger.warning(f"限流检查失败，放行请求: {str(e)}")
+                return 0
+            if not allowed:
+                RATE_LIMITED.inc(policy, scope)
+                return wait
+        return 0
+
+
+def create_rate_limiter(backend=RATE_LIMIT_BACKEND):
+    """按配置创建限流器"""
+    if backend == 'redis':
+        logger.info("限流使用 Redis")
+        return RateLimiter(RedisBuckets())
+    if backend == 'off':
+        return RateLimiter(None)
+    if backend != 'memory':
+        raise ValueError(f'不支持的限流后端: {backend}')
+    return RateLimiter(MemoryBuckets())
+
+
+# 进程内共享的限流器
+rate_limiter = create_rate_limiter()
+
+
+def client_ip():
+    """客户端地址；部署在反向代理之后且设置 RATE_LIMIT_TRUST_PROXY 时取 X-Forwarded-For 的第一个地址"""
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get('X-Forwarded-For', '')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote_addr or ''
+
+
+def rate_limited(policy, limiter=None):
+    """视图装饰器：超过策略限制时返回 429 和 Retry-After"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            active = limiter or rate_limiter
+            if active.enabled:
+                wait = active.check(policy, {'ip': client_ip()})
+                if wait > 0:
+                    retry_after = max(1, int(wait + 0.999))
+                    response = jsonify({'error': '请求过于频繁，请稍后再试', 'retry_after': retry_after})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(retry_after)
+                    return response
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
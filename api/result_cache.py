@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""
+生成结果缓存
+以“提示词 + 模型 + 尺寸”的哈希为键缓存已生成的图像，相同提示词直接复用，避免重复调用模型。
+缓存索引保存在 image_cache 表中，图像保存在图像存储（image_store）中，按 TTL 和最近最少使用淘汰。
+未命中时，同一提示词的并发任务合并为一次上游调用。
+"""
+import os
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+
+from .user_manager import UserManager
+from .single_flight import SingleFlight
+from .image_generator import MODEL, IMAGE_SIZE
+from .image_store import image_store
+from .image_variants import image_variants
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 命中策略：always 始终复用同一张图；rotate 先生成 N 张不同的图，之后轮流复用；off 关闭缓存
+POLICY = os.environ.get('RESULT_CACHE_POLICY', 'always').lower()
+VARIANTS = int(os.environ.get('RESULT_CACHE_VARIANTS', '3'))  # rotate 策略下每个提示词保留的图像数
+TTL_SECONDS = int(os.environ.get('RESULT_CACHE_TTL', str(30 * 24 * 3600)))  # 缓存有效期
+MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '10000'))  # 缓存图像数上限
+EVICT_EVERY = 100  # 每写入多少条缓存执行一次淘汰
+
+# 这些文件是兜底图像，不进入缓存也不会被删除
+PROTECTED_FILES = {'default_image.svg'}
+
+# 淘汰条件：图像没有被未归档的任务结果引用（借助 generation_tasks.image_file 索引逐条检查）
+UNREFERENCED_BY_TASKS = '''NOT EXISTS (
+    SELECT 1 FROM generation_tasks WHERE generation_tasks.image_file = image_cache.file_name
+)'''
+
+
+def cache_key(prompt):
+    """计算缓存键：提示词、模型和尺寸共同决定生成结果"""
+    return hashlib.sha256(f'{MODEL}|{IMAGE_SIZE}|{prompt}'.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, policy=POLICY, variants=VARIANTS, ttl=TTL_SECONDS, max_entries=MAX_ENTRIES):
+        self.policy = policy
+        self.variants = 1 if policy == 'always' else max(1, variants)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.flight = SingleFlight()
+        self._puts = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.policy in ('always', 'rotate')
+
+    def get(self, key):
+        """
+        查找可复用的图像
+        :return: 图像文件名；未命中（或 rotate 策略下变体数量不足）时返回 None
+        """
+        now = time.time()
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('''
+                SELECT variant, file_name FROM image_cache
+                WHERE cache_key = ? AND created_at > ?
+                ORDER BY last_used_at
+            ''', (key, now - self.ttl))
+            rows = cursor.fetchall()
+            if len(rows) < self.variants:
+                return None
+            # 取最久未使用的变体，实现轮换
+            variant, file_name = rows[0]['variant'], rows[0]['file_name']
+            cursor.execute('''
+                UPDATE image_cache SET last_used_at = ?, hits = hits + 1
+                WHERE cache_key = ? AND variant = ?
+            ''', (now, key, variant))
+        if not image_store.exists(file_name):
+            # 文件已被外部清理，视为未命中
+            return None
+        return file_name
+
+    def put(self, key, file_name):
+        """记录新生成的图像"""
+        if not file_name or file_name in PROTECTED_FILES:
+            return
+        now = time.time()
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('DELETE FROM image_cache WHERE cache_key = ? AND created_at <= ?', (key, now - self.ttl))
+            cursor.execute('''
+                INSERT INTO image_cache (cache_key, variant, file_name, created_at, last_used_at)
+                VALUES (?, (SELECT COUNT(*) FROM image_cache WHERE cache_key = ?) % ?, ?, ?, ?)
+                ON CONFLICT (cache_key, variant) DO UPDATE SET
+                    file_name = excluded.file_name, created_at = excluded.created_at,
+                    last_used_at = excluded.last_used_at, hits = 0
+            ''', (key, key, self.variants, file_name, now, now))
+
+        with self._lock:
+            self._puts += 1
+            should_evict = self._puts % EVICT_EVERY == 0
+        if should_evict:
+            self.evict()
+
+    def get_or_generate(self, prompt, generate):
+        """
+        先查缓存，未命中时调用 generate(prompt) 生成并写入缓存；
+        同一提示词的并发调用只会触发一次 generate
+        :return: 图像文件名
+        """
+        key = cache_key(prompt)
+        if self.enabled:
+            file_name = self.get(key)
+            if file_name:
+                with self._lock:
+                    self.hits += 1
+                logger.info(f"结果缓存命中: {key[:12]} -> {file_name}")
+                return file_name
+
+        file_name, leader = self.flight.do(key, generate, prompt)
+        with self._lock:
+            if leader:
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.info(f"合并到进行中的生成: {key[:12]} -> {file_name}")
+        elif self.enabled:
+            self.put(key, file_name)
+        return file_name
+
+    def get_or_submit(self, prompt, submit):
+        """
+        get_or_generate 的异步版本：未命中时调用 submit(prompt) 发起上游任务，不阻塞调用线程
+        :param submit: 返回 Future 的函数，Future 的结果为图像文件名
+        :return: Future，结果为图像文件名；同一提示词的并发调用共享同一个 Future
+        """
+        key = cache_key(prompt)
+        if self.enabled:
+            file_name = self.get(key)
+            if file_name:
+                with self._lock:
+                    self.hits += 1
+                logger.info(f"结果缓存命中: {key[:12]} -> {file_name}")
+                future = Future()
+                future.set_result(file_name)
+                return future
+
+        future, leader = self.flight.acquire(key)
+        with self._lock:
+            if leader:
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            logger.info(f"合并到进行中的生成: {key[:12]}")
+            return future
+
+        def on_done(upstream):
+            error = upstream.exception()
+            if error is not None:
+                self.flight.reject(key, error)
+                return
+            file_name = upstream.result()
+            if self.enabled:
+                try:
+                    self.put(key, file_name)
+                except Exception as e:
+                    logger.error(f"写入结果缓存失败: {str(e)}")
+            self.flight.resolve(key, file_name)
+
+        try:
+            submit(prompt).add_done_callback(on_done)
+        except Exception as e:
+            self.flight.reject(key, e)
+        return future
+
+    def evict(self):
+        """
+        淘汰过期和超出容量的缓存，并删除不再被引用的图像文件
+        仍被未归档任务的结果引用的图像不淘汰（结果响应可被永久缓存），任务归档后再按正常规则淘汰
+        """
+        now = time.time()
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute(f'''
+                DELETE FROM image_cache WHERE created_at <= ? AND {UNREFERENCED_BY_TASKS}
+                RETURNING file_name
+            ''', (now - self.ttl,))
+            removed = {row['file_name'] for row in cursor.fetchall()}
+            # 超出容量的部分按最近使用时间从旧到新删除；先计数再按主键删除，SQLite 和 PostgreSQL 通用
+            cursor.execute('SELECT COUNT(*) AS entries FROM image_cache')
+            excess = cursor.fetchone()['entries'] - self.max_entries
+            if excess > 0:
+                cursor.execute(f'''
+                    DELETE FROM image_cache WHERE (cache_key, variant) IN (
+                        SELECT cache_key, variant FROM image_cache WHERE {UNREFERENCED_BY_TASKS}
+                        ORDER BY last_used_at, cache_key, variant LIMIT ?
+                    ) RETURNING file_name
+                ''', (excess,))
+                removed.update(row['file_name'] for row in cursor.fetchall())
+            if not removed:
+                return 0
+            # 同一文件可能仍被其他缓存项引用
+            placeholders = ','.join('?' * len(removed))
+            cursor.execute(f'SELECT DISTINCT file_name FROM image_cache WHERE file_name IN ({placeholders})', tuple(removed))
+            removed -= {row['file_name'] for row in cursor.fetchall()}
+
+        # 图像按内容命名，不同提示词生成的相同图像共用一个文件，上面已排除仍被引用的文件
+        for file_name in removed - PROTECTED_FILES:
+            image_variants.remove(file_name)
+            try:
+                image_store.delete(file_name)
+            except Exception as e:
+                logger.warning(f"删除缓存图像失败: {file_name}, {str(e)}")
+        logger.info(f"结果缓存淘汰 {len(removed)} 个图像文件")
+        return len(removed)
+
+    def stats(self):
+        """命中统计"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'policy': self.policy,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'in_flight': self.flight.in_flight(),
+                'hit_rate': self.hits / total if total else 0.0,
+            }
+
+
+# 进程内共享的缓存实例
+result_cache = ResultCache()
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+生成任务归档
+后台线程定期把超过保留期的已结束任务（SUCCESS/FAILED）分批移到归档数据库，
+随后增量回收空闲页，使主库只保留近期任务，体积和索引深度不随历史数据增长。
+使用 PostgreSQL 存储时归档到同库的 generation_tasks_archive 表，空间回收交给 autovacuum。
+
+也可以在定时任务中单独执行一次：python -m api.retention
+
+增量回收要求主库为 auto_vacuum=INCREMENTAL。新建的数据库由连接池设置；改造前创建的数据库需要在停机维护时
+执行一次 python -m api.retention --enable-incremental-vacuum（完整 VACUUM，会重写整个文件并持有写锁），
+切换之前后台线程只归档、不回收空间。
+"""
+import os
+import time
+import logging
+import argparse
+import datetime
+import threading
+
+from .user_manager import UserManager
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 归档配置
+RETENTION_DAYS = float(os.environ.get('TASK_RETENTION_DAYS', '30'))  # 主库保留已结束任务的天数，0 表示不归档
+RETENTION_INTERVAL = float(os.environ.get('TASK_RETENTION_INTERVAL', '3600'))  # 两次归档之间的间隔（秒）
+RETENTION_BATCH = int(os.environ.get('TASK_RETENTION_BATCH', '500'))  # 每个事务移动的任务数，避免长时间持有写锁
+ARCHIVE_DB_PATH = os.environ.get('TASK_ARCHIVE_DB_PATH', 'soulmate_archive.db')  # 归档数据库路径
+VACUUM_PAGES = int(os.environ.get('TASK_RETENTION_VACUUM_PAGES', '2000'))  # 每轮最多回收的空闲页数
+
+# SQLite auto_vacuum=INCREMENTAL 对应的取值
+AUTO_VACUUM_INCREMENTAL = 2
+
+ARCHIVED_TASKS = REGISTRY.counter('soulmate_retention_archived_tasks_total', '移到归档数据库的生成任务数')
+
+
+class RetentionJob:
+    def __init__(self, retention_days=RETENTION_DAYS, interval=RETENTION_INTERVAL,
+                 batch_size=RETENTION_BATCH, archive_path=ARCHIVE_DB_PATH):
+        self.retention_days = retention_days
+        self.interval = max(1.0, interval)
+        self.batch_size = max(1, batch_size)
+        self.archive_path = archive_path
+        self._thread = None
+        self._lock = threading.Lock()
+        self._vacuum_warned = False
+
+    def start(self):
+        """启动后台归档线程，保留天数为 0 时不启动"""
+        if self.retention_days <= 0:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='task-retention')
+            self._thread.daemon = True
+            self._thread.start()
+        logger.info(f"任务归档已启动，保留 {self.retention_days:g} 天，每 {self.interval:g}s 执行一次")
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"任务归档失败: {str(e)}")
+
+    def run_once(self):
+        """
+        执行一轮归档并增量回收空闲页
+        :return: 本轮归档的任务数
+        """
+        cutoff = (datetime.datetime.now() - datetime.timedelta(days=self.retention_days)).strftime('%Y-%m-%d %H:%M:%S')
+        if UserManager.storage.name == 'postgres':
+            archived, freed = self._archive_postgres(cutoff), 0
+        else:
+            archived, freed = self._archive_sqlite(cutoff)
+
+        ARCHIVED_TASKS.inc(amount=archived)
+        if archived or freed:
+            logger.info(f"已归档 {archived} 个 {cutoff} 之前结束的任务，回收 {freed} 个空闲页")
+        return archived
+
+    def _archive_postgres(self, cutoff):
+        """每批在一条语句内删除并写入归档表，SKIP LOCKED 避免与其他实例的归档互相等待"""
+        archived = 0
+        while True:
+            with UserManager.get_db_cursor() as cursor:
+                cursor.execute('''
+                    WITH moved AS (
+                        DELETE FROM generation_tasks WHERE id IN (
+                            SELECT id FROM generation_tasks
+                            WHERE status IN ('SUCCESS', 'FAILED') AND created_at < ?
+                            ORDER BY created_at LIMIT ?
+                            FOR UPDATE SKIP LOCKED
+                        )
+                        RETURNING id, user_id, status, result, created_at, birth_date, birth_time, birth_place
+                    ), archived AS (
+                        INSERT INTO generation_tasks_archive
+                            (id, user_id, status, result, created_at, birth_date, birth_time, birth_place)
+                        SELECT id, user_id, status, result, created_at, birth_date, birth_time, birth_place FROM moved
+                        ON CONFLICT (id) DO NOTHING
+                    )
+                    SELECT COUNT(*) FROM moved
+                ''', (cutoff, self.batch_size))
+                moved = cursor.fetchone()[0]
+            archived += moved
+            if moved < self.batch_size:
+                return archived
+
+    def _archive_sqlite(self, cutoff):
+        """通过 ATTACH 把任务移到归档数据库文件，返回 (归档任务数, 回收页数)"""
+        conn = UserManager.storage.acquire()
+        try:
+            conn.execute('ATTACH DATABASE ? AS archive', (self.archive_path,))
+            try:
+                self._ensure_archive_table(conn)
+                archived = 0
+                while True:
+                    moved = self._archive_batch(conn, cutoff)
+                    archived += moved
+                    if moved < self.batch_size:
+                        break
+            finally:
+                conn.execute('DETACH DATABASE archive')
+            freed = self._incremental_vacuum(conn)
+        finally:
+            UserManager.storage.release(conn)
+        return archived, freed
+
+    @staticmethod
+    def _ensure_archive_table(conn):
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS archive.generation_tasks (
+                id TEXT PRIMARY KEY,
+                user_id TEXT,
+                status TEXT,
+                result TEXT,
+                created_at TIMESTAMP,
+                birth_date TEXT,
+                birth_time TEXT,
+                birth_place TEXT,
+                archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        conn.execute('CREATE INDEX IF NOT EXISTS archive.idx_archived_tasks_user ON generation_tasks (user_id, created_at)')
+        conn.commit()
+
+    def _archive_batch(self, conn, cutoff):
+        """在一个事务内复制并删除一批任务，返回移动的任务数"""
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            # 借助 (status, created_at) 索引按时间顺序取出最早的一批
+            rows = conn.execute('''
+                SELECT id FROM generation_tasks
+                WHERE status IN ('SUCCESS', 'FAILED') AND created_at < ?
+                ORDER BY created_at LIMIT ?
+            ''', (cutoff, self.batch_size)).fetchall()
+            if not rows:
+                conn.rollback()
+                return 0
+            task_ids = [row['id'] for row in rows]
+            placeholders = ','.join('?' * len(task_ids))
+            conn.execute(f'''
+                INSERT OR IGNORE INTO archive.generation_tasks
+                    (id, user_id, status, result, created_at, birth_date, birth_time, birth_place)
+                SELECT id, user_id, status, result, created_at, birth_date, birth_time, birth_place
+                FROM main.generation_tasks WHERE id IN ({placeholders})
+            ''', task_ids)
+            conn.execute(f'DELETE FROM main.generation_tasks WHERE id IN ({placeholders})', task_ids)
+            conn.commit()
+            return len(task_ids)
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _incremental_vacuum(self, conn):
+        """
+        回收主库的空闲页，返回回收的页数。
+        数据库尚未切换到增量回收模式时跳过：切换需要完整 VACUUM，不在服务进程内执行。
+        """
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != AUTO_VACUUM_INCREMENTAL:
+            if not self._vacuum_warned:
+                self._vacuum_warned = True
+                logger.warning("数据库尚未启用增量回收，跳过空间回收；"
+                               "请在停机维护时执行 python -m api.retention --enable-incremental-vacuum")
+            return 0
+
+        free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        if not free_pages:
+            return 0
+        # incremental_vacuum 每执行一步回收一页，execute 只执行一步，需用 executescript 执行到底
+        conn.executescript(f'PRAGMA incremental_vacuum({min(free_pages, VACUUM_PAGES)});')
+        return free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+
+
+def enable_incremental_vacuum(storage=None):
+    """
+    把已有的 SQLite 主库切换到增量回收模式：设置 auto_vacuum 后执行一次完整 VACUUM。
+    VACUUM 会重写整个数据库文件并在期间持有写锁，只应在停机维护时执行。
+    :return: 是否执行了切换（已是增量模式时返回 False）
+    """
+    storage = storage or UserManager.storage
+    if storage.name != 'sqlite':
+        raise ValueError('只有 SQLite 存储需要切换回收模式')
+    conn = storage.acquire()
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == AUTO_VACUUM_INCREMENTAL:
+            return False
+        conn.execute(f'PRAGMA auto_vacuum = {AUTO_VACUUM_INCREMENTAL}')
+        conn.execute('VACUUM')
+        return True
+    finally:
+        storage.release(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SoulMate 生成任务归档')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='把已有的 SQLite 主库切换到增量回收模式（完整 VACUUM，需停机执行），不执行归档')
+    args = parser.parse_args(argv)
+
+    if args.enable_incremental_vacuum:
+        started = time.perf_counter()
+        if enable_incremental_vacuum():
+            print(f"已切换到增量回收模式，耗时 {time.perf_counter() - started:.1f}s")
+        else:
+            print("数据库已是增量回收模式")
+        return
+    archived = RetentionJob().run_once()
+    print(f"已归档 {archived} 个任务")
+
+
+if __name__ == '__main__':
+    main()
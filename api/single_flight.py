@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+请求合并（single-flight）
+同一个键上并发发起的调用只执行一次，其余调用方挂在同一个进行中的调用上等待结果。
+"""
+import logging
+import threading
+from concurrent.futures import Future
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """
+        加入键对应的调用
+        :return: (future, leader)；leader 为 True 时调用方负责执行并调用 resolve 或 reject
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def resolve(self, key, result):
+        """调用成功，唤醒所有等待方"""
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is not None:
+            future.set_result(result)
+
+    def reject(self, key, error):
+        """调用失败，所有等待方收到同一个异常"""
+        with self._lock:
+            future = self._calls.pop(key, None)
+        if future is not None:
+            future.set_exception(error)
+
+    def do(self, key, fn, *args):
+        """
+        执行 fn(*args)，同一键上的并发调用共享一次执行的结果
+        :return: (结果, 是否由本次调用执行)
+        """
+        future, leader = self.acquire(key)
+        if not leader:
+            return future.result(), False
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.reject(key, e)
+            raise
+        self.resolve(key, result)
+        return result, True
+
+    def in_flight(self):
+        """进行中的调用数"""
+        with self._lock:
+            return len(self._calls)
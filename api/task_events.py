@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+任务状态通知
+生成任务状态变化时由工作线程发布，长轮询和 SSE 请求在这里等待，而不是反复查询数据库。
+通知只在进程内传递；多进程部署时等待会在超时后回退为重新查询数据库。
+"""
+import threading
+
+
+class TaskEventHub:
+    def __init__(self):
+        # 任务ID -> [等待该任务状态变化的 Event, 订阅者数]
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, task_id):
+        """
+        订阅任务的下一次状态变化，需在读取当前状态之前调用，避免错过通知；
+        等待结束后（无论是否收到通知）必须调用 unsubscribe
+        :return: threading.Event，状态变化时被置位
+        """
+        with self._lock:
+            entry = self._events.get(task_id)
+            if entry is None:
+                entry = self._events[task_id] = [threading.Event(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def unsubscribe(self, task_id, event):
+        """取消订阅；最后一个订阅者离开时移除该任务的 Event，不唤醒其他等待者"""
+        with self._lock:
+            entry = self._events.get(task_id)
+            # 已被 publish 移除，或换成了新的 Event
+            if entry is None or entry[0] is not event:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._events[task_id]
+
+    def publish(self, task_id):
+        """通知任务状态已变化"""
+        with self._lock:
+            entry = self._events.pop(task_id, None)
+        if entry is not None:
+            entry[0].set()
+
+    def waiting(self):
+        """有等待者的任务数"""
+        with self._lock:
+            return len(self._events)
+
+
+# 进程内共享的通知中心
+task_events = TaskEventHub()
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+生成任务队列
+任务持久化在 generation_tasks 表中（QUEUED → PROCESSING → SUCCESS/FAILED），
+由固定大小的工作线程池消费，队列满时拒绝新任务。
+后台线程定期恢复任务：中断的 PROCESSING 任务（如其他实例崩溃）重新排队，内存队列有空位时从数据库补充
+超过排队上限而未能入队的 QUEUED 任务。
+提交时提供了 callbackUrl 的任务，结束后由独立的回调线程池通知，失败时有限次重试。
+"""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .user_manager import UserManager
+from .task_events import task_events
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 任务状态
+STATUS_QUEUED = 'QUEUED'
+STATUS_PROCESSING = 'PROCESSING'
+STATUS_SUCCESS = 'SUCCESS'
+STATUS_FAILED = 'FAILED'
+
+# 队列配置
+WORKER_COUNT = int(os.environ.get('GENERATION_WORKERS', '4'))  # 工作线程数，负责组装提示词并提交上游任务
+MAX_PENDING = int(os.environ.get('GENERATION_QUEUE_MAX', '200'))  # 排队任务上限，超过后拒绝新任务
+MAX_RPS = float(os.environ.get('GENERATION_MAX_RPS', '0'))  # 每秒最多开始的任务数，0 表示不限制
+STALE_SECONDS = int(os.environ.get('GENERATION_STALE_SECONDS', '600'))  # PROCESSING 超过该时长视为中断
+RECOVER_INTERVAL = float(os.environ.get('GENERATION_RECOVER_INTERVAL', '60'))  # 恢复中断任务、补充队列的间隔（秒）
+
+# 任务回调配置
+CALLBACK_WORKERS = int(os.environ.get('TASK_CALLBACK_WORKERS', '2'))  # 发送回调的线程数
+CALLBACK_TIMEOUT = float(os.environ.get('TASK_CALLBACK_TIMEOUT', '5'))  # 单次回调请求超时（秒）
+CALLBACK_MAX_RETRIES = int(os.environ.get('TASK_CALLBACK_MAX_RETRIES', '3'))  # 连接失败、超时、429 和 5xx 最多重试次数
+CALLBACK_RETRY_BACKOFF = float(os.environ.get('TASK_CALLBACK_RETRY_BACKOFF', '1'))  # 首次重试前的平均等待（秒），之后每次翻倍
+
+TASK_CALLBACKS = REGISTRY.counter(
+    'soulmate_task_callbacks_total', '任务回调发送结果，result=ok/rejected/failed', ('result',))
+
+
+def _now(offset=0):
+    """任务表中时间列的格式，offset 为相对当前时间的秒数"""
+    return (datetime.datetime.now() + datetime.timedelta(seconds=offset)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class QueueFullError(Exception):
+    """队列已满，调用方应稍后重试"""
+
+    def __init__(self, retry_after):
+        super().__init__('生成队列已满')
+        self.retry_after = retry_after
+
+
+class TaskQueue:
+    def __init__(self, handler, workers=WORKER_COUNT, max_pending=MAX_PENDING, max_rps=MAX_RPS):
+        """
+        :param handler: 任务处理函数，接收任务字典，返回结果字典；抛出异常视为失败；
+                        返回 None 表示任务已交给异步流水线，由其稍后调用 complete 或 fail
+        :param workers: 工作线程数
+        :param max_pending: 排队任务上限
+        :param max_rps: 每秒最多开始的任务数，0 表示不限制
+        """
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.min_interval = 1.0 / max_rps if max_rps > 0 else 0
+        self._queue = queue.Queue(maxsize=self.max_pending)
+        # 已在内存队列中的任务ID，从数据库补充时跳过
+        self._queued_ids = set()
+        self._threads = []
+        self._active = 0
+        self._lock = threading.Lock()
+        self._next_start = 0.0
+        self._started = False
+
+    def start(self):
+        """恢复数据库中未完成的任务，启动工作线程和定期恢复线程"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        self._recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f'generation-worker-{i}')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if RECOVER_INTERVAL > 0:
+            thread = threading.Thread(target=self._recover_periodically, name='generation-recovery')
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"生成任务队列已启动，工作线程: {self.workers}，排队上限: {self.max_pending}")
+
+    def submit(self, task_id, user_id, birth_date, birth_time, birth_place, callback_url=None):
+        """
+        持久化并排队一个新任务
+        :raises QueueFullError: 队列已满
+        """
+        if self.full():
+            raise QueueFullError(self.retry_after())
+
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('''
+                INSERT INTO generation_tasks
+                    (id, user_id, status, birth_date, birth_time, birth_place, callback_url, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (task_id, user_id, STATUS_QUEUED, birth_date, birth_time, birth_place, callback_url, _now()))
+
+        if not self._enqueue(task_id):
+            # 并发提交时可能在检查之后才被占满，撤销刚写入的任务
+            with UserManager.get_db_cursor() as cursor:
+                cursor.execute('DELETE FROM generation_tasks WHERE id = ?', (task_id,))
+            raise QueueFullError(self.retry_after())
+
+    def full(self):
+        """排队任务是否已达上限"""
+        return self._queue.full()
+
+    def depth(self):
+        """当前排队中的任务数"""
+        return self._queue.qsize()
+
+    def active(self):
+        """当前正在处理的任务数"""
+        return self._active
+
+    def retry_after(self):
+        """根据排队长度估算客户端重试间隔（秒）"""
+        per_task = max(self.min_interval, 10.0 / self.workers)
+        return max(1, int(self.depth() * per_task / self.workers) + 1)
+
+    def _enqueue(self, task_id):
+        """放入内存队列，已在队列中时不重复放入；队列已满时返回 False"""
+        with self._lock:
+            if task_id in self._queued_ids:
+                return True
+            try:
+                self._queue.put_nowait(task_id)
+            except queue.Full:
+                return False
+            self._queued_ids.add(task_id)
+            return True
+
+    def _recover(self):
+        """
+        把领取后长时间未完成的 PROCESSING 任务改回 QUEUED，再按创建顺序用 QUEUED 任务填满内存队列的空位；
+        按领取时间而不是创建时间判断，排队较久的任务刚被其他实例领取时不会被重复执行
+        :return: 本次放入队列的任务数
+        """
+        stale_before = _now(-STALE_SECONDS)
+        with self._lock:
+            known = set(self._queued_ids)
+        room = self.max_pending - self._queue.qsize()
+        with UserManager.get_db_cursor() as cursor:
+            # 迁移前领取的任务没有 claimed_at，按创建时间判断
+            cursor.execute('''
+                UPDATE generation_tasks SET status = ?, claimed_at = NULL
+                WHERE status = ? AND COALESCE(claimed_at, created_at) < ?
+            ''', (STATUS_QUEUED, STATUS_PROCESSING, stale_before))
+            task_ids = []
+            if room > 0:
+                # 多取出已在队列中的数量，跳过它们之后仍能填满空位
+                cursor.execute('''
+                    SELECT id FROM generation_tasks WHERE status = ?
+                    ORDER BY created_at LIMIT ?
+                ''', (STATUS_QUEUED, room + len(known)))
+                task_ids = [row['id'] for row in cursor.fetchall() if row['id'] not in known]
+
+        recovered = 0
+        for task_id in task_ids:
+            if not self._enqueue(task_id):
+                break
+            recovered += 1
+        if recovered:
+            logger.info(f"已恢复 {recovered} 个未完成的生成任务")
+        return recovered
+
+    def _recover_periodically(self):
+        while True:
+            time.sleep(RECOVER_INTERVAL)
+            try:
+                self._recover()
+            except Exception as e:
+                logger.error(f"恢复生成任务失败: {str(e)}")
+
+    def _throttle(self):
+        """按 max_rps 限制任务开始的速率"""
+        if not self.min_interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start_at = max(now, self._next_start)
+            self._next_start = start_at + self.min_interval
+        if start_at > now:
+            time.sleep(start_at - now)
+
+    def _claim(self, task_id):
+        """
+        把任务从 QUEUED 置为 PROCESSING 并记录领取时间，返回任务数据；已被其他进程领取时返回 None
+        领取结束后才把任务ID移出 _queued_ids，取出队列到领取之间的任务不会被定期恢复重复放入
+        """
+        try:
+            with UserManager.get_db_cursor() as cursor:
+                # PostgreSQL 下附加 FOR UPDATE SKIP LOCKED，其他实例正在领取的任务直接跳过而不是等待行锁
+                cursor.execute(f'''
+                    UPDATE generation_tasks SET status = ?, claimed_at = ?
+                    WHERE id = (
+                        SELECT id FROM generation_tasks
+                        WHERE id = ? AND status = ? {UserManager.storage.skip_locked}
+                    )
+                    RETURNING id, user_id, birth_date, birth_time, birth_place, callback_url
+                ''', (STATUS_PROCESSING, _now(), task_id, STATUS_QUEUED))
+                row = cursor.fetchone()
+        finally:
+            with self._lock:
+                self._queued_ids.discard(task_id)
+        if row is None:
+            return None
+        task = dict(row)
+        task_events.publish(task_id)
+        return task
+
+    def complete(self, task, result, image_file=None):
+        """
+        标记任务成功、保存结果并发送回调
+        :param image_file: 结果引用的图像键，结果缓存淘汰时不会删除仍被任务引用的图像
+        """
+        # 结果只在这里序列化一次，读取时直接返回原始 JSON 文本
+        result_json = json.dumps(result, ensure_ascii=False)
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('''
+                UPDATE generation_tasks
+                SET status = ?, result = ?, image_file = ?
+                WHERE id = ?
+            ''', (STATUS_SUCCESS, result_json, image_file, task['id']))
+        logger.info(f"任务 {task['id']} 生成成功")
+        task_events.publish(task['id'])
+        self._send_callback(task.get('callback_url'), {
+            'task_id': task['id'],
+            'status': STATUS_SUCCESS,
+            'result': result
+        })
+
+    def fail(self, task, error):
+        """标记任务失败、保存错误信息、退还提交时扣减的机会并发送回调"""
+        logger.error(f"异步任务错误: {str(error)}")
+        with UserManager.get_db_cursor() as cursor:
+            # 只在第一次标记失败时退还，任务被重复处理时不会多退
+            cursor.execute('''
+                UPDATE generation_tasks
+                SET status = ?, result = ?
+                WHERE id = ? AND status <> ?
+                RETURNING user_id
+            ''', (STATUS_FAILED, json.dumps({'error': str(error)}, ensure_ascii=False), task['id'], STATUS_FAILED))
+            row = cursor.fetchone()
+            if row is not None and row['user_id']:
+                UserManager.add_chances(row['user_id'], 1, cursor)
+        task_events.publish(task['id'])
+        self._send_callback(task.get('callback_url'), {
+            'task_id': task['id'],
+            'status': STATUS_FAILED,
+            'error': str(error)
+        })
+
+    @staticmethod
+    def _send_callback(callback_url, body):
+        """如果提交时提供了回调URL，交给回调线程池发送任务完成通知，不占用完成任务的线程"""
+        if not callback_url:
+            return
+        _callback_executor().submit(deliver_callback, callback_url, body)
+
+    def _worker(self):
+        while True:
+            task_id = self._queue.get()
+            try:
+                task = self._claim(task_id)
+                if not task:
+                    continue
+
+                self._throttle()
+                with self._lock:
+                    self._active += 1
+                try:
+                    result = self.handler(task)
+                    if result is not None:
+                        self.complete(task, result)
+                except Exception as e:
+                    self.fail(task, e)
+                finally:
+                    with self._lock:
+                        self._active -= 1
+            except Exception as e:
+                logger.error(f"处理生成任务 {task_id} 失败: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+
+_callbacks = None
+_callbacks_lock = threading.Lock()
+
+
+def _callback_executor():
+    """进程内共享的回调线程池，第一次发送回调时创建"""
+    global _callbacks
+    if _callbacks is None:
+        with _callbacks_lock:
+            if _callbacks is None:
+                _callbacks = ThreadPoolExecutor(max_workers=max(1, CALLBACK_WORKERS), thread_name_prefix='task-callback')
+    return _callbacks
+
+
+def deliver_callback(callback_url, body, max_retries=CALLBACK_MAX_RETRIES, backoff=CALLBACK_RETRY_BACKOFF,
+                     timeout=CALLBACK_TIMEOUT):
+    """
+    发送任务回调；连接失败、超时、429 和 5xx 按带抖动的指数退避重试，其他 4xx 视为对方拒绝，不重试
+    :return: 是否送达
+    """
+    import requests
+
+    attempt = 0
+    while True:
+        try:
+            response = requests.post(callback_url, json=body, timeout=timeout)
+            if response.status_code < 400:
+                TASK_CALLBACKS.inc('ok')
+                return True
+            error = f'HTTP {response.status_code}'
+            retryable = response.status_code >= 500 or response.status_code == 429
+        except requests.RequestException as e:
+            error = str(e)
+            retryable = True
+        if not retryable or attempt >= max_retries:
+            TASK_CALLBACKS.inc('failed' if retryable else 'rejected')
+            logger.error(f"发送任务 {body.get('task_id')} 的回调失败: {error}")
+            return False
+        attempt += 1
+        # 全抖动：在 [0, backoff * 2^attempt) 内随机等待
+        delay = random.uniform(0, backoff * (2 ** attempt))
+        logger.warning(f"发送任务回调失败，{delay:.2f}s 后第 {attempt} 次重试: {error}")
+        time.sleep(delay)
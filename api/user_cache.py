@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+用户信息热缓存
+缓存 users 表中的单行（免费机会数、最后分享时间），首页和提交任务前的机会查询直接从内存返回。
+- memory（默认）：进程内 LRU，按 TTL 过期；多实例部署时其他实例的写入要等 TTL 过期后才可见
+- redis：Redis 协议的共享缓存，多实例之间一致，需安装 redis 包并设置 REDIS_URL
+- off：关闭缓存，每次都查数据库
+
+一致性约定（由 UserManager 保证）：
+- 读未命中时从数据库读取，用 add 写入——键已存在时不覆盖，避免用旧值覆盖写入方刚写入的新值
+- 分享、购买、扣减等写操作提交后用 set 写入 RETURNING 返回的新行；事务回滚时删除该键
+缓存读写失败只记录指标，调用方按未命中处理，不影响请求。
+"""
+import os
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from .metrics import REGISTRY
+
+# 配置日志
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 缓存配置
+USER_CACHE_BACKEND = os.environ.get('USER_CACHE_BACKEND', 'memory').lower()  # memory、redis 或 off
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', '30'))  # 缓存有效期（秒）
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', '10000'))  # memory 后端缓存的用户数上限
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')  # redis 后端的连接串
+REDIS_KEY_PREFIX = os.environ.get('USER_CACHE_KEY_PREFIX', 'soulmate:user:')  # redis 键前缀
+REDIS_TIMEOUT = float(os.environ.get('REDIS_TIMEOUT', '0.5'))  # redis 连接和读写超时（秒）
+
+USER_CACHE_REQUESTS = REGISTRY.counter(
+    'soulmate_user_cache_requests_total', '用户信息缓存查询数，result=hit/miss/error', ('result',))
+USER_CACHE_WRITES = REGISTRY.counter(
+    'soulmate_user_cache_writes_total', '用户信息缓存写入数，op=add/set/delete', ('op',))
+
+
+class MemoryUserCache:
+    """进程内 LRU 缓存，条目超过 TTL 视为不存在"""
+    name = 'memory'
+
+    def __init__(self, ttl=USER_CACHE_TTL, max_entries=USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        # 用户 ID -> (过期时间, 用户信息)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return dict(entry[1])
+
+    def add(self, user_id, user):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                return False
+            self._store(user_id, user, now)
+            return True
+
+    def set(self, user_id, user):
+        with self._lock:
+            self._store(user_id, user, time.monotonic())
+
+    def _store(self, user_id, user, now):
+        self._entries[user_id] = (now + self.ttl, dict(user))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def delete_many(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisUserCache:
+    """
+    Redis 协议的共享缓存，值为 JSON。
+    client 可以是任何兼容 redis-py 接口（get / set(ex, nx) / delete）的客户端，默认按 REDIS_URL 创建。
+    """
+    name = 'redis'
+
+    def __init__(self, url=REDIS_URL, ttl=USER_CACHE_TTL, prefix=REDIS_KEY_PREFIX, client=None):
+        self.url = url
+        self.ttl = max(1, int(ttl))
+        self.prefix = prefix
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    import redis
+                    self._client = redis.Redis.from_url(
+                        self.url, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT)
+        return self._client
+
+    def _key(self, user_id):
+        return f'{self.prefix}{user_id}'
+
+    def get(self, user_id):
+        value = self.client.get(self._key(user_id))
+        return json.loads(value) if value is not None else None
+
+    def add(self, user_id, user):
+        return bool(self.client.set(self._key(user_id), json.dumps(user, default=str), ex=self.ttl, nx=True))
+
+    def set(self, user_id, user):
+        self.client.set(self._key(user_id), json.dumps(user, default=str), ex=self.ttl)
+
+    def delete(self, user_id):
+        self.client.delete(self._key(user_id))
+
+    def delete_many(self, user_ids, batch=500):
+        # 每条 DEL 命令携带多个键，减少往返
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), batch):
+            self.client.delete(*[self._key(user_id) for user_id in user_ids[i:i + batch]])
+
+
+class NullUserCache:
+    """关闭缓存时使用，所有查询都未命中"""
+    name = 'off'
+
+    def get(self, user_id):
+        return None
+
+    def add(self, user_id, user):
+        return False
+
+    def set(self, user_id, user):
+        pass
+
+    def delete(self, user_id):
+        pass
+
+    def delete_many(self, user_ids):
+        pass
+
+
+class UserCache:
+    """包装具体后端：统计命中率，后端出错时记录日志并按未命中处理"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def name(self):
+        return self.backend.name
+
+    def get(self, user_id):
+        if self.backend.name == 'off':
+            return None
+        try:
+            user = self.backend.get(user_id)
+        except Exception as e:
+            USER_CACHE_REQUESTS.inc('error')
+            logger.warning(f"读取用户缓存失败: {str(e)}")
+            return None
+        USER_CACHE_REQUESTS.inc('hit' if user is not None else 'miss')
+        return user
+
+    def add(self, user_id, user):
+        self._write('add', user_id, user)
+
+    def set(self, user_id, user):
+        self._write('set', user_id, user)
+
+    def delete(self, user_id):
+        self._write('delete', user_id)
+
+    def delete_many(self, user_ids):
+        """批量删除，后端失败时等待 TTL 过期"""
+        if self.backend.name == 'off' or not user_ids:
+            return
+        try:
+            self.backend.delete_many(user_ids)
+            USER_CACHE_WRITES.inc('delete', amount=len(user_ids))
+        except Exception as e:
+            USER_CACHE_REQUESTS.inc('error')
+            logger.warning(f"批量删除用户缓存失败: {str(e)}")
+
+    def _write(self, op, user_id, *args):
+        if self.backend.name == 'off':
+            return
+        try:
+            getattr(self.backend, op)(user_id, *args)
+            USER_CACHE_WRITES.inc(op)
+        except Exception as e:
+            USER_CACHE_REQUESTS.inc('error')
+            logger.warning(f"写入用户缓存失败: {str(e)}")
+            if op == 'set':
+                # 新值写不进去时至少删掉旧值，删除也失败则等待 TTL 过期
+                try:
+                    self.backend.delete(user_id)
+                except Exception:
+                    pass
+
+
+def create_user_cache(backend=USER_CACHE_BACKEND):
+    """按配置创建用户缓存"""
+    if backend == 'redis':
+        logger.info("用户缓存使用 Redis")
+        return UserCache(RedisUserCache())
+    if backend == 'off':
+        return UserCache(NullUserCache())
+    if backend != 'memory':
+        raise ValueError(f'不支持的用户缓存后端: {backend}')
+    return UserCache(MemoryUserCache())
+
+
+# 进程内共享的用户缓存
+user_cache = create_user_cache()
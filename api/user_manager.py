@@ -1,59 +1,127 @@
-import sqlite3
 import time
 import logging
-from flask import g
+import threading
+from flask import g, has_app_context
 import contextlib
 
+from .storage import create_backend
+from .metrics import DB_QUERY_SECONDS, DB_ERRORS
+from .user_cache import user_cache
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 新用户默认的免费机会数
+DEFAULT_FREE_CHANCES = 1
+
+# 当前线程的事务中改动过的用户，最外层事务结束后再写入或删除缓存；
+# depth 为嵌套的 get_db_cursor 层数，rolled_back 记录内层是否回滚过
+_pending_cache_writes = threading.local()
+
 class UserManager:
+    # 进程内共享的存储后端（SQLite 或 PostgreSQL），请求处理线程和后台生成线程都从这里取连接
+    storage = create_backend()
+
     @staticmethod
     def get_db():
+        # 同一个应用上下文内复用一个连接，上下文结束时归还连接池
         db = getattr(g, '_database', None)
         if db is None:
-            db = g._database = sqlite3.connect('soulmate.db')
-            db.row_factory = sqlite3.Row
+            db = g._database = UserManager.storage.acquire()
         return db
 
+    @staticmethod
+    def close_db(exception=None):
+        db = g.pop('_database', None)
+        if db is not None:
+            UserManager.storage.release(db)
+
     @staticmethod
     @contextlib.contextmanager
     def get_db_cursor():
-        db = UserManager.get_db()
-        cursor = db.cursor()
+        # 没有应用上下文时（如后台线程）临时借用一个连接，用完立即归还
+        borrowed = not has_app_context()
+        db = UserManager.storage.acquire() if borrowed else UserManager.get_db()
+        cursor = UserManager.storage.cursor(db)
+        started = time.perf_counter()
+        outcome = 'commit'
+        _pending_cache_writes.depth = getattr(_pending_cache_writes, 'depth', 0) + 1
         try:
             yield cursor
             db.commit()
         except Exception as e:
+            outcome = 'rollback'
             db.rollback()
+            kind = UserManager.storage.error_kind(e)
+            if kind:
+                DB_ERRORS.inc(kind)
             raise e
         finally:
             cursor.close()
+            if borrowed:
+                UserManager.storage.release(db)
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started, outcome)
+            UserManager._exit_cache_scope(outcome == 'commit')
+
+    @staticmethod
+    def _exit_cache_scope(committed):
+        """
+        退出一层 get_db_cursor；嵌套时只在最外层结束后处理缓存，
+        避免内层提交时把外层尚未提交的改动写入缓存。任一层回滚都按回滚处理
+        """
+        if not committed:
+            _pending_cache_writes.rolled_back = True
+        _pending_cache_writes.depth -= 1
+        if _pending_cache_writes.depth > 0:
+            return
+        committed = not getattr(_pending_cache_writes, 'rolled_back', False)
+        _pending_cache_writes.rolled_back = False
+        UserManager._flush_cache_writes(committed)
+
+    @staticmethod
+    def _defer_cache_write(user_id, user):
+        """登记事务中改动的用户行，user 为 None 表示只需删除缓存"""
+        pending = getattr(_pending_cache_writes, 'users', None)
+        if pending is None:
+            pending = _pending_cache_writes.users = {}
+        pending[user_id] = user
+
+    @staticmethod
+    def _flush_cache_writes(committed):
+        """事务提交后写入新行，回滚时删除缓存，保证缓存里不会出现未提交的数据"""
+        pending = getattr(_pending_cache_writes, 'users', None)
+        if not pending:
+            return
+        _pending_cache_writes.users = {}
+        stale = []
+        for user_id, user in pending.items():
+            if committed and user is not None:
+                user_cache.set(user_id, user)
+            else:
+                stale.append(user_id)
+        user_cache.delete_many(stale)
 
     @staticmethod
     def init_db(app):
-        with app.app_context():
-            with UserManager.get_db_cursor() as cursor:
-                # 创建用户表
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS users (
-                        id TEXT PRIMARY KEY,
-                        free_chances INTEGER DEFAULT 1,
-                        last_shared_at TIMESTAMP,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
+        # 请求结束时归还连接；表结构由 migrations 模块创建
+        app.teardown_appcontext(UserManager.close_db)
 
     @staticmethod
     def get_user(user_id):
+        # 先查缓存，未命中时读库并回填；回填不覆盖写操作刚写入的新值
+        user = user_cache.get(user_id)
+        if user is not None:
+            return user
         try:
             with UserManager.get_db_cursor() as cursor:
                 cursor.execute('SELECT * FROM users WHERE id = ?', (user_id,))
                 user = cursor.fetchone()
-                if user:
-                    return dict(user)
-                return None
+            if user:
+                user = dict(user)
+                user_cache.add(user_id, user)
+                return user
+            return None
         except Exception as e:
             logger.error(f"获取用户信息失败: {str(e)}")
             return None
@@ -61,8 +129,8 @@ class UserManager:
     @staticmethod
     def create_user(user_id):
         try:
-            with UserManager.get_db_cursor() as cursor:
-                cursor.execute('INSERT INTO users (id, free_chances) VALUES (?, 1)', (user_id,))
+            UserManager._update_user(user_id, 'INSERT INTO users (id, free_chances) VALUES (?, ?) RETURNING *',
+                                     (user_id, DEFAULT_FREE_CHANCES))
             return True
         except Exception as e:
             logger.error(f"创建用户失败: {str(e)}")
@@ -71,8 +139,8 @@ class UserManager:
     @staticmethod
     def update_free_chances(user_id, chances):
         try:
-            with UserManager.get_db_cursor() as cursor:
-                cursor.execute('UPDATE users SET free_chances = ? WHERE id = ?', (chances, user_id))
+            UserManager._update_user(user_id, 'UPDATE users SET free_chances = ? WHERE id = ? RETURNING *',
+                                     (chances, user_id))
             return True
         except Exception as e:
             logger.error(f"更新免费次数失败: {str(e)}")
@@ -81,9 +149,105 @@ class UserManager:
     @staticmethod
     def update_last_shared(user_id):
         try:
-            with UserManager.get_db_cursor() as cursor:
-                cursor.execute('UPDATE users SET last_shared_at = ? WHERE id = ?', (time.time(), user_id))
+            UserManager._update_user(user_id, 'UPDATE users SET last_shared_at = ? WHERE id = ? RETURNING *',
+                                     (time.time(), user_id))
             return True
         except Exception as e:
             logger.error(f"更新最后分享时间失败: {str(e)}")
-            return False
\ No newline at end of file
+            return False
+
+    # ------------------------------------------------------------------
+    # 机会账本：每次增减都是一条带条件的 SQL，避免“读-改-写”丢失更新
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _update_user(user_id, sql, params, cursor=None):
+        """
+        执行 RETURNING * 的用户写语句，事务提交后把返回的新行写入缓存；传入 cursor 时加入调用方的事务
+        :return: 写入后的用户行；没有行被改动时返回 None
+        """
+        if cursor is not None:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+            user = dict(row) if row else None
+            UserManager._defer_cache_write(user_id, user)
+            return user
+        with UserManager.get_db_cursor() as cursor:
+            return UserManager._update_user(user_id, sql, params, cursor)
+
+    @staticmethod
+    def _update_chances(user_id, sql, params, cursor=None):
+        """执行机会增减语句，返回写入后的机会数"""
+        user = UserManager._update_user(user_id, sql, params, cursor)
+        return user['free_chances'] if user else None
+
+    @staticmethod
+    def consume_chance(user_id, cursor=None):
+        """
+        扣减一次免费机会，用户不存在时按默认机会数创建后再扣减
+        :return: 扣减后剩余的机会数；没有可用机会时返回 None
+        """
+        return UserManager._update_chances(user_id, '''
+            INSERT INTO users (id, free_chances) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET free_chances = users.free_chances - 1
+            WHERE users.free_chances > 0
+            RETURNING *
+        ''', (user_id, DEFAULT_FREE_CHANCES - 1), cursor)
+
+    @staticmethod
+    def add_chances(user_id, chances, cursor=None):
+        """
+        增加免费机会，用户不存在时按默认机会数创建后再增加
+        :return: 增加后的机会数
+        """
+        return UserManager._update_chances(user_id, '''
+            INSERT INTO users (id, free_chances) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET free_chances = users.free_chances + ?
+            RETURNING *
+        ''', (user_id, DEFAULT_FREE_CHANCES + chances, chances), cursor)
+
+    @staticmethod
+    def record_share(user_id, cursor=None):
+        """
+        记录分享时间并奖励一次机会
+        :return: 奖励后的机会数；用户不存在时返回 None
+        """
+        return UserManager._update_chances(user_id, '''
+            UPDATE users SET free_chances = free_chances + 1, last_shared_at = ?
+            WHERE id = ?
+            RETURNING *
+        ''', (time.time(), user_id), cursor)
+
+    # ------------------------------------------------------------------
+    # 批量操作：供运营批量发放和查询使用，调用方负责分批
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def add_chances_many(user_ids, chances, cursor=None):
+        """
+        在一个事务内为一批用户增加免费机会，用户不存在时按默认机会数创建；提交后删除这些用户的缓存
+        :return: 处理的用户数
+        """
+        if cursor is None:
+            with UserManager.get_db_cursor() as cursor:
+                return UserManager.add_chances_many(user_ids, chances, cursor)
+        cursor.executemany('''
+            INSERT INTO users (id, free_chances) VALUES (?, ?)
+            ON CONFLICT(id) DO UPDATE SET free_chances = users.free_chances + ?
+        ''', [(user_id, DEFAULT_FREE_CHANCES + chances, chances) for user_id in user_ids])
+        for user_id in user_ids:
+            UserManager._defer_cache_write(user_id, None)
+        return len(user_ids)
+
+    @staticmethod
+    def get_users(user_ids):
+        """
+        批量查询用户（直接读库，不经过缓存）
+        :return: {用户ID: 用户信息}，不存在的用户不在结果中
+        """
+        if not user_ids:
+            return {}
+        placeholders = ','.join('?' * len(user_ids))
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute(f'SELECT * FROM users WHERE id IN ({placeholders})', tuple(user_ids))
+            return {row['id']: dict(row) for row in cursor.fetchall()}
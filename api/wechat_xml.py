@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付 XML 编解码与签名
+- to_xml：一次拼接生成请求报文，字符串值放在 CDATA 中，值里的 "]]>" 会被拆开转义
+- parse_xml：用 expat 解析回调报文，拒绝超长报文、DTD/实体声明和嵌套元素，杜绝实体膨胀攻击；
+  DTD 由解析器本身拒绝，与报文编码（UTF-8、UTF-16 等）无关
+- sign / verify_sign：按微信规则签名（跳过空值和 sign 字段），验签使用常量时间比较
+"""
+import os
+import re
+import hmac
+import hashlib
+import functools
+
+# 报文大小上限（字节），微信支付的通知和应答都远小于这个值
+MAX_XML_BYTES = int(os.environ.get('WECHAT_XML_MAX_BYTES', str(64 * 1024)))
+
+SIGN_TYPE_MD5 = 'MD5'
+SIGN_TYPE_HMAC_SHA256 = 'HMAC-SHA256'
+
+_TAG_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+class XMLCodecError(ValueError):
+    """报文格式不合法、超长或包含不允许的结构"""
+
+
+# 已校验过的字段名，序列化时每个字段名只做一次正则校验
+_valid_tags = set()
+
+
+def _check_tag(name):
+    if not _TAG_PATTERN.match(name):
+        raise XMLCodecError(f'非法的字段名: {name!r}')
+    _valid_tags.add(name)
+
+
+def to_xml(params):
+    """把扁平字典序列化为微信支付报文，整数原样输出，其他值放入 CDATA，值为 None 的字段省略"""
+    parts = ['<xml>']
+    append = parts.append
+    for key, value in params.items():
+        if value is None:
+            continue
+        if key not in _valid_tags:
+            _check_tag(key)
+        if value.__class__ is int:
+            append(f'<{key}>{value}</{key}>')
+            continue
+        if value.__class__ is not str:
+            value = str(value)
+        if ']]>' in value:
+            value = value.replace(']]>', ']]]]><![CDATA[>')
+        append(f'<{key}><![CDATA[{value}]]></{key}>')
+    append('</xml>')
+    return ''.join(parts)
+
+
+def _reject_dtd(*args):
+    """DTD、实体声明和外部实体引用的处理函数：一律拒绝"""
+    raise XMLCodecError('报文不允许包含 DTD 或实体声明')
+
+
+def parse_xml(data, max_bytes=MAX_XML_BYTES):
+    """
+    解析微信支付报文为扁平字典
+    :param data: bytes 或 str
+    :raises XMLCodecError: 报文超长、格式错误、包含 DTD/实体声明或嵌套元素
+    """
+    # expat 只在支付接口用到，按需导入
+    from xml.parsers import expat
+
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    if len(data) > max_bytes:
+        raise XMLCodecError(f'报文超过 {max_bytes} 字节')
+
+    parser = expat.ParserCreate()
+    # 实体只能在 DTD 中声明：解析器遇到 DTD 即报错，未声明的实体引用本身就是格式错误
+    parser.SetParamEntityParsing(expat.XML_PARAM_ENTITY_PARSING_NEVER)
+    parser.StartDoctypeDeclHandler = _reject_dtd
+    parser.EntityDeclHandler = _reject_dtd
+    parser.ExternalEntityRefHandler = _reject_dtd
+    parser.buffer_text = True
+
+    result = {}
+    stack = []
+    text = []
+
+    def start_element(tag, attrs):
+        if not stack:
+            if tag != 'xml':
+                raise XMLCodecError(f'根元素应为 xml，实际为 {tag}')
+        elif len(stack) > 1:
+            raise XMLCodecError('报文不允许嵌套元素')
+        stack.append(tag)
+        text.clear()
+
+    def end_element(tag):
+        stack.pop()
+        if len(stack) == 1:
+            if tag in result:
+                raise XMLCodecError('报文包含重复字段')
+            result[tag] = ''.join(text)
+
+    def character_data(data):
+        if len(stack) == 2:
+            text.append(data)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.CharacterDataHandler = character_data
+    try:
+        parser.Parse(data, True)
+    except XMLCodecError:
+        raise
+    except (expat.ExpatError, ValueError) as e:
+        # ValueError：声明了 expat 不支持的编码（如不带 BOM 的 UTF-16LE）
+        raise XMLCodecError(f'报文格式错误: {str(e)}') from e
+    return result
+
+
+@functools.lru_cache(maxsize=64)
+def _sign_order(keys):
+    """签名时的参数顺序；同一接口的字段集合固定，排序结果按字段元组缓存"""
+    return tuple(key for key in sorted(keys) if key != 'sign')
+
+
+def sign(params, api_key, sign_type=SIGN_TYPE_MD5):
+    """按参数名 ASCII 码排序拼接非空参数（不含 sign）后签名，返回大写十六进制"""
+    message = '&'.join([f'{key}={value}' for key in _sign_order(tuple(params))
+                        if (value := params[key]) != '' and value is not None])
+    message = f'{message}&key={api_key}'.encode('utf-8')
+    if sign_type == SIGN_TYPE_HMAC_SHA256:
+        return hmac.new(api_key.encode('utf-8'), message, hashlib.sha256).hexdigest().upper()
+    return hashlib.md5(message).hexdigest().upper()
+
+
+def verify_sign(params, api_key):
+    """校验报文中的 sign 字段，签名方式取报文的 sign_type（默认 MD5）"""
+    given = params.get('sign')
+    if not given:
+        return False
+    expected = sign(params, api_key, params.get('sign_type') or SIGN_TYPE_MD5)
+    return hmac.compare_digest(expected.encode('ascii'), given.encode('utf-8', 'replace'))
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+"""压测工具及上游服务替身"""
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+本地 DashScope 图像合成替身
+实现 ImageSynthesis.async_call / fetch（以及基于二者的 call）用到的 HTTP 接口和图像下载地址，
+生成耗时、失败率和限流比例可配置，用于压测时替代真实上游。
+
+将环境变量 DASHSCOPE_HTTP_BASE_URL 指向 base_url 即可让 dashscope SDK 访问本服务。
+"""
+import io
+import json
+import time
+import random
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 图像合成提交接口路径（dashscope SDK 按 task_group/task/function 拼接）
+SYNTHESIS_PATH = '/api/v1/services/aigc/text2image/image-synthesis'
+TASKS_PREFIX = '/api/v1/tasks/'
+IMAGES_PREFIX = '/images/'
+
+
+def synthetic_png(target, size=1024):
+    """合成测试图：径向渐变叠加高斯噪点，模拟照片的高频细节；target 为路径或文件对象"""
+    from PIL import Image, ImageChops, ImageFilter
+    gradient = Image.radial_gradient('L').resize((size, size))
+    base = Image.merge('RGB', (gradient, gradient.rotate(90), gradient.rotate(180)))
+    noise = Image.effect_noise((size, size), 48).filter(ImageFilter.GaussianBlur(1))
+    image = ImageChops.add(base, Image.merge('RGB', (noise, noise, noise)), scale=1.4)
+    image.save(target, 'PNG')
+
+
+class FakeDashScope:
+    def __init__(self, host='127.0.0.1', port=0, latency=3.0, jitter=0.5,
+                 failure_rate=0.0, throttle_rate=0.0, image_bytes=256 * 1024, real_image=False):
+        """
+        :param latency: 上游任务从提交到完成的平均耗时（秒）
+        :param jitter: 耗时的随机浮动比例，0.5 表示 ±50%
+        :param failure_rate: 任务最终状态为 FAILED 的比例
+        :param throttle_rate: 提交时直接返回 429 Throttling 的比例
+        :param image_bytes: 下载图像的大小
+        :param real_image: 返回可解码的 1024×1024 PNG（需要 Pillow），此时忽略 image_bytes
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.throttle_rate = throttle_rate
+        if real_image:
+            buffer = io.BytesIO()
+            synthetic_png(buffer)
+            self.image = buffer.getvalue()
+        else:
+            self.image = b'\x89PNG\r\n\x1a\n' + bytes(max(0, image_bytes - 8))
+        # 上游任务ID -> (完成时间, 是否失败)
+        self.tasks = {}
+        self.stats = {'submitted': 0, 'throttled': 0, 'fetched': 0, 'downloaded': 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def root_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def base_url(self):
+        """供 DASHSCOPE_HTTP_BASE_URL 使用的接口根地址"""
+        return self.root_url + '/api/v1'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-dashscope')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def create_task(self):
+        """登记一个新上游任务，返回 (状态码, 响应体)"""
+        if random.random() < self.throttle_rate:
+            self._count('throttled')
+            return 429, {'request_id': uuid.uuid4().hex, 'code': 'Throttling.RateQuota',
+                         'message': 'Requests rate limit exceeded, please try again later.'}
+
+        task_id = uuid.uuid4().hex
+        duration = self.latency * (1 + random.uniform(-self.jitter, self.jitter))
+        with self._lock:
+            self.tasks[task_id] = (time.monotonic() + max(0.0, duration), random.random() < self.failure_rate)
+            self.stats['submitted'] += 1
+        return 200, {'request_id': uuid.uuid4().hex,
+                     'output': {'task_id': task_id, 'task_status': 'PENDING'}}
+
+    def task_status(self, task_id):
+        """查询上游任务，返回 (状态码, 响应体)"""
+        self._count('fetched')
+        with self._lock:
+            task = self.tasks.get(task_id)
+        if task is None:
+            return 200, {'request_id': uuid.uuid4().hex,
+                         'output': {'task_id': task_id, 'task_status': 'UNKNOWN'}}
+
+        ready_at, failed = task
+        if time.monotonic() < ready_at:
+            return 200, {'request_id': uuid.uuid4().hex,
+                         'output': {'task_id': task_id, 'task_status': 'RUNNING'}}
+        if failed:
+            return 200, {'request_id': uuid.uuid4().hex,
+                         'output': {'task_id': task_id, 'task_status': 'FAILED',
+                                    'code': 'InternalError', 'message': 'fake failure'}}
+        return 200, {'request_id': uuid.uuid4().hex,
+                     'output': {'task_id': task_id, 'task_status': 'SUCCEEDED',
+                                'results': [{'url': f'{self.root_url}{IMAGES_PREFIX}{task_id}.png'}]},
+                     'usage': {'image_count': 1}}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                if self.path.split('?')[0] != SYNTHESIS_PATH:
+                    self._send_json(404, {'code': 'NotFound', 'message': self.path})
+                    return
+                self._send_json(*fake.create_task())
+
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path.startswith(TASKS_PREFIX):
+                    self._send_json(*fake.task_status(path[len(TASKS_PREFIX):]))
+                elif path.startswith(IMAGES_PREFIX):
+                    fake._count('downloaded')
+                    # 末尾附上任务ID，每个任务的图像内容不同（解码时忽略 IEND 之后的数据）
+                    image = fake.image + path[len(IMAGES_PREFIX):].encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/png')
+                    self.send_header('Content-Length', str(len(image)))
+                    self.end_headers()
+                    self.wfile.write(image)
+                else:
+                    self._send_json(404, {'code': 'NotFound', 'message': self.path})
+
+        return Handler
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+本地微信支付统一下单替身
+实现 /pay/unifiedorder：校验签名后返回带 prepay_id 的 XML，响应耗时和失败率可配置。
+同时提供 notify_xml，按微信规则生成已签名的支付结果通知，用于压测支付回调接口。
+
+将环境变量 WECHAT_UNIFIEDORDER_URL 指向 unifiedorder_url 即可让应用访问本服务。
+"""
+import time
+import random
+import hashlib
+import threading
+import uuid
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+UNIFIEDORDER_PATH = '/pay/unifiedorder'
+
+
+def sign(params, api_key):
+    """微信支付 MD5 签名：去掉空值和 sign 字段，按参数名排序拼接后追加 key"""
+    items = sorted((k, v) for k, v in params.items() if k != 'sign' and v not in (None, ''))
+    sign_str = '&'.join(f'{k}={v}' for k, v in items) + f'&key={api_key}'
+    return hashlib.md5(sign_str.encode('utf-8')).hexdigest().upper()
+
+
+def to_xml(params):
+    return '<xml>' + ''.join(f'<{k}><![CDATA[{v}]]></{k}>' for k, v in params.items()) + '</xml>'
+
+
+def notify_xml(out_trade_no, total_fee, api_key, app_id='', mch_id='', success=True):
+    """生成一条已签名的支付结果通知"""
+    params = {
+        'appid': app_id,
+        'mch_id': mch_id,
+        'nonce_str': uuid.uuid4().hex,
+        'return_code': 'SUCCESS',
+        'result_code': 'SUCCESS' if success else 'FAIL',
+        'out_trade_no': out_trade_no,
+        'transaction_id': uuid.uuid4().hex,
+        'total_fee': str(total_fee),
+        'time_end': time.strftime('%Y%m%d%H%M%S'),
+    }
+    if not success:
+        params['err_code'] = 'NOTENOUGH'
+        params['err_code_des'] = '余额不足'
+    params['sign'] = sign(params, api_key)
+    return to_xml(params)
+
+
+class FakeWeChatPay:
+    def __init__(self, api_key, host='127.0.0.1', port=0, latency=0.05, failure_rate=0.0, error_rate=0.0):
+        """
+        :param api_key: 与应用 WECHAT_API_KEY 相同的密钥，用于校验和生成签名
+        :param latency: 统一下单的响应耗时（秒），运行中可修改以模拟网关变慢
+        :param failure_rate: 返回 result_code=FAIL 的比例
+        :param error_rate: 返回 HTTP 500 的比例，运行中可修改以模拟网关故障
+        """
+        self.api_key = api_key
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.stats = {'orders': 0, 'failed': 0, 'bad_sign': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def unifiedorder_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}{UNIFIEDORDER_PATH}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-wechat')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def unifiedorder(self, body):
+        """处理一次统一下单请求，返回响应参数"""
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            request = {child.tag: child.text or '' for child in ET.fromstring(body)}
+        except ET.ParseError:
+            return {'return_code': 'FAIL', 'return_msg': 'XML格式错误'}
+
+        if request.get('sign') != sign(request, self.api_key):
+            with self._lock:
+                self.stats['bad_sign'] += 1
+            return {'return_code': 'FAIL', 'return_msg': '签名错误'}
+
+        response = {
+            'return_code': 'SUCCESS',
+            'return_msg': 'OK',
+            'appid': request.get('appid', ''),
+            'mch_id': request.get('mch_id', ''),
+            'nonce_str': uuid.uuid4().hex,
+        }
+        with self._lock:
+            self.stats['orders'] += 1
+            failed = random.random() < self.failure_rate
+            if failed:
+                self.stats['failed'] += 1
+        if failed:
+            response.update({'result_code': 'FAIL', 'err_code': 'SYSTEMERROR', 'err_code_des': '系统错误'})
+        else:
+            response.update({'result_code': 'SUCCESS', 'trade_type': request.get('trade_type', 'JSAPI'),
+                             'prepay_id': 'wx' + uuid.uuid4().hex})
+        response['sign'] = sign(response, self.api_key)
+        return response
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length)
+                if self.path.split('?')[0] != UNIFIEDORDER_PATH:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if random.random() < fake.error_rate:
+                    with fake._lock:
+                        fake.stats['errors'] += 1
+                    self.send_response(500)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                data = to_xml(fake.unifiedorder(body)).encode('utf-8')
+                try:
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/xml; charset=utf-8')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # 客户端已超时断开
+                    self.close_connection = True
+
+        return Handler
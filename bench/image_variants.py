@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+图像变体基准
+对一张 1024×1024 的原图生成 thumb / preview / full 变体，报告各档字节数、相对原图的比例和生成耗时。
+不指定 --image 时合成一张带渐变和噪点的 PNG，体积与上游返回的图像相近。
+
+用法:
+    python -m bench.image_variants
+    python -m bench.image_variants --image sample.png --formats webp,jpeg --rounds 5
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from api.image_store import ImageStore, LocalImageStore
+from api.image_variants import ImageVariants
+from bench.fake_dashscope import synthetic_png
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='图像变体基准')
+    parser.add_argument('--image', help='原图路径，默认合成一张 1024×1024 的 PNG')
+    parser.add_argument('--formats', default='webp,jpeg', help='逗号分隔的格式')
+    parser.add_argument('--workers', type=int, default=1, help='进程数，0 表示在当前线程内编码')
+    parser.add_argument('--rounds', type=int, default=3, help='重复生成的次数，取中位数')
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp(prefix='soulmate-variants-')
+    try:
+        source = os.path.join(work_dir, 'source' + (os.path.splitext(args.image)[1] if args.image else '.png'))
+        if args.image:
+            shutil.copy(args.image, source)
+        else:
+            synthetic_png(source)
+        file_name = os.path.basename(source)
+
+        variants = ImageVariants(store=ImageStore(LocalImageStore(work_dir)), formats=args.formats,
+                                 workers=args.workers, timeout=60)
+        timings = []
+        manifest = None
+        for _ in range(max(1, args.rounds)):
+            variants.remove(file_name)
+            started = time.perf_counter()
+            manifest = variants.ensure(file_name)
+            timings.append(time.perf_counter() - started)
+        variants.shutdown()
+        if manifest is None:
+            print('生成变体失败', file=sys.stderr)
+            return 1
+
+        first, timings = timings[0], sorted(timings)
+        source_bytes = manifest['source_bytes']
+        print(f"原图 {file_name}: {source_bytes / 1024:.1f} KB")
+        print(f"{'variant':<10} {'format':<6} {'size':>10} {'KB':>9} {'ratio':>7}")
+        for v in manifest['variants']:
+            print(f"{v['name']:<10} {v['format']:<6} {v['width']:>4}x{v['height']:<5} "
+                  f"{v['bytes'] / 1024:>9.1f} {v['bytes'] / source_bytes:>6.1%}")
+        print(f"生成耗时中位数 {timings[len(timings) // 2] * 1000:.0f} ms，首轮（含工作进程启动）{first * 1000:.0f} ms")
+
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump({'manifest': manifest, 'seconds': timings}, f, ensure_ascii=False, indent=2)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
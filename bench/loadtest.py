@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+"""
+压测工具
+在本进程内启动 api/index.py 中的 Flask 应用，上游图像合成和微信统一下单分别由本地替身代替，
+按指定并发和流量配比发送 提交/状态/结果/分享/支付 请求，最后输出吞吐量、p50/p95/p99 延迟和 数据库锁错误数。
+
+用法:
+    python -m bench.loadtest --duration 30 --concurrency 32
+    python -m bench.loadtest --mix submit=40,status=40,payment=20 --upstream-latency 8 --json report.json
+
+数据库和生成图像写入临时目录，不会影响仓库中的 soulmate.db。
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from bench.fake_dashscope import FakeDashScope
+from bench.fake_wechat import FakeWeChatPay, notify_xml
+
+# 默认流量配比（权重）
+DEFAULT_MIX = 'submit=20,status=35,result=25,share=10,payment=10,user=30'
+OPERATIONS = ('submit', 'status', 'result', 'share', 'payment', 'user')
+
+# 压测使用的微信支付配置
+BENCH_APP_ID = 'bench-app-id'
+BENCH_MCH_ID = 'bench-mch-id'
+BENCH_API_KEY = 'bench-api-key'
+
+BIRTH_PLACES = ['北京', '上海', '广州', '深圳', '杭州', '成都', '西安', '南京', '武汉', '重庆']
+
+
+def parse_mix(text):
+    """解析 'submit=20,status=35' 形式的流量配比"""
+    weights = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f'未知操作: {name}，可选: {", ".join(OPERATIONS)}')
+        weights[name] = float(weight or 1)
+    if not any(weights.values()):
+        raise argparse.ArgumentTypeError('流量配比不能全为 0')
+    return weights
+
+
+def percentile(sorted_values, p):
+    """最近秩百分位数"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def parse_metric(text, name, labels=''):
+    """从 Prometheus 文本中取出指定样本的值，不存在时返回 0"""
+    prefix = name + labels + ' '
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0.0
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.operations = list(args.mix.keys())
+        self.weights = [args.mix[name] for name in self.operations]
+        self.user_ids = [f'bench_user_{i}' for i in range(args.users)]
+        self.profiles = [self._random_profile() for _ in range(args.profiles)]
+        # 已提交的任务ID列表，以及任务ID -> 最近一次拿到的 ETag
+        self.task_ids = []
+        self.etags = {}
+        self.tasks_lock = threading.Lock()
+        # 操作名 -> 延迟列表 / 状态码计数
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(Counter)
+        self.errors = Counter()
+        self.record_lock = threading.Lock()
+        self.local = threading.local()
+
+    @staticmethod
+    def _random_profile():
+        return {
+            'birthDate': f'{random.randint(1980, 2005)}-{random.randint(1, 12):02d}-{random.randint(1, 28):02d}',
+            'birthTime': f'{random.randint(0, 23):02d}:{random.randint(0, 59):02d}',
+            'birthPlace': random.choice(BIRTH_PLACES),
+        }
+
+    # ------------------------------------------------------------------
+    # 环境准备
+    # ------------------------------------------------------------------
+
+    def setup(self):
+        args = self.args
+        self.workdir = tempfile.mkdtemp(prefix='soulmate-bench-')
+        images_dir = os.path.join(self.workdir, 'generated_images')
+        os.makedirs(images_dir)
+
+        self.dashscope = FakeDashScope(latency=args.upstream_latency, jitter=args.upstream_jitter,
+                                       failure_rate=args.upstream_failure_rate,
+                                       throttle_rate=args.upstream_throttle_rate,
+                                       image_bytes=args.image_bytes, real_image=args.image_variants).start()
+        self.wechat = FakeWeChatPay(BENCH_API_KEY, latency=args.pay_latency,
+                                    failure_rate=args.pay_failure_rate, error_rate=args.pay_error_rate).start()
+
+        # 应用在导入时读取配置，必须先设置环境变量再导入
+        os.environ.update({
+            'SOULMATE_DB_PATH': os.path.join(self.workdir, 'soulmate.db'),
+            'GENERATED_IMAGES_DIR': images_dir,
+            'DASHSCOPE_API_KEY': 'bench',
+            'USE_MOCK': 'false',
+            'DASHSCOPE_HTTP_BASE_URL': self.dashscope.base_url,
+            'WECHAT_APP_ID': BENCH_APP_ID,
+            'WECHAT_MCH_ID': BENCH_MCH_ID,
+            'WECHAT_API_KEY': BENCH_API_KEY,
+            'WECHAT_UNIFIEDORDER_URL': self.wechat.unifiedorder_url,
+        })
+        if args.database_url:
+            # 压测 PostgreSQL 后端，应指向一次性的测试库
+            os.environ.update({'STORAGE_BACKEND': 'postgres', 'DATABASE_URL': args.database_url})
+        # 所有虚拟用户来自同一地址，默认关闭限流；--rate-limit 时保留限流以观察 429 比例
+        if not args.rate_limit:
+            os.environ['RATE_LIMIT_BACKEND'] = 'off'
+        # 默认的上游图像不是可解码的 PNG，只有 --image-variants 时才生成变体
+        if not args.image_variants:
+            os.environ['IMAGE_VARIANTS'] = 'false'
+        from werkzeug.serving import make_server
+        from api.index import app, start_background_services
+        from api.user_manager import UserManager
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.ERROR)
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+        # 后台服务默认在首个请求时启动，这里提前启动以便先建表并预置用户
+        start_background_services()
+        for user_id in self.user_ids:
+            UserManager.add_chances(user_id, args.initial_chances)
+
+        self.server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        thread = threading.Thread(target=self.server.serve_forever, name='bench-app')
+        thread.daemon = True
+        thread.start()
+
+    def teardown(self):
+        self.server.shutdown()
+        self.dashscope.stop()
+        self.wechat.stop()
+        if not self.args.keep:
+            import shutil
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # ------------------------------------------------------------------
+    # 请求
+    # ------------------------------------------------------------------
+
+    def session(self):
+        """每个压测线程一个 keep-alive 会话"""
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            import requests
+            session = self.local.session = requests.Session()
+        return session
+
+    def request(self, operation, method, path, **kwargs):
+        """发送请求并记录延迟和状态码，返回响应；连接错误时返回 None"""
+        started = time.perf_counter()
+        try:
+            response = self.session().request(method, self.base_url + path, timeout=self.args.timeout, **kwargs)
+        except Exception as e:
+            elapsed = time.perf_counter() - started
+            with self.record_lock:
+                self.latencies[operation].append(elapsed)
+                self.codes[operation]['error'] += 1
+                self.errors[type(e).__name__] += 1
+            return None
+        elapsed = time.perf_counter() - started
+        with self.record_lock:
+            self.latencies[operation].append(elapsed)
+            self.codes[operation][response.status_code] += 1
+        return response
+
+    def random_task(self):
+        with self.tasks_lock:
+            if not self.task_ids:
+                return None, None
+            task_id = random.choice(self.task_ids)
+            return task_id, self.etags.get(task_id)
+
+    def op_submit(self):
+        body = dict(random.choice(self.profiles), userId=random.choice(self.user_ids))
+        response = self.request('submit', 'POST', '/api/v1/generate/submit', json=body)
+        if response is not None and response.status_code == 200:
+            with self.tasks_lock:
+                self.task_ids.append(response.json()['taskId'])
+
+    def op_status(self):
+        task_id, _ = self.random_task()
+        if task_id is None:
+            return self.op_submit()
+        self.request('status', 'GET', f'/api/v1/generate/status/{task_id}')
+
+    def op_result(self):
+        # 模拟浏览器：拿到过 ETag 的结果带 If-None-Match 重新验证
+        task_id, etag = self.random_task()
+        if task_id is None:
+            return self.op_submit()
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.request('result', 'GET', f'/api/v1/tasks/{task_id}', headers=headers)
+        if response is not None and response.headers.get('ETag'):
+            with self.tasks_lock:
+                self.etags[task_id] = response.headers['ETag']
+
+    def op_user(self):
+        # 首页加载时查询剩余机会
+        self.request('user', 'GET', f'/api/v1/users/{random.choice(self.user_ids)}')
+
+    def op_share(self):
+        self.request('share', 'POST', '/api/v1/share/verify', json={'userId': random.choice(self.user_ids)})
+
+    def op_payment(self):
+        response = self.request('payment_create', 'POST', '/api/v1/payment/create',
+                                json={'userId': random.choice(self.user_ids), 'product_type': 'single'})
+        if response is None or response.status_code != 200:
+            return
+        xml = notify_xml(response.json()['order_id'], 2880, BENCH_API_KEY, BENCH_APP_ID, BENCH_MCH_ID,
+                         success=random.random() >= self.args.pay_failure_rate)
+        # 微信未及时收到应答时会重发同一条通知
+        for attempt in range(1 + self.args.notify_retries):
+            self.request('payment_callback' if attempt == 0 else 'callback_retry', 'POST',
+                         '/api/v1/payment/callback', data=xml.encode('utf-8'), headers={'Content-Type': 'text/xml'})
+
+    def worker(self, deadline):
+        while time.monotonic() < deadline:
+            operation = random.choices(self.operations, self.weights)[0]
+            getattr(self, f'op_{operation}')()
+            if self.args.think_time:
+                time.sleep(random.expovariate(1.0 / self.args.think_time))
+
+    # ------------------------------------------------------------------
+    # 执行与报告
+    # ------------------------------------------------------------------
+
+    def fetch_metrics(self):
+        import requests
+        return requests.get(self.base_url + '/metrics', timeout=10).text
+
+    def task_counts(self):
+        from api.user_manager import UserManager
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('SELECT status, COUNT(*) AS n FROM generation_tasks GROUP BY status')
+            return {row['status']: row['n'] for row in cursor.fetchall()}
+
+    def drain(self):
+        """等待已提交的生成任务结束，最多 drain 秒"""
+        deadline = time.monotonic() + self.args.drain
+        while time.monotonic() < deadline:
+            counts = self.task_counts()
+            if not counts.get('QUEUED') and not counts.get('PROCESSING'):
+                break
+            time.sleep(0.5)
+
+    def run(self):
+        args = self.args
+        self.setup()
+        try:
+            started = time.monotonic()
+            deadline = started + args.duration
+            with ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix='bench') as executor:
+                for future in [executor.submit(self.worker, deadline) for _ in range(args.concurrency)]:
+                    future.result()
+            elapsed = time.monotonic() - started
+
+            drain_started = time.monotonic()
+            if args.drain:
+                self.drain()
+            drain_elapsed = time.monotonic() - drain_started
+            report = self.report(elapsed, drain_elapsed, self.fetch_metrics())
+        finally:
+            self.teardown()
+        return report
+
+    def report(self, elapsed, drain_elapsed, metrics_text):
+        operations = {}
+        total = 0
+        for operation in sorted(self.latencies):
+            values = sorted(self.latencies[operation])
+            codes = self.codes[operation]
+            # 5xx（503 排队已满属于预期的背压）和连接错误计为失败
+            failures = sum(n for code, n in codes.items() if code == 'error' or (code >= 500 and code != 503))
+            total += len(values)
+            operations[operation] = {
+                'count': len(values),
+                'rps': len(values) / elapsed,
+                'p50_ms': percentile(values, 50) * 1000,
+                'p95_ms': percentile(values, 95) * 1000,
+                'p99_ms': percentile(values, 99) * 1000,
+                'max_ms': values[-1] * 1000 if values else 0.0,
+                'failures': failures,
+                'codes': {str(code): n for code, n in sorted(codes.items(), key=lambda item: str(item[0]))},
+            }
+
+        tasks = self.task_counts()
+        generated = tasks.get('SUCCESS', 0) + tasks.get('FAILED', 0)
+        return {
+            'config': {key: value for key, value in vars(self.args).items() if key != 'json'},
+            'duration_s': elapsed,
+            'requests': total,
+            'throughput_rps': total / elapsed,
+            'failures': sum(item['failures'] for item in operations.values()),
+            'operations': operations,
+            'connection_errors': dict(self.errors),
+            'database': {
+                'locked_errors': parse_metric(metrics_text, 'soulmate_db_errors_total', '{kind="locked"}'),
+                'operational_errors': parse_metric(metrics_text, 'soulmate_db_errors_total', '{kind="operational"}'),
+                'user_cache_hits': parse_metric(metrics_text, 'soulmate_user_cache_requests_total', '{result="hit"}'),
+                'user_cache_misses': parse_metric(metrics_text, 'soulmate_user_cache_requests_total', '{result="miss"}'),
+            },
+            'generation': {
+                'tasks': tasks,
+                'finished_per_s': generated / (elapsed + drain_elapsed),
+                'upstream': dict(self.dashscope.stats),
+                'result_cache_hits': parse_metric(metrics_text, 'soulmate_result_cache_hits_total'),
+            },
+            'payment': dict(self.wechat.stats),
+        }
+
+
+def print_report(report):
+    print()
+    print(f"时长 {report['duration_s']:.1f}s，请求 {report['requests']}，"
+          f"吞吐 {report['throughput_rps']:.1f} req/s，失败 {report['failures']}")
+    print()
+    header = f"{'操作':<18}{'次数':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'失败':>6}  状态码"
+    print(header)
+    print('-' * (len(header) + 20))
+    for operation, item in report['operations'].items():
+        codes = ' '.join(f'{code}:{n}' for code, n in item['codes'].items())
+        print(f"{operation:<18}{item['count']:>8}{item['rps']:>9.1f}{item['p50_ms']:>10.1f}{item['p95_ms']:>10.1f}"
+              f"{item['p99_ms']:>10.1f}{item['max_ms']:>10.1f}{item['failures']:>6}  {codes}")
+    print()
+    database = report['database']
+    print(f"数据库锁错误: {database['locked_errors']:.0f}，其他错误: {database['operational_errors']:.0f}，"
+          f"用户缓存命中 {database['user_cache_hits']:.0f} / 未命中 {database['user_cache_misses']:.0f}")
+    generation = report['generation']
+    print(f"生成任务: {generation['tasks']}，完成速率 {generation['finished_per_s']:.2f}/s，"
+          f"上游: {generation['upstream']}")
+    print(f"统一下单: {report['payment']}")
+    if report['connection_errors']:
+        print(f"连接错误: {report['connection_errors']}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='SoulMate 压测工具')
+    parser.add_argument('--duration', type=float, default=30, help='压测时长（秒）')
+    parser.add_argument('--concurrency', type=int, default=16, help='并发虚拟用户数')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX), help=f'流量配比，默认 {DEFAULT_MIX}')
+    parser.add_argument('--users', type=int, default=200, help='参与压测的用户数')
+    parser.add_argument('--profiles', type=int, default=50, help='不同出生信息的组合数，越少结果缓存命中越多')
+    parser.add_argument('--initial-chances', type=int, default=1000, help='每个用户预置的机会数')
+    parser.add_argument('--think-time', type=float, default=0, help='每个虚拟用户两次请求间的平均间隔（秒）')
+    parser.add_argument('--timeout', type=float, default=30, help='单个请求超时（秒）')
+    parser.add_argument('--drain', type=float, default=0, help='压测结束后等待生成任务完成的最长时间（秒）')
+    parser.add_argument('--upstream-latency', type=float, default=3, help='上游生成平均耗时（秒）')
+    parser.add_argument('--upstream-jitter', type=float, default=0.5, help='上游耗时随机浮动比例')
+    parser.add_argument('--upstream-failure-rate', type=float, default=0.02, help='上游任务失败比例')
+    parser.add_argument('--upstream-throttle-rate', type=float, default=0, help='上游提交返回 429 的比例')
+    parser.add_argument('--image-bytes', type=int, default=256 * 1024, help='上游图像大小（字节）')
+    parser.add_argument('--image-variants', action='store_true', help='上游返回可解码的 PNG 并生成多尺寸变体（忽略 --image-bytes）')
+    parser.add_argument('--pay-latency', type=float, default=0.05, help='统一下单响应耗时（秒）')
+    parser.add_argument('--pay-failure-rate', type=float, default=0.05, help='统一下单及支付通知失败比例')
+    parser.add_argument('--pay-error-rate', type=float, default=0.0, help='统一下单返回 HTTP 500 的比例')
+    parser.add_argument('--notify-retries', type=int, default=1, help='每条支付通知额外重发的次数，模拟微信重试')
+    parser.add_argument('--rate-limit', action='store_true', help='保留限流（默认关闭，压测流量都来自本机地址）')
+    parser.add_argument('--database-url', help='使用 PostgreSQL 后端压测，指向一次性的测试库；默认使用临时 SQLite 文件')
+    parser.add_argument('--json', help='将报告以 JSON 写入该文件，便于与历史结果对比')
+    parser.add_argument('--max-p95-ms', type=float, help='任一操作 p95 超过该值时以非零状态退出')
+    parser.add_argument('--max-lock-errors', type=int, help='数据库锁错误超过该值时以非零状态退出')
+    parser.add_argument('--keep', action='store_true', help='保留临时数据库和图像目录')
+    parser.add_argument('--verbose', action='store_true', help='输出应用日志')
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = LoadTest(args).run()
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    failed = []
+    if args.max_p95_ms is not None:
+        failed += [f"{name} p95 {item['p95_ms']:.1f}ms" for name, item in report['operations'].items()
+                   if item['p95_ms'] > args.max_p95_ms]
+    if args.max_lock_errors is not None and report['database']['locked_errors'] > args.max_lock_errors:
+        failed.append(f"数据库锁错误 {report['database']['locked_errors']:.0f}")
+    if failed:
+        print('超出阈值: ' + '，'.join(failed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+冷启动耗时报告
+在全新的子进程中以 -X importtime 导入 api.index，统计导入耗时、首个请求耗时，
+并按顶层包和模块汇总导入开销，便于逐个版本跟踪 serverless 冷启动时间。
+
+用法:
+    python -m bench.startup
+    python -m bench.startup --runs 10 --top 20 --json startup.json
+    python -m bench.startup --max-import-ms 400   # 超出阈值时以非零状态退出
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+from collections import defaultdict
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 子进程中执行的脚本：依次计时导入和首个请求，结果以 JSON 输出到 stdout
+PROBE = '''
+import sys, time, json
+started = time.perf_counter()
+sys.path.insert(0, {root!r})
+import api.index
+imported = time.perf_counter()
+client = api.index.app.test_client()
+status = client.get('/api/v1/users/startup_probe').status_code
+first_request = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (first_request - imported) * 1000,
+    'status': status,
+    'modules': len(sys.modules),
+}}))
+'''
+
+
+def parse_importtime(stderr):
+    """
+    解析 -X importtime 输出
+    :return: [(模块名, 自身耗时 us, 累计耗时 us)]
+    """
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        rows.append((name.strip(), int(self_us), int(cumulative_us)))
+    return rows
+
+
+def run_probe(workdir):
+    env = dict(os.environ)
+    env.update({
+        'SOULMATE_DB_PATH': os.path.join(workdir, 'soulmate.db'),
+        'GENERATED_IMAGES_DIR': os.path.join(workdir, 'generated_images'),
+        'TASK_ARCHIVE_DB_PATH': os.path.join(workdir, 'soulmate_archive.db'),
+    })
+    env.setdefault('USE_MOCK', 'true')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(root=ROOT_DIR)],
+                            cwd=workdir, env=env, capture_output=True, text=True, timeout=120)
+    if result.returncode != 0:
+        raise RuntimeError(f'启动探测失败:\n{result.stderr[-2000:]}')
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    return timings, parse_importtime(result.stderr)
+
+
+def build_report(runs, top):
+    timings = [timing for timing, _ in runs]
+    # 模块耗时取各次运行的中位数
+    self_us = defaultdict(list)
+    cumulative_us = defaultdict(list)
+    for _, rows in runs:
+        for name, self_time, cumulative in rows:
+            self_us[name].append(self_time)
+            cumulative_us[name].append(cumulative)
+    modules = {name: (statistics.median(self_us[name]), statistics.median(cumulative_us[name])) for name in self_us}
+
+    packages = defaultdict(float)
+    for name, (self_time, _) in modules.items():
+        packages[name.split('.')[0]] += self_time
+
+    def median_of(key):
+        return statistics.median(timing[key] for timing in timings)
+
+    return {
+        'python': sys.version.split()[0],
+        'runs': len(runs),
+        'import_ms': median_of('import_ms'),
+        'first_request_ms': median_of('first_request_ms'),
+        'cold_start_ms': median_of('import_ms') + median_of('first_request_ms'),
+        'modules_loaded': int(median_of('modules')),
+        'packages_ms': {name: us / 1000 for name, us in sorted(packages.items(), key=lambda item: -item[1])[:top]},
+        'app_modules_ms': {name: cumulative / 1000 for name, (_, cumulative) in sorted(modules.items())
+                           if name == 'api' or name.startswith('api.')},
+        'slowest_modules_ms': {name: cumulative / 1000 for name, (_, cumulative)
+                               in sorted(modules.items(), key=lambda item: -item[1][1])[:top]},
+    }
+
+
+def print_report(report):
+    print(f"Python {report['python']}，{report['runs']} 次运行取中位数")
+    print(f"导入 api.index: {report['import_ms']:.1f} ms，首个请求: {report['first_request_ms']:.1f} ms，"
+          f"冷启动合计: {report['cold_start_ms']:.1f} ms，已加载模块 {report['modules_loaded']} 个")
+    print()
+    print('按顶层包汇总的自身导入耗时:')
+    for name, ms in report['packages_ms'].items():
+        print(f'  {name:<40}{ms:>10.1f} ms')
+    print()
+    print('应用模块累计导入耗时:')
+    for name, ms in report['app_modules_ms'].items():
+        print(f'  {name:<40}{ms:>10.1f} ms')
+    print()
+    print('累计耗时最高的模块:')
+    for name, ms in report['slowest_modules_ms'].items():
+        print(f'  {name:<40}{ms:>10.1f} ms')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SoulMate 冷启动耗时报告')
+    parser.add_argument('--runs', type=int, default=5, help='启动次数，结果取中位数')
+    parser.add_argument('--top', type=int, default=15, help='列出耗时最高的包和模块数')
+    parser.add_argument('--json', help='将报告以 JSON 写入该文件，便于与历史版本对比')
+    parser.add_argument('--max-import-ms', type=float, help='导入耗时超过该值时以非零状态退出')
+    args = parser.parse_args(argv)
+
+    runs = []
+    for _ in range(max(1, args.runs)):
+        # 每次使用全新的数据库，与 serverless 实例冷启动一致
+        with tempfile.TemporaryDirectory(prefix='soulmate-startup-') as workdir:
+            runs.append(run_probe(workdir))
+
+    report = build_report(runs, args.top)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+    if args.max_import_ms is not None and report['import_ms'] > args.max_import_ms:
+        print(f"导入耗时 {report['import_ms']:.1f} ms 超过阈值 {args.max_import_ms:g} ms")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
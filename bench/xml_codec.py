@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+微信支付 XML 编解码基准
+对比 api.wechat_xml 与改造前 index.py 中的 dict_to_xml / xml_to_dict / generate_sign，
+分别测量序列化、解析回调和验签的单次耗时。
+
+用法:
+    python -m bench.xml_codec
+    python -m bench.xml_codec --number 50000 --json xml_codec.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import hashlib
+import argparse
+import xml.etree.ElementTree as ET
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+from api import wechat_xml
+from bench.fake_wechat import notify_xml
+
+API_KEY = 'bench-api-key'
+
+
+# ----------------------------------------------------------------------
+# 改造前的实现，作为对照
+# ----------------------------------------------------------------------
+
+def legacy_generate_sign(params, api_key):
+    sorted_params = sorted(params.items(), key=lambda x: x[0])
+    sign_str = '&'.join([f'{k}={v}' for k, v in sorted_params]) + f'&key={api_key}'
+    return hashlib.md5(sign_str.encode('utf-8')).hexdigest().upper()
+
+
+def legacy_dict_to_xml(params):
+    xml = '<xml>'
+    for k, v in params.items():
+        xml += f'<{k}>{v}</{k}>'
+    xml += '</xml>'
+    return xml
+
+
+def legacy_xml_to_dict(xml_str):
+    xml = ET.fromstring(xml_str)
+    return {child.tag: child.text for child in xml}
+
+
+def legacy_verify(body):
+    result = legacy_xml_to_dict(body)
+    sign = result.pop('sign')
+    return sign == legacy_generate_sign(result, API_KEY)
+
+
+def codec_verify(body):
+    return wechat_xml.verify_sign(wechat_xml.parse_xml(body), API_KEY)
+
+
+def unifiedorder_params():
+    return {
+        'appid': 'wx0123456789abcdef',
+        'mch_id': '1900000109',
+        'nonce_str': uuid.uuid4().hex,
+        'body': '购买single求缘机会',
+        'out_trade_no': f'user_{int(time.time())}_{uuid.uuid4().hex[:6]}',
+        'total_fee': 2880,
+        'spbill_create_ip': '127.0.0.1',
+        'notify_url': 'https://example.com/api/v1/payment/callback',
+        'trade_type': 'JSAPI',
+        'openid': 'oUpF8uMuAJO_M2pxb1Q9zNjWeS6o',
+    }
+
+
+def measure(func, arg, number):
+    """返回单次调用的平均耗时（微秒）"""
+    func(arg)
+    started = time.perf_counter()
+    for _ in range(number):
+        func(arg)
+    return (time.perf_counter() - started) / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='微信支付 XML 编解码基准')
+    parser.add_argument('--number', type=int, default=20000, help='每项测量的调用次数')
+    parser.add_argument('--json', help='将结果以 JSON 写入该文件')
+    args = parser.parse_args(argv)
+
+    params = unifiedorder_params()
+    body = notify_xml('user_1700000000_abcdef', 2880, API_KEY, 'wx0123456789abcdef', '1900000109').encode('utf-8')
+    assert legacy_verify(body) and codec_verify(body)
+
+    cases = [
+        ('sign', lambda p: legacy_generate_sign(p, API_KEY), lambda p: wechat_xml.sign(p, API_KEY), params),
+        ('serialize', legacy_dict_to_xml, wechat_xml.to_xml, params),
+        ('parse_callback', legacy_xml_to_dict, wechat_xml.parse_xml, body),
+        ('parse_and_verify', legacy_verify, codec_verify, body),
+    ]
+    report = {}
+    print(f"{'操作':<20}{'改造前 us':>12}{'codec us':>12}{'倍数':>8}")
+    for name, legacy, codec, arg in cases:
+        legacy_us = measure(legacy, arg, args.number)
+        codec_us = measure(codec, arg, args.number)
+        report[name] = {'legacy_us': legacy_us, 'codec_us': codec_us, 'speedup': legacy_us / codec_us}
+        print(f"{name:<20}{legacy_us:>12.2f}{codec_us:>12.2f}{legacy_us / codec_us:>8.2f}")
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
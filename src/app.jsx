@@ -66,12 +66,15 @@ const DocumentationPage = ({ onClose }) => (
 
 // 主应用组件
 const API_BASE_URL = 'http://localhost:5000/api/v1'; // 本地开发环境 API 地址
+const LONG_POLL_WAIT = 25; // 长轮询单次最长等待时间（秒）
+const PLACE_SUGGEST_DELAY = 200; // 出生地联想的输入防抖时间（毫秒）
 
 export default function App() {
   const [step, setStep] = useState('input'); // 'input', 'loading', 'result'
   const [birthDate, setBirthDate] = useState('');
   const [birthTime, setBirthTime] = useState('');
   const [birthPlace, setBirthPlace] = useState('');
+  const [placeSuggestions, setPlaceSuggestions] = useState([]); // 出生地联想
   const [result, setResult] = useState(null);
   const [modalMessage, setModalMessage] = useState(null);
   const [isGenerating, setIsGenerating] = useState(false);
@@ -104,6 +107,30 @@ export default function App() {
 
     return () => clearInterval(interval);
   }, [userId]);
+
+  // 出生地联想：停止输入后再请求，只保留最后一次输入的结果
+  useEffect(() => {
+    const query = birthPlace.trim();
+    if (!query) {
+      setPlaceSuggestions([]);
+      return;
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const response = await fetch(`${API_BASE_URL}/places?q=${encodeURIComponent(query)}`, { signal: controller.signal });
+        if (!response.ok) return;
+        const data = await response.json();
+        setPlaceSuggestions(data.places || []);
+      } catch (error) {
+        // 联想失败不影响手动输入
+      }
+    }, PLACE_SUGGEST_DELAY);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [birthPlace]);
   const [showShareModal, setShowShareModal] = useState(false);
   const [showPurchaseModal, setShowPurchaseModal] = useState(false);
 
@@ -181,11 +208,12 @@ export default function App() {
     }
   };
 
-  // 获取任务状态
-  const getGenerationStatus = async (taskId) => {
-    console.log(`正在查询任务状态: ${API_BASE_URL}/generate/status/${taskId}`);
+  // 获取任务状态（长轮询：服务端在状态变化或超时后才返回，成功时同时返回结果）
+  const getGenerationStatus = async (taskId, since) => {
+    const query = `wait=${LONG_POLL_WAIT}` + (since ? `&since=${since}` : '');
+    console.log(`正在查询任务状态: ${API_BASE_URL}/tasks/${taskId}?${query}`);
     try {
-      const response = await fetch(`${API_BASE_URL}/generate/status/${taskId}`);
+      const response = await fetch(`${API_BASE_URL}/tasks/${taskId}?${query}`);
       if (!response.ok) {
         const errorData = await response.json().catch(() => ({}));
         throw new Error(`${errorData.error || '查询任务状态失败。'} (状态码: ${response.status})`);
@@ -243,48 +271,64 @@ export default function App() {
     }
   };
 
-  // 轮询任务状态
+  // 等待任务完成：优先使用 SSE 推送，浏览器不支持或连接中断时退回长轮询
   const pollTaskStatus = async (taskId) => {
-    const checkStatus = async () => {
+    // 确保所有状态正确设置
+    const showResult = (result) => {
+      setIsGenerating(false);
+      setModalMessage(null);
+      setResult(result);
+      setStep('result');
+    };
+
+    const longPoll = async (since) => {
       try {
-        const statusResponse = await getGenerationStatus(taskId);
+        const statusResponse = await getGenerationStatus(taskId, since);
         if (statusResponse.status === 'SUCCESS') {
-          const result = await getGenerationResult(taskId);
-          // 确保所有状态正确设置
-          setIsGenerating(false);
-          setModalMessage(null);
-          setResult(result);
-          setStep('result');
-          return;
+          showResult(statusResponse.result || await getGenerationResult(taskId));
         } else if (statusResponse.status === 'FAILED') {
           // 生成失败时提供模拟兜底结果
           console.log('生成失败，提供模拟兜底结果');
-          const mockResult = generateMockResult(birthDate, birthTime, birthPlace);
-          // 确保所有状态正确设置
-          setIsGenerating(false);
-          setModalMessage(null);
-          setResult(mockResult);
-          setStep('result');
-          return;
+          showResult(generateMockResult(birthDate, birthTime, birthPlace));
         } else {
-          // 继续轮询
-          setTimeout(checkStatus, 2000);
+          // 继续等待下一次状态变化
+          longPoll(statusResponse.status);
         }
       } catch (error) {
         console.error('轮询任务状态失败:', error);
         // 轮询失败时也提供模拟兜底结果
         console.log('轮询失败，提供模拟兜底结果');
-        const mockResult = generateMockResult(birthDate, birthTime, birthPlace);
-        // 确保所有状态正确设置
-        setIsGenerating(false);
-        setModalMessage(null);
-        setResult(mockResult);
-        setStep('result');
+        showResult(generateMockResult(birthDate, birthTime, birthPlace));
       }
     };
 
-    // 开始轮询
-    setTimeout(checkStatus, 2000);
+    if (typeof window === 'undefined' || !window.EventSource) {
+      longPoll();
+      return;
+    }
+
+    // 任务成功时服务端随事件直接返回结果，无需再请求结果接口
+    const source = new EventSource(`${API_BASE_URL}/generate/events/${taskId}`);
+    let finished = false;
+    source.addEventListener('status', (event) => {
+      const data = JSON.parse(event.data);
+      if (data.status === 'SUCCESS') {
+        finished = true;
+        source.close();
+        showResult(data.result);
+      } else if (data.status === 'FAILED') {
+        finished = true;
+        source.close();
+        console.log('生成失败，提供模拟兜底结果');
+        showResult(generateMockResult(birthDate, birthTime, birthPlace));
+      }
+    });
+    source.onerror = () => {
+      if (finished) return;
+      finished = true;
+      source.close();
+      longPoll();
+    };
   };
 
   // 生成模拟兜底结果
@@ -574,8 +618,15 @@ export default function App() {
                   className="w-full p-3 border border-gray-300 rounded-xl focus:ring-4 focus:ring-rose-200 focus:border-rose-400 transition-all duration-300"
                   value={birthPlace}
                   onChange={(e) => setBirthPlace(e.target.value)}
+                  list="birthPlaceSuggestions"
+                  autoComplete="off"
                   required
                 />
+                <datalist id="birthPlaceSuggestions">
+                  {placeSuggestions.map((place) => (
+                    <option key={place.id} value={place.name} label={place.label} />
+                  ))}
+                </datalist>
               </div>
               
               {freeChances > 0 ? (
@@ -640,14 +691,28 @@ export default function App() {
           <div className="flex flex-col items-center p-6 sm:p-8 bg-white rounded-3xl shadow-2xl border-4 border-rose-300 max-w-lg w-full text-center animate-fade-in font-sans">
             <h2 className="text-3xl sm:text-4xl font-bold text-gray-900 mb-4 font-serif">你的正缘</h2>
             
-            <img
-              src={result?.hdImage || '/default_image.svg'}
-              alt="正缘画像"
-              className={`w-full max-w-[20rem] aspect-[2/3] object-cover rounded-2xl shadow-xl transition-all duration-500`}
-              onError={(e) => {
-                e.target.src = '/default_image.svg';
-              }}
-            />
+            {/* 后端返回多尺寸变体时由浏览器按屏幕宽度和格式支持选择，否则直接显示原图 */}
+            <picture className="w-full max-w-[20rem]">
+              {(result?.imageSources || []).map((source) => (
+                <source key={source.type} type={source.type} srcSet={source.srcset} sizes={result.imageSizes} />
+              ))}
+              <img
+                src={result?.previewImage || result?.hdImage || '/default_image.svg'}
+                srcSet={result?.imageSrcset}
+                sizes={result?.imageSizes}
+                alt="正缘画像"
+                className={`w-full max-w-[20rem] aspect-[2/3] object-cover rounded-2xl shadow-xl transition-all duration-500`}
+                onError={(e) => {
+                  // 变体加载失败时先退回原图，原图也失败再显示默认图像
+                  const img = e.target;
+                  if (img.src.endsWith('/default_image.svg')) return;
+                  const useOriginal = result?.hdImage && img.srcset;
+                  img.parentElement.querySelectorAll('source').forEach((node) => node.remove());
+                  img.removeAttribute('srcset');
+                  img.src = useOriginal ? result.hdImage : '/default_image.svg';
+                }}
+              />
+            </picture>
             
             {result.poeticText && (
               <p className="mt-6 sm:mt-8 text-lg sm:text-xl text-gray-700 italic font-serif leading-relaxed px-4 border-l-4 border-rose-400">
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+测试公共配置
+测试从仓库根目录运行：python -m pytest -q
+
+- 数据库、生成图像和归档库都写入临时目录，不影响仓库中的 soulmate.db
+- storage 夹具对 SQLite 和 PostgreSQL 各运行一次；PostgreSQL 使用 SOULMATE_TEST_DATABASE_URL 指向的库，
+  未设置时用 pgserver 启动一个一次性的本地实例，两者都没有时跳过
+"""
+import os
+import sys
+import uuid
+import tempfile
+from urllib.parse import urlsplit, urlunsplit
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
+
+# 在导入 api 之前设置，模块级的配置常量在导入时读取
+_WORK_DIR = tempfile.mkdtemp(prefix='soulmate-tests-')
+os.environ.setdefault('SOULMATE_DB_PATH', os.path.join(_WORK_DIR, 'soulmate.db'))
+os.environ.setdefault('TASK_ARCHIVE_DB_PATH', os.path.join(_WORK_DIR, 'soulmate_archive.db'))
+os.environ.setdefault('GENERATED_IMAGES_DIR', os.path.join(_WORK_DIR, 'generated_images'))
+os.environ.setdefault('USE_MOCK', 'true')
+os.environ.setdefault('RATE_LIMIT_BACKEND', 'off')
+os.environ.setdefault('IMAGE_VARIANT_WORKERS', '0')
+os.environ.pop('DATABASE_URL', None)
+os.environ.pop('STORAGE_BACKEND', None)
+
+
+def _with_database(dsn, name):
+    """把连接串中的数据库名换成 name"""
+    parts = urlsplit(dsn)
+    return urlunsplit(parts._replace(path=f'/{name}'))
+
+
+@pytest.fixture(scope='session')
+def postgres_dsn():
+    """可以创建数据库的 PostgreSQL 连接串"""
+    pytest.importorskip('psycopg2')
+    dsn = os.environ.get('SOULMATE_TEST_DATABASE_URL')
+    if dsn:
+        yield dsn
+        return
+    pgserver = pytest.importorskip('pgserver')
+    server = pgserver.get_server(tempfile.mkdtemp(prefix='soulmate-pg-'), cleanup_mode='stop')
+    yield server.get_uri()
+
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def empty_storage(request, tmp_path):
+    """尚未执行任何迁移的空库"""
+    from api.storage import SQLiteBackend, PostgresBackend
+
+    database = None
+    if request.param == 'sqlite':
+        backend = SQLiteBackend(str(tmp_path / 'soulmate.db'))
+    else:
+        import psycopg2
+        admin_dsn = request.getfixturevalue('postgres_dsn')
+        database = f'soulmate_test_{uuid.uuid4().hex[:12]}'
+        admin = psycopg2.connect(admin_dsn)
+        admin.autocommit = True
+        admin.cursor().execute(f'CREATE DATABASE {database}')
+        backend = PostgresBackend(_with_database(admin_dsn, database))
+    yield backend
+
+    if database:
+        admin.cursor().execute(f'DROP DATABASE {database} WITH (FORCE)')
+        admin.close()
+
+
+@pytest.fixture
+def storage(empty_storage, monkeypatch):
+    """已执行全部迁移的存储后端，并替换为 UserManager 使用的后端"""
+    from api.migrations import migrate
+    from api.user_manager import UserManager
+
+    migrate(empty_storage)
+    monkeypatch.setattr(UserManager, 'storage', empty_storage)
+    return empty_storage
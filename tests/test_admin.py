@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""运营管理接口：超出单次上限的名单返回 413 并提示使用命令行"""
+import pytest
+
+from api import index
+from api.user_manager import UserManager
+
+
+@pytest.fixture
+def admin(storage, monkeypatch):
+    monkeypatch.setattr(index, '_services_started', True)
+    monkeypatch.setattr(index, 'ADMIN_TOKEN', 'secret')
+    monkeypatch.setattr(index, 'ADMIN_MAX_USERS', 3)
+    client = index.app.test_client()
+
+    def post(path, user_ids, **params):
+        return client.post(path, json={'userIds': user_ids, **params}, headers={'X-Admin-Token': 'secret'})
+    return post
+
+
+def test_grant_within_limit(admin):
+    response = admin('/api/v1/admin/grants', ['a', 'b', 'c'], chances=2)
+    assert response.status_code == 200
+    assert UserManager.get_user('a')['free_chances'] == 3
+
+
+def test_large_lists_are_pointed_to_the_cli(admin):
+    for path in ('/api/v1/admin/grants', '/api/v1/admin/users/lookup'):
+        response = admin(path, ['a', 'b', 'c', 'd'], chances=1)
+        assert response.status_code == 413
+        assert 'python -m api.admin' in response.get_json()['error']
+    assert UserManager.get_user('d') is None
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""流式下载：大小上限和 Content-Length 的处理"""
+import hashlib
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from api.downloader import DownloadError, download_temp
+
+BODY = b'x' * 1000
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        content_length = {
+            '/ok': str(len(BODY)),
+            '/malformed': 'abc',
+        }.get(self.path)
+        if content_length is not None:
+            self.send_header('Content-Length', content_length)
+        self.end_headers()
+        self.wfile.write(BODY)
+
+
+@pytest.fixture(scope='module')
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_download_hashes_content(server, tmp_path):
+    tmp, digest, size = download_temp(f'{server}/ok', str(tmp_path))
+    assert (size, digest) == (len(BODY), hashlib.sha256(BODY).hexdigest())
+    with open(tmp, 'rb') as f:
+        assert f.read() == BODY
+
+
+def test_declared_length_over_limit_is_rejected(server, tmp_path):
+    with pytest.raises(DownloadError, match='文件过大'):
+        download_temp(f'{server}/ok', str(tmp_path), max_bytes=100)
+    assert os.listdir(tmp_path) == []
+
+
+def test_malformed_content_length_is_treated_as_unknown(server, tmp_path):
+    tmp, _, size = download_temp(f'{server}/malformed', str(tmp_path))
+    assert size == len(BODY)
+    os.remove(tmp)
+    # 长度未知时仍按实际读取的字节数限制大小
+    with pytest.raises(DownloadError, match='大小上限'):
+        download_temp(f'{server}/malformed', str(tmp_path), max_bytes=100)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""命理推算：节气交界、跨午夜的子时，以及超出 1900-2100 的出生日期"""
+import pytest
+
+from api import index
+from api.fortune import (
+    SEASONS, SEXAGENARY, SHICHEN, SOLAR_TERMS, InvalidBirthData, birth_features, normalize_birth,
+)
+
+
+def pillars(birth_date, birth_time='12:00'):
+    features = birth_features(birth_date, birth_time, '北京')
+    return tuple(SEXAGENARY[p] for p in features[:4]), features
+
+
+def test_year_and_month_pillars_change_at_lichun():
+    # 2000 年立春按 2 月 4 日计：前一天仍是己卯年丑月、大寒、冬季
+    (year, month, _, _), before = pillars('2000-02-03')
+    assert (year, month) == ('己卯', '丁丑')
+    assert (SOLAR_TERMS[before.solar_term][0], SEASONS[before.season]) == ('大寒', '冬季')
+
+    (year, month, day, _), after = pillars('2000-02-04')
+    assert (year, month, day) == ('庚辰', '戊寅', '壬辰')
+    assert (SOLAR_TERMS[after.solar_term][0], SEASONS[after.season]) == ('立春', '春季')
+
+
+def test_month_pillar_changes_at_xiaohan():
+    # 元旦到小寒前属于上一年的冬至（子月），小寒起丑月
+    (_, month, _, _), before = pillars('2000-01-05')
+    assert month == '丙子' and SOLAR_TERMS[before.solar_term][0] == '冬至'
+    (_, month, _, _), after = pillars('2000-01-06')
+    assert month == '丁丑' and SOLAR_TERMS[after.solar_term][0] == '小寒'
+
+
+def test_zi_hour_spans_midnight():
+    (_, _, day, late), late_features = pillars('2000-03-15', '23:30')
+    (_, _, same_day, early), early_features = pillars('2000-03-15', '00:30')
+    # 23:00-00:59 同属子时，日柱不因 23 点而进位，时柱按当日日干推出
+    assert SHICHEN[late_features.shichen][0] == SHICHEN[early_features.shichen][0] == '子时'
+    assert day == same_day == '壬申'
+    assert late == early == '庚子'
+    (_, _, _, before), features = pillars('2000-03-15', '22:59')
+    assert (before, SHICHEN[features.shichen][0]) == ('辛亥', '亥时')
+
+
+@pytest.mark.parametrize('birth_date', ['1900-01-01', '2100-12-31'])
+def test_range_limits_are_accepted(birth_date):
+    assert normalize_birth(birth_date, '08:00', '北京')[0] == birth_date
+
+
+@pytest.mark.parametrize('birth_date', ['1899-12-31', '2101-01-01'])
+def test_out_of_range_year_is_rejected(birth_date):
+    with pytest.raises(InvalidBirthData, match='1900 到 2100'):
+        normalize_birth(birth_date, '08:00', '北京')
+
+
+@pytest.mark.parametrize('birth_date', ['1899-12-31', '2101-01-01'])
+def test_submit_rejects_out_of_range_date(birth_date, monkeypatch):
+    monkeypatch.setattr(index, '_services_started', True)
+    response = index.app.test_client().post('/api/v1/generate/submit', json={
+        'userId': 'u1', 'birthDate': birth_date, 'birthTime': '08:00', 'birthPlace': '北京',
+    })
+    assert response.status_code == 400
+    assert '1900 到 2100' in response.get_json()['error']
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""地名索引与出生地规范化"""
+import pytest
+
+from api.fortune import normalize_birth, read_birth, region_of
+from api.gazetteer import Gazetteer, gazetteer
+
+
+def normalized_place(place):
+    return normalize_birth('1990-05-06', '08:30', place)[2]
+
+
+@pytest.mark.parametrize('place, expected', [
+    ('北京', '北京'),
+    ('北京市', '北京'),
+    ('Beijing', '北京'),
+    ('Bei Jing', '北京'),
+    ('中国北京', '北京'),
+    ('江苏省苏州市', '苏州'),
+    ('suzhou', '苏州'),
+    ('Suzhou, Anhui', '宿州'),
+    ('New York', '纽约'),
+    ("xi'an", '西安'),
+    ('吉林市', '吉林市'),
+])
+def test_exact_and_alias_matches_are_normalized(place, expected):
+    assert normalized_place(place) == expected
+
+
+@pytest.mark.parametrize('place', [
+    # 县级市与地级市同前缀，不能被换成地级市
+    '昆山市', '张家港市', '江阴市', '宜兴市', '常熟市',
+    # 地名表之外的区县，不能截断为上级或换成同名的其他城市
+    '江苏昆山市', '北京市朝阳区', '朝阳区',
+    # 错别字只在联想中纠正
+    '哈尔宾',
+])
+def test_partial_and_fuzzy_matches_keep_raw_text(place):
+    assert normalized_place(place) == place
+    assert gazetteer.resolve(place) is None
+
+
+def test_analysis_shows_the_place_as_entered():
+    assert '1990-05-06, 08:30, 张家港市)' in read_birth('1990-05-06', '08:30', '张家港市').analysis
+
+
+def test_region_uses_province_for_listed_cities_and_prefix_for_others():
+    assert region_of('宿州') == region_of('安徽')
+    assert region_of('江苏昆山市') == region_of('苏州')
+    assert region_of('张家港市') == -1
+
+
+def test_word_boundaries_for_pinyin_keys():
+    assert gazetteer.resolve('Alice Springs') is None
+    assert gazetteer.resolve('Ukraine') is None
+
+
+def test_suggest_uses_prefix_and_fuzzy_matches():
+    assert [place.name for place in gazetteer.suggest('哈尔宾')] == ['哈尔滨']
+    assert [place.id for place in gazetteer.suggest('江苏苏')] == ['cn.jiangsu.suzhou']
+    assert gazetteer.suggest('江苏', 3)[0].id == 'cn.jiangsu'
+    assert gazetteer.suggest('') == []
+
+
+def test_index_is_rebuilt_in_memory_when_missing(tmp_path):
+    fallback = Gazetteer(index_path=str(tmp_path / 'missing.idx'))
+    assert fallback.resolve('beijing').id == 'cn.beijing'
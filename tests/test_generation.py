@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""生成任务的收尾：图像就绪后在哪个线程上完成任务，上游失败或超时时任务失败而不是成功"""
+import threading
+from types import SimpleNamespace
+from concurrent.futures import Future
+
+import pytest
+
+from api import index
+from api import generation_poller as generation_poller_module
+from api.generation_poller import GenerationPoller
+from api.image_generator import ImageGenerator, UpstreamError
+
+
+@pytest.fixture
+def finished(monkeypatch):
+    """记录完成或失败的任务以及执行收尾的线程名"""
+    finished = SimpleNamespace(calls=[], done=threading.Event())
+
+    def record(kind):
+        def handler(task, value, *args):
+            finished.calls.append((kind, task['id'], value, threading.current_thread().name))
+            finished.done.set()
+        return handler
+
+    monkeypatch.setattr(index.task_queue, 'complete', record('complete'))
+    monkeypatch.setattr(index.task_queue, 'fail', record('fail'))
+    monkeypatch.setattr(index, 'compose_result', lambda *args: {'hdImage': args[-1]})
+    return finished
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """替换结果缓存，由测试决定图像何时就绪"""
+    future = Future()
+    monkeypatch.setattr(index.result_cache, 'get_or_submit', lambda prompt, submit: future)
+    return future
+
+
+TASK = {'id': 't1', 'birth_date': '1990-01-01', 'birth_time': '08:00', 'birth_place': '北京'}
+
+
+def test_completion_runs_off_the_fetch_thread(finished, upstream):
+    assert index.run_generation_task(dict(TASK)) is None
+    # 模拟轮询器的查询线程设置结果
+    fetch = threading.Thread(target=upstream.set_result, args=('ab/cd/x.png',), name='generation-fetch-0')
+    fetch.start()
+    fetch.join()
+    assert finished.done.wait(5)
+    kind, task_id, result, thread_name = finished.calls[0]
+    assert (kind, task_id, result) == ('complete', 't1', {'hdImage': 'ab/cd/x.png'})
+    assert thread_name.startswith('generation-complete')
+
+
+def test_upstream_failure_fails_the_task(finished, upstream):
+    index.run_generation_task(dict(TASK))
+    upstream.set_exception(UpstreamError('图像生成任务失败: FAILED'))
+    assert finished.done.wait(5)
+    kind, task_id, error, _ = finished.calls[0]
+    assert (kind, task_id) == ('fail', 't1')
+    assert isinstance(error, UpstreamError)
+
+
+@pytest.fixture
+def poller(monkeypatch):
+    """不启动轮询线程，由测试直接调用 _poll"""
+    monkeypatch.setattr(ImageGenerator, 'generate_async_image', staticmethod(lambda prompt: 'up-1'))
+    return GenerationPoller(max_inflight=1, fetch_workers=1)
+
+
+def test_submit_failure_resolves_with_error(poller, monkeypatch):
+    monkeypatch.setattr(ImageGenerator, 'generate_async_image', staticmethod(lambda prompt: None))
+    with pytest.raises(UpstreamError):
+        poller.submit('prompt').result(0)
+    # 名额已释放，可以继续提交
+    assert poller._slots.acquire(blocking=False)
+
+
+def test_failed_upstream_task_resolves_with_error(poller, monkeypatch):
+    def fetch(upstream_id):
+        raise UpstreamError('图像生成任务失败: FAILED')
+    monkeypatch.setattr(ImageGenerator, 'fetch_image', staticmethod(fetch))
+    future = poller.submit('prompt')
+    poller._poll('up-1')
+    with pytest.raises(UpstreamError, match='FAILED'):
+        future.result(0)
+    assert poller.pending() == 0
+
+
+def test_timed_out_upstream_task_resolves_with_error(poller, monkeypatch):
+    monkeypatch.setattr(ImageGenerator, 'fetch_image', staticmethod(lambda upstream_id: None))
+    future = poller.submit('prompt')
+    # 未超时：重新排期，不结束
+    poller._poll('up-1')
+    assert not future.done()
+    monkeypatch.setattr(generation_poller_module, 'UPSTREAM_TIMEOUT', 0)
+    poller._poll('up-1')
+    with pytest.raises(UpstreamError, match='超时'):
+        future.result(0)
+    assert poller.pending() == 0
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""图像存储：按内容命名的分片键，以及 S3 后端（moto 模拟的存储桶）"""
+import hashlib
+import os
+
+import pytest
+
+from api.image_store import (
+    IMMUTABLE_CACHE_CONTROL, ImageStore, ImageStoreError, LocalImageStore, S3ImageStore,
+    is_content_key, is_valid_key,
+)
+
+boto3 = pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+BUCKET = 'soulmate-test'
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 64
+DIGEST = hashlib.sha256(PNG).hexdigest()
+
+
+@pytest.fixture
+def s3_client(monkeypatch):
+    for name in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(name, 'testing')
+    with moto.mock_aws():
+        client = boto3.client('s3', region_name='us-east-1')
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def store(s3_client, tmp_path):
+    backend = S3ImageStore(bucket=BUCKET, prefix='generated_images/', public_url='https://cdn.example.com/gi/',
+                           client=s3_client)
+    return ImageStore(backend, local=LocalImageStore(str(tmp_path / 'local')))
+
+
+def test_key_validation():
+    key = f'{DIGEST[:2]}/{DIGEST[2:4]}/{DIGEST}.png'
+    assert is_content_key(key)
+    assert is_content_key(f'{DIGEST[:2]}/{DIGEST[2:4]}/{DIGEST}.w320.webp')
+    assert not is_content_key('default_image.svg')
+    assert is_valid_key('default_image.svg')
+    for key in ('../soulmate.db', 'ab/../../etc/passwd', '', '.hidden', 'a/b.png'):
+        assert not is_valid_key(key)
+
+
+def test_put_bytes_uploads_with_immutable_headers(store, s3_client):
+    key = store.put_bytes(PNG, '.PNG')
+    assert key == f'{DIGEST[:2]}/{DIGEST[2:4]}/{DIGEST}.png'
+    head = s3_client.head_object(Bucket=BUCKET, Key=f'generated_images/{key}')
+    assert head['ContentType'] == 'image/png'
+    assert head['CacheControl'] == IMMUTABLE_CACHE_CONTROL
+    assert store.url(key) == f'https://cdn.example.com/gi/{key}'
+    assert store.local_path(key) is None
+    assert store.etag(key) == f'{DIGEST}.png'
+
+
+def test_identical_content_is_stored_once(store, s3_client, tmp_path):
+    key = store.put_bytes(PNG)
+    tmp = tmp_path / 'again.png'
+    tmp.write_bytes(PNG)
+    assert store.put_file(str(tmp)) == key
+    # 重复写入时临时文件同样被清理
+    assert not tmp.exists()
+    listed = s3_client.list_objects_v2(Bucket=BUCKET)['Contents']
+    assert [obj['Key'] for obj in listed] == [f'generated_images/{key}']
+
+
+def test_read_open_fetch_and_delete(store, tmp_path):
+    key = store.put_bytes(PNG)
+    assert store.exists(key)
+    assert store.read_bytes(key) == PNG
+    body, size = store.open(key)
+    assert size == len(PNG)
+    assert body.read() == PNG
+    dest = tmp_path / 'copy.png'
+    store.fetch(key, str(dest))
+    assert dest.read_bytes() == PNG
+
+    store.delete(key)
+    assert not store.exists(key)
+    assert store.read_bytes(key) is None
+    assert store.open(key) is None
+
+
+def test_derived_files_share_the_original_directory(store, s3_client):
+    key = store.put_bytes(PNG)
+    variant = key.replace('.png', '.w320.webp')
+    store.save_bytes(variant, b'webp')
+    head = s3_client.head_object(Bucket=BUCKET, Key=f'generated_images/{variant}')
+    assert head['ContentType'] == 'image/webp'
+    assert store.read_bytes(variant) == b'webp'
+
+
+def test_legacy_keys_stay_local(store, s3_client, tmp_path):
+    os.makedirs(tmp_path / 'local')
+    (tmp_path / 'local' / 'default_image.svg').write_bytes(b'<svg/>')
+    assert store.read_bytes('default_image.svg') == b'<svg/>'
+    assert store.url('default_image.svg') == '/generated_images/default_image.svg'
+    assert store.etag('default_image.svg') is None
+    assert 'Contents' not in s3_client.list_objects_v2(Bucket=BUCKET)
+
+
+def test_upload_failure_raises_and_removes_temp_file(s3_client, tmp_path):
+    store = ImageStore(S3ImageStore(bucket='missing-bucket', client=s3_client),
+                       local=LocalImageStore(str(tmp_path / 'local')))
+    tmp = tmp_path / 'upload.png'
+    tmp.write_bytes(PNG)
+    with pytest.raises(ImageStoreError):
+        store.put_file(str(tmp))
+    assert not tmp.exists()
+
+
+def test_local_store_dedupes_into_shards(tmp_path):
+    store = ImageStore(LocalImageStore(str(tmp_path)))
+    key = store.put_bytes(PNG)
+    assert store.put_bytes(PNG) == key
+    assert os.path.isfile(tmp_path / DIGEST[:2] / DIGEST[2:4] / f'{DIGEST}.png')
+    assert store.local_path(key) == str(tmp_path / DIGEST[:2] / DIGEST[2:4] / f'{DIGEST}.png')
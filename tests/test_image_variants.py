@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""图像变体：srcset 中的宽度去重"""
+import io
+
+import pytest
+
+from api.image_store import ImageStore, LocalImageStore
+from api.image_variants import ImageVariants
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def png(width, height):
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (200, 120, 80)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def variants(tmp_path):
+    store = ImageStore(LocalImageStore(str(tmp_path)))
+    return ImageVariants(store=store, formats='webp,jpeg', widths='thumb:320,preview:640,full:1024',
+                         workers=0, enabled=True)
+
+
+def widths(srcset):
+    return [int(item.rsplit(' ', 1)[1][:-1]) for item in srcset.split(', ')]
+
+
+def test_srcset_lists_each_tier(variants):
+    key = variants.store.put_bytes(png(1024, 1024))
+    payload = variants.payload(key)
+    assert widths(payload['imageSrcset']) == [320, 640, 1024]
+    assert payload['previewImage'].endswith('.preview.webp')
+
+
+def test_srcset_dedupes_tiers_wider_than_source(variants):
+    key = variants.store.put_bytes(png(500, 400))
+    payload = variants.payload(key)
+    # preview 和 full 都不放大，宽度同为 500，只保留一项
+    assert widths(payload['imageSrcset']) == [320, 500]
+    for source in payload['imageSources']:
+        assert widths(source['srcset']) == [320, 500]
+    assert payload['previewImage'].endswith('.preview.webp')
+
+
+def test_srcset_for_source_narrower_than_every_tier(variants):
+    key = variants.store.put_bytes(png(200, 200))
+    assert widths(variants.payload(key)['imageSrcset']) == [200]
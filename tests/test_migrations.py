@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""数据库迁移：空库和引入迁移前创建的库都能升级到最新版本，重复执行不改变结构（SQLite 和 PostgreSQL）"""
+import pytest
+
+from api import migrations
+from api.migrations import LATEST_VERSION, MIGRATIONS, current_version, ensure_schema, migrate
+
+# 引入迁移之前应用启动时创建的表（用户表、生成任务表、支付脚本创建的订单和记录表）
+BASELINE_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id TEXT PRIMARY KEY,
+        free_chances INTEGER DEFAULT 1,
+        last_shared_at TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS generation_tasks (
+        id TEXT PRIMARY KEY,
+        user_id TEXT,
+        status TEXT DEFAULT 'PROCESSING',
+        result TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        birth_date TEXT,
+        birth_time TEXT,
+        birth_place TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS payment_orders (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id TEXT UNIQUE NOT NULL,
+        user_id TEXT NOT NULL,
+        product_type TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL DEFAULT 'PENDING',
+        error_msg TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS payment_records (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        order_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        amount REAL NOT NULL,
+        status TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+]
+
+
+def run(storage, statements=(), params=()):
+    conn = storage.acquire()
+    cursor = storage.cursor(conn)
+    try:
+        for statement in statements:
+            cursor.execute(storage.translate_ddl(statement), params)
+        conn.commit()
+        return current_version(storage, cursor), {
+            table: set(storage.column_names(cursor, table))
+            for table in ('users', 'generation_tasks', 'image_cache', 'payment_orders', 'payment_records')
+        }
+    finally:
+        cursor.close()
+        storage.release(conn)
+
+
+@pytest.fixture
+def baseline_storage(empty_storage):
+    """引入迁移之前的库：已有表和数据，没有 schema_version"""
+    run(empty_storage, BASELINE_SCHEMA)
+    run(empty_storage, ["INSERT INTO users (id, free_chances) VALUES ('old', 3)"])
+    return empty_storage
+
+
+def assert_latest(storage):
+    version, columns = run(storage)
+    assert version == LATEST_VERSION
+    assert {'callback_url', 'claimed_at', 'image_file'} <= columns['generation_tasks']
+    assert 'error_msg' in columns['payment_records']
+    assert {'cache_key', 'variant', 'file_name'} <= columns['image_cache']
+
+
+def test_versions_are_sequential():
+    assert [version for version, _, _ in MIGRATIONS] == list(range(1, LATEST_VERSION + 1))
+
+
+def test_migrate_empty_database(empty_storage):
+    assert run(empty_storage)[0] == 0
+    assert migrate(empty_storage) == list(range(1, LATEST_VERSION + 1))
+    assert_latest(empty_storage)
+
+
+def test_migrate_baseline_database(baseline_storage):
+    assert migrate(baseline_storage) == list(range(1, LATEST_VERSION + 1))
+    assert_latest(baseline_storage)
+    conn = baseline_storage.acquire()
+    cursor = baseline_storage.cursor(conn)
+    try:
+        cursor.execute("SELECT free_chances FROM users WHERE id = 'old'")
+        assert cursor.fetchone()['free_chances'] == 3
+    finally:
+        cursor.close()
+        baseline_storage.release(conn)
+
+
+def test_rerun_is_a_no_op(empty_storage):
+    migrate(empty_storage)
+    _, columns = run(empty_storage)
+    assert migrate(empty_storage) == []
+    assert run(empty_storage) == (LATEST_VERSION, columns)
+
+
+def test_migrate_up_to_target(empty_storage):
+    assert migrate(empty_storage, target=4) == [1, 2, 3, 4]
+    assert run(empty_storage)[0] == 4
+    assert migrate(empty_storage) == list(range(5, LATEST_VERSION + 1))
+    assert_latest(empty_storage)
+
+
+def test_ensure_schema_migrates_stale_database(empty_storage):
+    migrate(empty_storage, target=4)
+    ensure_schema(empty_storage, auto_migrate=True)
+    assert_latest(empty_storage)
+
+
+def test_ensure_schema_without_auto_migrate_leaves_database(empty_storage):
+    migrate(empty_storage, target=4)
+    ensure_schema(empty_storage, auto_migrate=False)
+    assert run(empty_storage)[0] == 4
+
+
+def test_ensure_schema_skips_current_database(empty_storage, monkeypatch):
+    migrate(empty_storage)
+    monkeypatch.setattr(migrations, 'migrate', lambda storage: pytest.fail('不应再次迁移'))
+    ensure_schema(empty_storage, auto_migrate=True)
+
+
+def test_last_shared_at_holds_unix_timestamps(baseline_storage, monkeypatch):
+    from api.user_manager import UserManager
+    run(baseline_storage, ["INSERT INTO users (id, last_shared_at) VALUES ('shared', '2024-01-01 00:00:00')"])
+    migrate(baseline_storage)
+    monkeypatch.setattr(UserManager, 'storage', baseline_storage)
+    # 新的分享时间（Unix 时间戳）可以直接写入
+    assert UserManager.record_share('old') == 4
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute("SELECT id, last_shared_at FROM users WHERE id IN ('old', 'shared')")
+        shared = {row['id']: row['last_shared_at'] for row in cursor.fetchall()}
+    assert float(shared['old']) > 1704067200
+    # PostgreSQL 下已有的时间转换为 Unix 时间戳
+    if baseline_storage.name == 'postgres':
+        assert shared['shared'] == 1704067200
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""统一下单客户端的重试和熔断，对接 bench/fake_wechat.py 的本地网关替身"""
+import socket
+import time
+
+import pytest
+
+from api.payment_gateway import (
+    CircuitBreaker, GatewayUnavailable, PaymentGatewayError, WeChatPayClient,
+)
+from api.wechat_xml import parse_xml, sign, to_xml
+from bench.fake_wechat import FakeWeChatPay
+
+API_KEY = 'test-api-key'
+
+
+@pytest.fixture
+def gateway():
+    fake = FakeWeChatPay(API_KEY, latency=0).start()
+    yield fake
+    fake.stop()
+
+
+def order_xml(out_trade_no='order-1'):
+    params = {'appid': 'wx-app', 'mch_id': 'mch', 'nonce_str': 'n', 'out_trade_no': out_trade_no,
+              'total_fee': '100', 'trade_type': 'JSAPI'}
+    params['sign'] = sign(params, API_KEY)
+    return to_xml(params)
+
+
+def make_client(url, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    kwargs.setdefault('breaker', CircuitBreaker(threshold=2, cooldown=60))
+    return WeChatPayClient(url, connect_timeout=0.5, read_timeout=1, **kwargs)
+
+
+def closed_port_url():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    return f'http://127.0.0.1:{port}/pay/unifiedorder'
+
+
+def test_unified_order_returns_prepay_id(gateway):
+    result = make_client(gateway.unifiedorder_url).unified_order(order_xml(), parse_xml)
+    assert result['result_code'] == 'SUCCESS'
+    assert result['prepay_id'].startswith('wx')
+    assert gateway.stats['orders'] == 1
+
+
+def test_server_errors_are_retried_then_raised(gateway):
+    gateway.error_rate = 1.0
+    client = make_client(gateway.unifiedorder_url, max_retries=2)
+    with pytest.raises(PaymentGatewayError):
+        client.unified_order(order_xml(), parse_xml)
+    assert gateway.stats['errors'] == 3
+    # 一次下单（含重试）只记一次失败
+    assert client.breaker.failures == 1
+
+
+def test_systemerror_is_retried_with_same_order(gateway):
+    gateway.failure_rate = 1.0
+    client = make_client(gateway.unifiedorder_url, max_retries=1)
+    with pytest.raises(PaymentGatewayError, match='系统错误'):
+        client.unified_order(order_xml(), parse_xml)
+    assert gateway.stats['orders'] == 2
+
+
+def test_recovers_when_retry_succeeds(gateway, monkeypatch):
+    client = make_client(gateway.unifiedorder_url, max_retries=2)
+    post = client._post
+    calls = []
+
+    def flaky(xml_data, parse):
+        calls.append(1)
+        if len(calls) == 1:
+            gateway.error_rate = 1.0
+        else:
+            gateway.error_rate = 0.0
+        return post(xml_data, parse)
+
+    monkeypatch.setattr(client, '_post', flaky)
+    assert client.unified_order(order_xml(), parse_xml)['result_code'] == 'SUCCESS'
+    assert len(calls) == 2
+    assert client.breaker.failures == 0
+
+
+def test_read_timeout_is_not_retried(gateway):
+    gateway.latency = 0.5
+    client = WeChatPayClient(gateway.unifiedorder_url, connect_timeout=0.5, read_timeout=0.1,
+                             max_retries=3, backoff=0)
+    started = time.monotonic()
+    with pytest.raises(PaymentGatewayError, match='响应超时'):
+        client.unified_order(order_xml(), parse_xml)
+    assert time.monotonic() - started < 0.4
+
+
+def test_connection_refused_is_retried():
+    client = make_client(closed_port_url(), max_retries=2)
+    attempts = []
+    post = client._post
+    client._post = lambda *args: attempts.append(1) or post(*args)
+    with pytest.raises(PaymentGatewayError, match='连接失败'):
+        client.unified_order(order_xml(), parse_xml)
+    assert len(attempts) == 3
+
+
+def test_breaker_opens_and_rejects_without_calling_gateway(gateway):
+    gateway.error_rate = 1.0
+    client = make_client(gateway.unifiedorder_url, max_retries=0)
+    for _ in range(2):
+        with pytest.raises(PaymentGatewayError):
+            client.unified_order(order_xml(), parse_xml)
+    assert client.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(GatewayUnavailable) as excinfo:
+        client.unified_order(order_xml(), parse_xml)
+    assert 1 <= excinfo.value.retry_after <= 60
+    assert gateway.stats['errors'] == 2
+
+
+def test_breaker_probe_after_cooldown(gateway):
+    gateway.error_rate = 1.0
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    client = make_client(gateway.unifiedorder_url, max_retries=0, breaker=breaker)
+    with pytest.raises(PaymentGatewayError):
+        client.unified_order(order_xml(), parse_xml)
+    time.sleep(0.06)
+    # 探测请求失败，重新熔断
+    with pytest.raises(PaymentGatewayError):
+        client.unified_order(order_xml(), parse_xml)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(GatewayUnavailable):
+        client.unified_order(order_xml(), parse_xml)
+
+    gateway.error_rate = 0.0
+    time.sleep(0.06)
+    assert client.unified_order(order_xml(), parse_xml)['result_code'] == 'SUCCESS'
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert gateway.stats['errors'] == 2
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker(threshold=1, cooldown=0)
+    breaker.record_failure()
+    breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(GatewayUnavailable):
+        breaker.allow()
+    breaker.record_success()
+    breaker.allow()
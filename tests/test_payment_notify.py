@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""支付结果通知的幂等处理：重复和并发到达的同一条通知只到账一次，每次都应答 SUCCESS"""
+import threading
+
+import pytest
+
+from api import index
+from api import payment_notify
+from api.payment_config import WECHAT_PAY_CONFIG, PRODUCT_CHANCES
+from api.user_manager import UserManager, DEFAULT_FREE_CHANCES
+from api.wechat_xml import parse_xml
+from bench.fake_wechat import notify_xml
+
+ORDER_ID = 'order-1'
+
+
+@pytest.fixture
+def order(storage):
+    """一笔待支付的月卡订单"""
+    UserManager.create_user('u1')
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO payment_orders (order_id, user_id, product_type, amount)
+            VALUES (?, 'u1', 'monthly', 19.9)
+        ''', (ORDER_ID,))
+    yield ORDER_ID
+    # 等后台记账写完再清理数据库
+    payment_notify._bookkeeping_executor().submit(lambda: None).result()
+
+
+@pytest.fixture
+def post_notify(monkeypatch):
+    monkeypatch.setattr(index, '_services_started', True)
+
+    def post(body):
+        response = index.app.test_client().post('/api/v1/payment/callback', data=body,
+                                                 content_type='text/xml')
+        return response.status_code, parse_xml(response.data)
+    return post
+
+
+def notify(out_trade_no):
+    return notify_xml(out_trade_no, 1990, WECHAT_PAY_CONFIG['API_KEY'])
+
+
+def chances():
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute("SELECT free_chances FROM users WHERE id = 'u1'")
+        return cursor.fetchone()['free_chances']
+
+
+def records():
+    payment_notify._bookkeeping_executor().submit(lambda: None).result()
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) AS n FROM payment_records WHERE order_id = ?', (ORDER_ID,))
+        return cursor.fetchone()['n']
+
+
+def test_repeated_notify_is_credited_once(order, post_notify):
+    body = notify(order)
+    for _ in range(2):
+        status, reply = post_notify(body)
+        assert (status, reply['return_code']) == (200, 'SUCCESS')
+    assert chances() == DEFAULT_FREE_CHANCES + PRODUCT_CHANCES['monthly']
+    assert records() == 1
+
+
+def test_concurrent_notify_is_credited_once(order, post_notify):
+    body = notify(order)
+    replies = []
+    barrier = threading.Barrier(5)
+
+    def deliver():
+        barrier.wait()
+        replies.append(post_notify(body))
+
+    threads = [threading.Thread(target=deliver) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [(status, reply['return_code']) for status, reply in replies] == [(200, 'SUCCESS')] * 5
+    assert chances() == DEFAULT_FREE_CHANCES + PRODUCT_CHANCES['monthly']
+    assert records() == 1
+
+
+def test_apply_notification_reports_duplicates(order):
+    notification = parse_xml(notify(order))
+    assert payment_notify.apply_notification(notification) == 'credited'
+    assert payment_notify.apply_notification(notification) == 'duplicate'
+    assert payment_notify.apply_notification(dict(notification, out_trade_no='missing')) == 'unknown'
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""令牌桶限流：memory 后端和 redis 后端的 Lua 脚本（fakeredis + lupa）"""
+import pytest
+from flask import Flask
+
+from api import rate_limit as rate_limit_module
+from api.rate_limit import DEFAULT_POLICIES, MemoryBuckets, RedisBuckets, RateLimiter, parse_rate, rate_limited
+
+fakeredis = pytest.importorskip('fakeredis')
+pytest.importorskip('lupa')
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def buckets(request):
+    if request.param == 'memory':
+        return MemoryBuckets(max_buckets=100)
+    return RedisBuckets(prefix='test:ratelimit:', client=request.getfixturevalue('redis_client'))
+
+
+def test_parse_rate():
+    assert parse_rate('10/60') == (10.0, 10 / 60)
+    assert parse_rate('5') == (5.0, 5.0)
+    assert parse_rate('0') is None
+    assert parse_rate('') is None
+
+
+def test_bucket_allows_burst_then_rejects(buckets):
+    for _ in range(3):
+        assert buckets.take('k', 3, 0.01) == (True, 0.0)
+    allowed, wait = buckets.take('k', 3, 0.01)
+    assert not allowed
+    assert 0 < wait <= 100
+
+
+def test_buckets_are_independent_per_key(buckets):
+    assert buckets.take('a', 1, 0.01)[0]
+    assert not buckets.take('a', 1, 0.01)[0]
+    assert buckets.take('b', 1, 0.01)[0]
+
+
+def test_memory_bucket_refills_over_time(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit_module.time, 'monotonic', lambda: now[0])
+    buckets = MemoryBuckets()
+    assert buckets.take('k', 1, 0.5)[0]
+    assert buckets.take('k', 1, 0.5) == (False, 2.0)
+    now[0] += 2
+    assert buckets.take('k', 1, 0.5)[0]
+
+
+def test_redis_bucket_state_expires(redis_client):
+    buckets = RedisBuckets(prefix='test:ratelimit:', client=redis_client)
+    buckets.take('k', 2, 1)
+    state = redis_client.hgetall('test:ratelimit:k')
+    assert float(state[b'tokens']) == pytest.approx(1, abs=0.1)
+    # 桶补满所需的时间之后键自动过期
+    assert 0 < redis_client.pttl('test:ratelimit:k') <= 2000
+
+
+def test_redis_bucket_refills_from_server_time(redis_client):
+    buckets = RedisBuckets(prefix='test:ratelimit:', client=redis_client)
+    assert buckets.take('k', 1, 1)[0]
+    assert not buckets.take('k', 1, 1)[0]
+    # 把上次更新时间往前拨，模拟经过了一段时间
+    ts = float(redis_client.hget('test:ratelimit:k', 'ts'))
+    redis_client.hset('test:ratelimit:k', 'ts', str(ts - 5))
+    assert buckets.take('k', 1, 1)[0]
+
+
+class BrokenBuckets:
+    name = 'redis'
+
+    def take(self, key, capacity, rate, cost=1):
+        raise ConnectionError('down')
+
+
+def test_limiter_checks_each_scope_and_fails_open():
+    policies = {'submit': {'user': (1, 0.01), 'ip': (5, 0.01)}}
+    limiter = RateLimiter(MemoryBuckets(), policies)
+    assert limiter.check('submit', {'user': 'u1', 'ip': '1.2.3.4'}) == 0
+    assert limiter.check('submit', {'user': 'u1', 'ip': '1.2.3.4'}) > 0
+    assert limiter.check('submit', {'user': 'u2', 'ip': '1.2.3.4'}) == 0
+    assert RateLimiter(BrokenBuckets(), policies).check('submit', {'user': 'u1'}) == 0
+
+
+def test_decorator_returns_429_with_retry_after(redis_client):
+    limiter = RateLimiter(RedisBuckets(prefix='test:ratelimit:', client=redis_client),
+                          {'user': {'ip': (1, 0.1)}})
+    app = Flask(__name__)
+
+    @app.route('/ping')
+    @rate_limited('user', limiter)
+    def ping():
+        return 'ok'
+
+    client = app.test_client()
+    assert client.get('/ping').status_code == 200
+    response = client.get('/ping')
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '10'
+    assert response.get_json()['retry_after'] == 10
+
+
+def test_client_supplied_user_id_does_not_get_its_own_bucket():
+    # userId 未经认证，默认策略只按客户端地址限流
+    assert all(set(scopes) == {'ip'} for scopes in DEFAULT_POLICIES.values())
+    limiter = RateLimiter(MemoryBuckets(), {'submit': {'ip': (2, 0.01)}})
+    app = Flask(__name__)
+
+    @app.route('/submit', methods=['POST'])
+    @rate_limited('submit', limiter)
+    def submit():
+        return 'ok'
+
+    client = app.test_client()
+    statuses = [client.post('/submit', json={'userId': f'u{i}'}).status_code for i in range(3)]
+    assert statuses == [200, 200, 429]
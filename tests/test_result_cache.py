@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""生成结果缓存的淘汰（SQLite 和 PostgreSQL）"""
+import time
+
+import pytest
+
+from api import result_cache as result_cache_module
+from api.result_cache import ResultCache
+from api.user_manager import UserManager
+
+
+@pytest.fixture
+def deleted(monkeypatch):
+    """记录被删除的图像文件，不访问图像存储"""
+    files = []
+    monkeypatch.setattr(result_cache_module.image_store, 'delete', files.append)
+    monkeypatch.setattr(result_cache_module.image_variants, 'remove', lambda file_name: None)
+    return files
+
+
+def insert(key, file_name, created_at, last_used_at):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO image_cache (cache_key, variant, file_name, created_at, last_used_at)
+            VALUES (?, 0, ?, ?, ?)
+        ''', (key, file_name, created_at, last_used_at))
+
+
+def remaining():
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT cache_key FROM image_cache ORDER BY cache_key')
+        return [row['cache_key'] for row in cursor.fetchall()]
+
+
+def test_evicts_least_recently_used_beyond_capacity(storage, deleted):
+    now = time.time()
+    for i, key in enumerate('abcde'):
+        insert(key, f'{key}.png', now, now + i)
+    assert ResultCache(max_entries=2, ttl=3600).evict() == 3
+    assert remaining() == ['d', 'e']
+    assert sorted(deleted) == ['a.png', 'b.png', 'c.png']
+
+
+def test_evicts_expired_entries_and_keeps_shared_files(storage, deleted):
+    now = time.time()
+    insert('old', 'shared.png', now - 7200, now - 7200)
+    insert('new', 'shared.png', now, now)
+    insert('gone', 'gone.png', now - 7200, now)
+    assert ResultCache(max_entries=10, ttl=3600).evict() == 1
+    assert remaining() == ['new']
+    assert deleted == ['gone.png']
+
+
+def test_evict_without_excess_is_a_no_op(storage, deleted):
+    insert('a', 'a.png', time.time(), time.time())
+    assert ResultCache(max_entries=5, ttl=3600).evict() == 0
+    assert remaining() == ['a'] and deleted == []
+
+
+def test_images_referenced_by_tasks_are_not_evicted(storage, deleted):
+    now = time.time()
+    UserManager.create_user('u1')
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO generation_tasks (id, user_id, status, result, image_file)
+            VALUES ('t1', 'u1', 'SUCCESS', '{}', 'a.png')
+        ''')
+    for i, key in enumerate('abc'):
+        insert(key, f'{key}.png', now - 7200 if key == 'a' else now, now + i)
+    # a 已过期且最久未使用，但仍被任务结果引用；超出容量的部分只从未被引用的图像中淘汰
+    assert ResultCache(max_entries=1, ttl=3600).evict() == 2
+    assert remaining() == ['a']
+    assert sorted(deleted) == ['b.png', 'c.png']
+
+    # 任务归档后按正常规则淘汰
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute("DELETE FROM generation_tasks WHERE id = 't1'")
+    assert ResultCache(max_entries=1, ttl=3600).evict() == 1
+    assert remaining() == []
+    assert deleted[-1] == 'a.png'
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""生成任务归档与空间回收"""
+import sqlite3
+
+import pytest
+
+from api.migrations import migrate
+from api.retention import RetentionJob, enable_incremental_vacuum, AUTO_VACUUM_INCREMENTAL
+from api.storage import SQLiteBackend
+from api.user_manager import UserManager
+
+
+@pytest.fixture
+def legacy_storage(tmp_path, monkeypatch):
+    """改造前创建的主库：auto_vacuum 为默认的 NONE"""
+    path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE users (id TEXT PRIMARY KEY, free_chances INTEGER DEFAULT 1)')
+    conn.close()
+    backend = SQLiteBackend(path)
+    migrate(backend)
+    monkeypatch.setattr(UserManager, 'storage', backend)
+    return backend
+
+
+def auto_vacuum(storage):
+    conn = storage.acquire()
+    try:
+        return conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+    finally:
+        storage.release(conn)
+
+
+def add_finished_tasks(count):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.executemany('''
+            INSERT INTO generation_tasks (id, user_id, status, result, created_at)
+            VALUES (?, 'u1', 'SUCCESS', ?, '2000-01-01 00:00:00')
+        ''', [(f'task-{i}', 'x' * 2000) for i in range(count)])
+
+
+def test_legacy_database_is_archived_without_full_vacuum(legacy_storage, tmp_path, caplog):
+    add_finished_tasks(50)
+    job = RetentionJob(retention_days=1, archive_path=str(tmp_path / 'archive.db'))
+    assert job.run_once() == 50
+    # 不在服务进程内切换模式，只记录一次提示
+    assert auto_vacuum(legacy_storage) != AUTO_VACUUM_INCREMENTAL
+    assert job.run_once() == 0
+    assert sum('enable-incremental-vacuum' in record.message for record in caplog.records) == 1
+
+
+def test_offline_conversion_enables_incremental_reclaim(legacy_storage, tmp_path):
+    assert enable_incremental_vacuum(legacy_storage) is True
+    assert auto_vacuum(legacy_storage) == AUTO_VACUUM_INCREMENTAL
+    assert enable_incremental_vacuum(legacy_storage) is False
+
+    add_finished_tasks(200)
+    job = RetentionJob(retention_days=1, archive_path=str(tmp_path / 'archive.db'))
+    assert job.run_once() == 200
+    conn = legacy_storage.acquire()
+    try:
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+    finally:
+        legacy_storage.release(conn)
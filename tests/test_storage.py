@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""存储后端：? 占位符转换、建表类型替换，以及同一组 SQL 在 SQLite 和 PostgreSQL 上的行为"""
+import sqlite3
+
+import pytest
+
+from api.storage import to_pyformat, PostgresBackend, SQLiteBackend
+from api.user_manager import UserManager
+
+
+@pytest.mark.parametrize('sql, expected', [
+    ('SELECT * FROM users WHERE id = ?', 'SELECT * FROM users WHERE id = %s'),
+    ('UPDATE t SET a = ?, b = ? WHERE c = ?', 'UPDATE t SET a = %s, b = %s WHERE c = %s'),
+    # 字符串字面量中的 ? 不是占位符
+    ("SELECT '?' AS q, id FROM t WHERE id = ?", "SELECT '?' AS q, id FROM t WHERE id = %s"),
+    ("SELECT 'it''s ?' FROM t WHERE id = ?", "SELECT 'it''s ?' FROM t WHERE id = %s"),
+    # % 在字面量内外都需要转义，否则会被 psycopg2 当作占位符
+    ("SELECT * FROM t WHERE name LIKE '%?%' AND id = ?", "SELECT * FROM t WHERE name LIKE '%%?%%' AND id = %s"),
+    ('SELECT a % ? FROM t', 'SELECT a %% %s FROM t'),
+])
+def test_to_pyformat(sql, expected):
+    assert to_pyformat(sql) == expected
+
+
+def test_translate_ddl():
+    sql = 'CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, score REAL, realm TEXT)'
+    assert PostgresBackend.translate_ddl(sql) == \
+        'CREATE TABLE t (id BIGSERIAL PRIMARY KEY, score DOUBLE PRECISION, realm TEXT)'
+    assert SQLiteBackend.translate_ddl(sql) == sql
+
+
+def test_placeholders_and_literals(storage):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('INSERT INTO users (id, free_chances) VALUES (?, ?)', ('50%?', 2))
+        cursor.execute("SELECT id, '?' AS mark FROM users WHERE id LIKE '50%' AND free_chances = ?", (2,))
+        row = cursor.fetchone()
+    assert row['id'] == '50%?'
+    assert row[1] == '?'
+
+
+def test_executemany_and_rowcount(storage):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.executemany('INSERT INTO users (id, free_chances) VALUES (?, ?)',
+                           [(f'u{i}', i) for i in range(450)])
+        cursor.execute('UPDATE users SET free_chances = free_chances + 1 WHERE free_chances >= ?', (400,))
+        assert cursor.rowcount == 50
+        cursor.execute('SELECT COUNT(*) FROM users')
+        assert cursor.fetchone()[0] == 450
+
+
+def test_rollback_on_error(storage):
+    with pytest.raises(Exception):
+        with UserManager.get_db_cursor() as cursor:
+            cursor.execute('INSERT INTO users (id, free_chances) VALUES (?, ?)', ('u1', 1))
+            cursor.execute('INSERT INTO users (id, free_chances) VALUES (?, ?)', ('u1', 1))
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT COUNT(*) FROM users')
+        assert cursor.fetchone()[0] == 0
+
+
+def test_schema_introspection(storage):
+    with UserManager.get_db_cursor() as cursor:
+        assert storage.table_exists(cursor, 'users')
+        assert not storage.table_exists(cursor, 'missing_table')
+        assert {'id', 'free_chances', 'last_shared_at'} <= set(storage.column_names(cursor, 'users'))
+
+
+def test_skip_locked_claims_distinct_rows(storage):
+    if storage.name != 'postgres':
+        pytest.skip('SQLite 的写事务本身是串行的')
+    with UserManager.get_db_cursor() as cursor:
+        cursor.executemany('INSERT INTO users (id, free_chances) VALUES (?, ?)', [('a', 1), ('b', 1)])
+    first, second = storage.acquire(), storage.acquire()
+    try:
+        claim = f'SELECT id FROM users ORDER BY id LIMIT 1 {storage.skip_locked}'
+        cursor_a, cursor_b = storage.cursor(first), storage.cursor(second)
+        cursor_a.execute(claim)
+        cursor_b.execute(claim)
+        assert (cursor_a.fetchone()['id'], cursor_b.fetchone()['id']) == ('a', 'b')
+    finally:
+        first.rollback()
+        second.rollback()
+        storage.release(first)
+        storage.release(second)
+
+
+def test_lock_timeout_is_classified_as_locked(storage):
+    if storage.name != 'postgres':
+        assert storage.error_kind(sqlite3.OperationalError('database is locked')) == 'locked'
+        assert storage.error_kind(sqlite3.OperationalError('no such table: x')) == 'operational'
+        assert storage.error_kind(ValueError('x')) is None
+        return
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('INSERT INTO users (id, free_chances) VALUES (?, ?)', ('a', 1))
+    holder, waiter = storage.acquire(), storage.acquire()
+    try:
+        storage.cursor(holder).execute("SELECT id FROM users WHERE id = 'a' FOR UPDATE")
+        cursor = storage.cursor(waiter)
+        cursor.execute("SET lock_timeout = '100ms'")
+        with pytest.raises(Exception) as excinfo:
+            cursor.execute("UPDATE users SET free_chances = 0 WHERE id = ?", ('a',))
+        assert storage.error_kind(excinfo.value) == 'locked'
+    finally:
+        holder.rollback()
+        waiter.rollback()
+        storage.release(holder)
+        storage.release(waiter)
+
+
+def test_sqlite_older_than_returning_support_is_rejected(monkeypatch, tmp_path):
+    monkeypatch.setattr(sqlite3, 'sqlite_version_info', (3, 31, 1))
+    monkeypatch.setattr(sqlite3, 'sqlite_version', '3.31.1')
+    with pytest.raises(RuntimeError, match='3.31.1'):
+        SQLiteBackend(str(tmp_path / 'old.db'))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""任务状态通知：订阅计数，超时退出的等待者不遗留 Event 也不唤醒其他等待者"""
+from api.task_events import TaskEventHub
+
+
+def test_timed_out_waiter_does_not_leak_or_wake_others():
+    hub = TaskEventHub()
+    first = hub.subscribe('t1')
+    second = hub.subscribe('t1')
+    assert first is second
+
+    # 第一个等待者超时离开：其他等待者不被唤醒，Event 仍保留
+    assert not first.wait(0.01)
+    hub.unsubscribe('t1', first)
+    assert not second.is_set()
+    assert hub.waiting() == 1
+
+    # 最后一个等待者离开后不再保留
+    hub.unsubscribe('t1', second)
+    assert hub.waiting() == 0
+
+
+def test_publish_wakes_every_subscriber():
+    hub = TaskEventHub()
+    events = [hub.subscribe('t1') for _ in range(3)]
+    hub.publish('t1')
+    assert all(event.is_set() for event in events)
+    assert hub.waiting() == 0
+
+    # 通知后重新订阅得到新的 Event，旧订阅者离开不影响新订阅
+    fresh = hub.subscribe('t1')
+    assert not fresh.is_set()
+    for event in events:
+        hub.unsubscribe('t1', event)
+    assert hub.waiting() == 1
+    hub.unsubscribe('t1', fresh)
+    assert hub.waiting() == 0
+
+
+def test_wait_for_task_unsubscribes_on_timeout(monkeypatch):
+    from api import index
+    monkeypatch.setattr(index, 'read_task', lambda task_id: {'id': task_id, 'status': 'QUEUED'})
+    assert index.wait_for_task('t1', 0.01)['status'] == 'QUEUED'
+    assert index.task_events.waiting() == 0
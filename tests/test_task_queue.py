@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""生成任务队列：回调地址持久化和重试发送，以及按领取时间恢复中断的任务（SQLite 和 PostgreSQL）"""
+import json
+import threading
+import time
+
+import pytest
+
+from api import task_queue as task_queue_module
+from api.task_queue import TaskQueue, STATUS_FAILED, STATUS_PROCESSING, STATUS_QUEUED, STATUS_SUCCESS, _now, deliver_callback
+from api.user_manager import UserManager
+
+
+@pytest.fixture
+def queue(storage, monkeypatch):
+    """不启动工作线程的队列，记录发送的回调"""
+    queue = TaskQueue(handler=lambda task: None, workers=1, max_pending=10)
+    queue.callbacks = []
+    monkeypatch.setattr(TaskQueue, '_send_callback',
+                        staticmethod(lambda url, body: queue.callbacks.append((url, body['status']))))
+    monkeypatch.setattr(task_queue_module.task_events, 'publish', lambda task_id: None)
+    UserManager.create_user('u1')
+    return queue
+
+
+def insert(task_id, status, created_at, claimed_at=None, callback_url=None):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO generation_tasks (id, user_id, status, birth_date, birth_time, birth_place,
+                                          callback_url, created_at, claimed_at)
+            VALUES (?, 'u1', ?, '1990-01-01', '08:00', '北京', ?, ?, ?)
+        ''', (task_id, status, callback_url, created_at, claimed_at))
+
+
+def status(task_id):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT status FROM generation_tasks WHERE id = ?', (task_id,))
+        return cursor.fetchone()['status']
+
+
+def drain(queue):
+    items = []
+    while not queue._queue.empty():
+        items.append(queue._queue.get_nowait())
+    return items
+
+
+def test_claim_returns_persisted_callback_url(queue):
+    queue.submit('t1', 'u1', '1990-01-01', '08:00', '北京', 'https://example.com/hook')
+    assert drain(queue) == ['t1']
+    task = queue._claim('t1')
+    assert task['callback_url'] == 'https://example.com/hook'
+    assert status('t1') == STATUS_PROCESSING
+    # 已被领取的任务不会再次领取
+    assert queue._claim('t1') is None
+
+    queue.complete(task, {'ok': True})
+    assert status('t1') == STATUS_SUCCESS
+    assert queue.callbacks == [('https://example.com/hook', STATUS_SUCCESS)]
+
+
+def test_recovered_task_keeps_callback_url(queue):
+    insert('t1', STATUS_PROCESSING, _now(-3600), _now(-3600), 'https://example.com/hook')
+    queue._recover()
+    assert drain(queue) == ['t1']
+    assert queue._claim('t1')['callback_url'] == 'https://example.com/hook'
+
+
+def test_recovery_uses_claim_time_not_creation_time(queue):
+    stale = -task_queue_module.STALE_SECONDS - 60
+    # 排队很久、刚被领取：仍在处理中
+    insert('recent', STATUS_PROCESSING, _now(stale), _now())
+    # 领取后长时间没有完成：视为中断
+    insert('stale', STATUS_PROCESSING, _now(stale), _now(stale))
+    # 迁移前领取的任务没有领取时间，按创建时间判断
+    insert('legacy', STATUS_PROCESSING, _now(stale))
+    insert('queued', STATUS_QUEUED, _now(-10))
+
+    queue._recover()
+    assert sorted(drain(queue)) == ['legacy', 'queued', 'stale']
+    assert status('recent') == STATUS_PROCESSING
+    assert status('stale') == STATUS_QUEUED
+    assert status('legacy') == STATUS_QUEUED
+
+
+def test_recovery_tops_up_queue_beyond_capacity(queue):
+    for i in range(12):
+        insert(f't{i:02d}', STATUS_QUEUED, _now(i - 100))
+    assert queue._recover() == 10
+    # 已在队列中的任务不重复放入
+    assert queue._recover() == 0
+    # 工作线程取出并领取了三个任务
+    for expected in ('t00', 't01', 't02'):
+        assert queue._queue.get_nowait() == expected
+        assert queue._claim(expected) is not None
+    # 队列有空位后补充仍在数据库中排队的任务
+    assert queue._recover() == 2
+    assert drain(queue)[-2:] == ['t10', 't11']
+
+
+def test_periodic_recovery_requeues_task_orphaned_at_runtime(queue):
+    insert('orphan', STATUS_PROCESSING, _now(-7200), _now(-task_queue_module.STALE_SECONDS - 60))
+    # 进程运行期间（而非重启时）其他实例崩溃留下的任务同样会被恢复
+    assert queue._recover() == 1
+    assert drain(queue) == ['orphan']
+    assert queue._claim('orphan') is not None
+
+
+class CallbackServer:
+    """按顺序返回预设状态码的回调接收端"""
+
+    def __init__(self, statuses):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        server = self
+        self.statuses = list(statuses)
+        self.bodies = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                server.bodies.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(server.statuses.pop(0) if server.statuses else 200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/hook'
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def callback_server():
+    servers = []
+
+    def start(*statuses):
+        servers.append(CallbackServer(statuses))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_callback_retries_server_errors(callback_server):
+    server = callback_server(500, 429)
+    assert deliver_callback(server.url, {'task_id': 't1'}, max_retries=3, backoff=0)
+    assert server.bodies == [{'task_id': 't1'}] * 3
+
+
+def test_callback_gives_up_after_max_retries(callback_server):
+    server = callback_server(503, 503, 503)
+    assert not deliver_callback(server.url, {'task_id': 't1'}, max_retries=1, backoff=0)
+    assert len(server.bodies) == 2
+
+
+def test_callback_client_errors_are_not_retried(callback_server):
+    server = callback_server(404)
+    assert not deliver_callback(server.url, {'task_id': 't1'}, max_retries=3, backoff=0)
+    assert len(server.bodies) == 1
+
+
+def test_send_callback_does_not_block_the_caller(callback_server, monkeypatch):
+    server = callback_server()
+    delivered = threading.Event()
+
+    def slow_deliver(url, body):
+        time.sleep(0.3)
+        deliver_callback(url, body)
+        delivered.set()
+
+    monkeypatch.setattr(task_queue_module, 'deliver_callback', slow_deliver)
+    started = time.monotonic()
+    TaskQueue._send_callback(server.url, {'task_id': 't1', 'status': STATUS_SUCCESS})
+    assert time.monotonic() - started < 0.2
+    assert delivered.wait(5)
+    assert server.bodies == [{'task_id': 't1', 'status': STATUS_SUCCESS}]
+
+
+def test_failed_task_refunds_the_chance_once(queue):
+    # 提交时已扣减一次机会
+    assert UserManager.consume_chance('u1') == 0
+    queue.submit('t1', 'u1', '1990-01-01', '08:00', '北京', 'https://example.com/hook')
+    task = queue._claim(drain(queue)[0])
+    queue.fail(task, RuntimeError('上游任务超时未完成'))
+    assert status('t1') == STATUS_FAILED
+    assert UserManager.get_user('u1')['free_chances'] == 1
+    # 重复标记失败不会多退
+    queue.fail(task, RuntimeError('上游任务超时未完成'))
+    assert UserManager.get_user('u1')['free_chances'] == 1
+    assert queue.callbacks[0] == ('https://example.com/hook', STATUS_FAILED)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""用户信息缓存：memory 和 redis（fakeredis）后端，以及 UserManager 的提交后写入约定"""
+import pytest
+
+from api import user_cache as user_cache_module
+from api import user_manager as user_manager_module
+from api.user_cache import MemoryUserCache, RedisUserCache, UserCache
+from api.user_manager import UserManager
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+@pytest.fixture
+def redis_cache(redis_client):
+    return RedisUserCache(ttl=30, prefix='test:user:', client=redis_client)
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    if request.param == 'memory':
+        return MemoryUserCache(ttl=30, max_entries=100)
+    return request.getfixturevalue('redis_cache')
+
+
+def test_add_does_not_overwrite_existing_entry(backend):
+    assert backend.add('u1', {'id': 'u1', 'free_chances': 1})
+    assert not backend.add('u1', {'id': 'u1', 'free_chances': 0})
+    assert backend.get('u1') == {'id': 'u1', 'free_chances': 1}
+
+
+def test_set_overwrites_and_delete_many_removes(backend):
+    backend.add('u1', {'id': 'u1', 'free_chances': 1})
+    backend.set('u1', {'id': 'u1', 'free_chances': 5})
+    backend.set('u2', {'id': 'u2', 'free_chances': 2})
+    assert backend.get('u1')['free_chances'] == 5
+    backend.delete_many(['u1', 'u2', 'missing'])
+    assert backend.get('u1') is None
+    assert backend.get('u2') is None
+
+
+def test_memory_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(user_cache_module.time, 'monotonic', lambda: now[0])
+    cache = MemoryUserCache(ttl=30, max_entries=100)
+    cache.set('u1', {'id': 'u1'})
+    now[0] += 29
+    assert cache.get('u1') == {'id': 'u1'}
+    now[0] += 2
+    assert cache.get('u1') is None
+    # 过期的条目不再阻止 add
+    assert cache.add('u1', {'id': 'u1', 'free_chances': 3})
+
+
+def test_memory_evicts_least_recently_used():
+    cache = MemoryUserCache(ttl=30, max_entries=2)
+    cache.set('a', {'id': 'a'})
+    cache.set('b', {'id': 'b'})
+    cache.get('a')
+    cache.set('c', {'id': 'c'})
+    assert len(cache) == 2
+    assert cache.get('b') is None
+    assert cache.get('a') and cache.get('c')
+
+
+def test_redis_values_are_json_with_ttl(redis_client, redis_cache):
+    redis_cache.set('u1', {'id': 'u1', 'free_chances': 2, 'last_shared_at': None})
+    assert redis_client.get('test:user:u1') == b'{"id": "u1", "free_chances": 2, "last_shared_at": null}'
+    assert 0 < redis_client.ttl('test:user:u1') <= 30
+
+
+def test_redis_delete_many_batches_keys(redis_client, redis_cache):
+    user_ids = [f'u{i}' for i in range(7)]
+    for user_id in user_ids:
+        redis_cache.set(user_id, {'id': user_id})
+    redis_cache.delete_many(user_ids, batch=3)
+    assert redis_client.keys('test:user:*') == []
+
+
+class BrokenBackend:
+    name = 'redis'
+
+    def __init__(self):
+        self.deleted = []
+
+    def get(self, user_id):
+        raise ConnectionError('down')
+
+    def set(self, user_id, user):
+        raise ConnectionError('down')
+
+    def delete(self, user_id):
+        self.deleted.append(user_id)
+
+    def delete_many(self, user_ids):
+        raise ConnectionError('down')
+
+
+def test_backend_errors_are_treated_as_miss():
+    backend = BrokenBackend()
+    cache = UserCache(backend)
+    assert cache.get('u1') is None
+    cache.delete_many(['u1'])
+    # 写入新值失败时删除旧值
+    cache.set('u1', {'id': 'u1'})
+    assert backend.deleted == ['u1']
+
+
+@pytest.fixture
+def cache(monkeypatch, redis_cache):
+    """UserManager 使用 fakeredis 上的缓存"""
+    cache = UserCache(redis_cache)
+    monkeypatch.setattr(user_manager_module, 'user_cache', cache)
+    return cache
+
+
+def test_user_manager_writes_cache_after_commit(storage, cache):
+    assert UserManager.consume_chance('u1') == 0
+    assert cache.get('u1')['free_chances'] == 0
+    assert UserManager.add_chances('u1', 3) == 3
+    assert UserManager.get_user('u1')['free_chances'] == 3
+
+
+def test_user_manager_drops_cache_on_rollback(storage, cache):
+    UserManager.add_chances('u1', 2)
+    with pytest.raises(RuntimeError):
+        with UserManager.get_db_cursor() as cursor:
+            UserManager.consume_chance('u1', cursor)
+            raise RuntimeError('abort')
+    # 回滚后缓存中不留未提交的值，下一次读取回到数据库
+    assert cache.get('u1') is None
+    assert UserManager.get_user('u1')['free_chances'] == 3
+
+
+def test_bulk_grant_invalidates_cached_users(storage, cache):
+    UserManager.add_chances('u1', 0)
+    assert cache.get('u1')['free_chances'] == 1
+    UserManager.add_chances_many(['u1', 'u2'], 2)
+    assert cache.get('u1') is None
+    assert UserManager.get_user('u1')['free_chances'] == 3
+    assert UserManager.get_user('u2')['free_chances'] == 3
+
+
+
+def test_nested_cursor_defers_cache_until_outer_exit(storage, cache):
+    from api.index import app
+    UserManager.add_chances('u1', 2)
+    # 同一应用上下文内嵌套的游标共用一个连接
+    with app.app_context():
+        with pytest.raises(RuntimeError):
+            with UserManager.get_db_cursor() as cursor:
+                UserManager.consume_chance('u1', cursor)
+                with UserManager.get_db_cursor() as inner:
+                    inner.execute('SELECT 1')
+                # 内层结束时不写入外层的改动
+                assert cache.get('u1')['free_chances'] == 3
+                raise RuntimeError('abort')
+    assert cache.get('u1') is None
+
+
+def test_inner_rollback_drops_cache_at_outer_exit(storage, cache):
+    from api.index import app
+    UserManager.add_chances('u1', 2)
+    with app.app_context():
+        with UserManager.get_db_cursor() as cursor:
+            UserManager.consume_chance('u1', cursor)
+            with pytest.raises(RuntimeError):
+                with UserManager.get_db_cursor():
+                    raise RuntimeError('abort')
+    # 内层回滚过，最外层结束时按回滚处理：删除缓存而不是写入
+    assert cache.get('u1') is None
+    assert user_manager_module._pending_cache_writes.depth == 0
+    # 之后的事务恢复正常写入
+    UserManager.add_chances('u1', 0)
+    assert cache.get('u1') is not None
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""免费机会的增减：单条 UPSERT ... RETURNING 在两种后端上的行为和并发扣减"""
+import threading
+
+from api.user_manager import UserManager, DEFAULT_FREE_CHANCES
+
+
+def chances(user_id):
+    with UserManager.get_db_cursor() as cursor:
+        cursor.execute('SELECT free_chances FROM users WHERE id = ?', (user_id,))
+        return cursor.fetchone()['free_chances']
+
+
+def test_consume_creates_user_with_default_chances(storage):
+    assert UserManager.consume_chance('new') == DEFAULT_FREE_CHANCES - 1
+    assert chances('new') == DEFAULT_FREE_CHANCES - 1
+
+
+def test_consume_at_zero_returns_none(storage):
+    UserManager.consume_chance('u1')
+    assert chances('u1') == 0
+    assert UserManager.consume_chance('u1') is None
+    # 没有可用机会时不会扣成负数
+    assert chances('u1') == 0
+
+
+def test_add_chances_creates_or_increments(storage):
+    assert UserManager.add_chances('u1', 3) == DEFAULT_FREE_CHANCES + 3
+    assert UserManager.add_chances('u1', 2) == DEFAULT_FREE_CHANCES + 5
+    assert chances('u1') == DEFAULT_FREE_CHANCES + 5
+
+
+def test_concurrent_consume_never_oversells(storage):
+    UserManager.add_chances('u1', 5 - DEFAULT_FREE_CHANCES)
+    results = []
+    barrier = threading.Barrier(10)
+
+    def consume():
+        barrier.wait()
+        results.append(UserManager.consume_chance('u1'))
+
+    threads = [threading.Thread(target=consume) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 五次成功，剩余数各不相同；其余五次没有机会可扣
+    assert sorted(r for r in results if r is not None) == [0, 1, 2, 3, 4]
+    assert results.count(None) == 5
+    assert chances('u1') == 0
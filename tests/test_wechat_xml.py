@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""微信支付 XML 编解码"""
+import pytest
+
+from api.wechat_xml import parse_xml, to_xml, sign, verify_sign, XMLCodecError
+
+LAUGHS = (
+    '<?xml version="1.0" encoding="{encoding}"?>'
+    '<!DOCTYPE xml ['
+    '<!ENTITY a "aaaaaaaaaa">'
+    '<!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">'
+    '<!ENTITY c "&b;&b;&b;&b;&b;&b;&b;&b;&b;&b;">'
+    ']>'
+    '<xml><return_code>&c;</return_code></xml>'
+)
+
+
+def test_round_trip():
+    params = {'return_code': 'SUCCESS', 'total_fee': 100, 'attach': 'a]]>b<c>&d'}
+    assert parse_xml(to_xml(params)) == {'return_code': 'SUCCESS', 'total_fee': '100', 'attach': 'a]]>b<c>&d'}
+
+
+@pytest.mark.parametrize('encoding', ['utf-8', 'utf-16', 'utf-16-le', 'utf-16-be'])
+def test_rejects_entity_expansion_in_any_encoding(encoding):
+    payload = LAUGHS.format(encoding=encoding.upper()).encode(encoding)
+    if encoding == 'utf-16':
+        assert payload.startswith((b'\xff\xfe', b'\xfe\xff'))
+    with pytest.raises(XMLCodecError):
+        parse_xml(payload)
+
+
+def test_rejects_external_entities():
+    payload = (b'<?xml version="1.0"?><!DOCTYPE xml [<!ENTITY x SYSTEM "file:///etc/passwd">]>'
+               b'<xml><a>&x;</a></xml>')
+    with pytest.raises(XMLCodecError):
+        parse_xml(payload)
+
+
+def test_rejects_bare_doctype_and_undeclared_entities():
+    with pytest.raises(XMLCodecError):
+        parse_xml(b'<!DOCTYPE xml SYSTEM "http://example.com/x.dtd"><xml><a>1</a></xml>')
+    with pytest.raises(XMLCodecError):
+        parse_xml(b'<xml><a>&undeclared;</a></xml>')
+
+
+@pytest.mark.parametrize('payload', [
+    b'<root><a>1</a></root>',
+    b'<xml><a><b>1</b></a></xml>',
+    b'<xml><a>1</a><a>2</a></xml>',
+    b'<xml><a>1</a>',
+])
+def test_rejects_malformed_structure(payload):
+    with pytest.raises(XMLCodecError):
+        parse_xml(payload)
+
+
+def test_rejects_oversized_payload():
+    with pytest.raises(XMLCodecError):
+        parse_xml(b'<xml><a>' + b'x' * 100 + b'</a></xml>', max_bytes=64)
+
+
+def test_sign_and_verify():
+    params = {'appid': 'wx1', 'nonce_str': 'abc', 'empty': ''}
+    params['sign'] = sign(params, 'key')
+    assert verify_sign(params, 'key')
+    params['nonce_str'] = 'abd'
+    assert not verify_sign(params, 'key')